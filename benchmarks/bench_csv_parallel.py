@@ -0,0 +1,48 @@
+"""Benchmark parsing a large CSV import with different numbers of workers.
+
+	python benchmarks/bench_csv_parallel.py --rows 500000
+"""
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import budgery.csv
+
+IMPORT_DATA = Path(__file__).parent.parent / "tests" / "import_data"
+
+def _write_csv(path: str, filename: str, rows: int) -> int:
+	"Repeat the records of one of the test files until there are at least rows of them."
+	with open(IMPORT_DATA / filename, "rb") as f:
+		header = f.readline()
+		records = f.readlines()
+	repeat = rows // len(records) + 1
+	with open(path, "wb") as f:
+		f.write(header)
+		for _ in range(repeat):
+			f.writelines(records)
+	return repeat * len(records)
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--format", default="afcu.csv", help="File in tests/import_data to scale up")
+	parser.add_argument("--rows", type=int, default=500000, help="Records in the generated file")
+	parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, args.format)
+		records = _write_csv(path, args.format, args.rows)
+		size = os.path.getsize(path)
+		print(f"{records} records, {size / 2**20:.1f} MiB")
+		print(f"{'workers':>8}{'rows':>10}{'seconds':>10}{'rows/s':>12}")
+		for workers in args.workers:
+			start = time.perf_counter()
+			with open(path, "rb") as f:
+				count = sum(1 for _ in budgery.csv.extract_rows(f, workers=workers))
+			elapsed = time.perf_counter() - start
+			print(f"{workers:>8}{count:>10}{elapsed:>10.2f}{count / elapsed:>12.0f}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,45 @@
+"""Micro-benchmark import date parsing against plain strptime.
+
+	python benchmarks/bench_dates.py --rows 100000 --distinct 365
+"""
+import argparse
+import datetime
+import random
+import time
+
+from budgery import dates
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--distinct", type=int, default=365, help="Distinct dates among the rows")
+	parser.add_argument("--rows", type=int, default=100000, help="Dates to parse")
+	args = parser.parse_args()
+
+	start = datetime.date(2023, 1, 1)
+	distinct = [(start + datetime.timedelta(days=i)).strftime("%m/%d/%Y") for i in range(args.distinct)]
+	values = [random.choice(distinct) for _ in range(args.rows)]
+
+	def strptime():
+		for v in values:
+			datetime.datetime.strptime(v, "%m/%d/%Y")
+
+	def fast_uncached():
+		uncached = dates.DateParser("%m/%d/%Y", cache_size=0)
+		for v in values:
+			uncached(v)
+
+	parse = dates.DateParser("%m/%d/%Y")
+	def cached():
+		for v in values:
+			parse(v)
+
+	print(f"{'parser':<16}{'seconds':>10}{'dates/s':>14}")
+	for name, fn in (("strptime", strptime), ("fast", fast_uncached), ("fast + cache", cached)):
+		begin = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - begin
+		print(f"{name:<16}{elapsed:>10.3f}{args.rows / elapsed:>14.0f}")
+	print(f"cache hit rate {parse.hits / (parse.hits + parse.misses):.1%}")
+
+if __name__ == "__main__":
+	main()
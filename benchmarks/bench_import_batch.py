@@ -0,0 +1,47 @@
+"""Benchmark the memory used to hold imported rows.
+
+Compares a list of ImportRow objects with the same rows packed into
+ImportBatch columns, both in memory and pickled for a worker process.
+
+	python benchmarks/bench_import_batch.py --rows 100000
+"""
+import argparse
+import datetime
+import pickle
+import tracemalloc
+
+from budgery.dataclasses import ImportBatch, ImportRow
+
+def _rows(count: int):
+	start = datetime.datetime(2023, 1, 1)
+	for i in range(count):
+		yield ImportRow(
+			account_id_is_from=bool(i % 2),
+			amount=round((i % 10000) / 100, 2),
+			at=start + datetime.timedelta(days=i % 365),
+			description=f"MERCHANT {i % 500}",
+			sourcink_from=None,
+			sourcink_to=None,
+		)
+
+def _measure(build):
+	tracemalloc.start()
+	held = build()
+	current, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return held, current
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=100000, help="Rows to hold")
+	args = parser.parse_args()
+
+	rows, rows_memory = _measure(lambda: list(_rows(args.rows)))
+	batches, batch_memory = _measure(lambda: list(ImportBatch.batched(_rows(args.rows), args.rows)))
+	print(f"{'representation':<16}{'MiB held':>10}{'MiB pickled':>14}")
+	for name, held, memory in (("ImportRow list", rows, rows_memory), ("ImportBatch", batches, batch_memory)):
+		pickled = len(pickle.dumps(held, protocol=pickle.HIGHEST_PROTOCOL))
+		print(f"{name:<16}{memory / 2**20:>10.1f}{pickled / 2**20:>14.1f}")
+
+if __name__ == "__main__":
+	main()
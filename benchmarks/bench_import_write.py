@@ -0,0 +1,103 @@
+"""Benchmark writing imported transactions to the database.
+
+Compares creating one transaction per commit with crud.transaction_bulk_create
+using the files in tests/import_data scaled up to a larger number of rows.
+
+	python benchmarks/bench_import_write.py --rows 20000
+"""
+import argparse
+import datetime
+import itertools
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from budgery import task
+from budgery.dataclasses import ImportBatch
+from budgery.db import crud, models
+from budgery.db.connection import session
+from budgery.user import User
+
+IMPORT_DATA = Path(__file__).parent.parent / "tests" / "import_data"
+FILENAMES = ("afcu.csv", "ally.csv", "amex.xlsx", "every_dollar.csv")
+
+def _setup(path: str):
+	engine = create_engine(f"sqlite:///{path}")
+	models.Base.metadata.create_all(engine)
+	db = session(engine)
+	user = User(
+		auth_time=datetime.datetime.utcnow(),
+		email_verified=False,
+		expiration=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+		name="Bench Marker",
+		username="benchmarker",
+	)
+	db_user = crud.user_ensure_exists(db, user)
+	institution = crud.institution_create(db=db, user=db_user, aba_routing_number=0, name="bench")
+	account = crud.account_create(db=db, institution_id=institution.id, name="bench", user=db_user)
+	return db, db_user, account
+
+def _scaled_rows(filename: str, count: int):
+	with open(IMPORT_DATA / filename, "rb") as f:
+		rows = list(task._extract_rows(f))
+	return list(itertools.islice(itertools.cycle(rows), count))
+
+def _per_row(db, import_job, values) -> None:
+	for v in values:
+		crud.transaction_create(
+			db=db,
+			account_id_from=v["account_id_from"],
+			account_id_to=v["account_id_to"],
+			amount=v["amount"],
+			at=v["at"],
+			category=v["category"],
+			description=v["description"],
+			import_job=import_job,
+			sourcink_from=None,
+			sourcink_to=None,
+		)
+
+def _bulk(db, import_job, values, chunk_size: int) -> None:
+	crud.transaction_bulk_create(
+		db=db,
+		transactions=values,
+		import_job=import_job,
+		chunk_size=chunk_size,
+	)
+
+def _run(filename: str, rows, writer, **kwargs) -> float:
+	with tempfile.TemporaryDirectory() as tmp:
+		db, db_user, account = _setup(os.path.join(tmp, "bench.db"))
+		import_job = crud.import_job_create(account_id=account.id, db=db, filename=filename, user=db_user)
+		crud.SOURCINK_RESOLVER.invalidate()
+		batches = ImportBatch.batched(rows, crud.TRANSACTION_BULK_CHUNK_SIZE)
+		values = list(task._transaction_values(
+			batches,
+			account.id,
+			lambda names: crud.SOURCINK_RESOLVER.resolve(db, names),
+		))
+		start = time.perf_counter()
+		writer(db, import_job, values, **kwargs)
+		elapsed = time.perf_counter() - start
+		db.close()
+	return len(values) / elapsed
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=20000, help="Rows to import per format")
+	parser.add_argument("--per-row-limit", type=int, default=2000, help="Cap the slow per-row run to this many rows")
+	parser.add_argument("--chunk-size", type=int, default=crud.TRANSACTION_BULK_CHUNK_SIZE)
+	args = parser.parse_args()
+
+	print(f"{'format':<18}{'per-row rows/s':>16}{'bulk rows/s':>16}{'speedup':>10}")
+	for filename in FILENAMES:
+		rows = _scaled_rows(filename, args.rows)
+		before = _run(filename, rows[:args.per_row_limit], _per_row)
+		after = _run(filename, rows, _bulk, chunk_size=args.chunk_size)
+		print(f"{filename:<18}{before:>16.0f}{after:>16.0f}{after / before:>9.1f}x")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,88 @@
+"""Benchmark extracting rows from a large synthetic OFX file.
+
+Generates a brokerage-sized SGML or XML OFX file and measures throughput and
+peak memory of budgery.ofx.extract_rows.
+
+	python benchmarks/bench_ofx.py --rows 500000
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+import budgery.ofx
+
+SGML_HEADER = "\r\n".join((
+	"OFXHEADER:100",
+	"DATA:OFXSGML",
+	"VERSION:102",
+	"SECURITY:NONE",
+	"ENCODING:USASCII",
+	"CHARSET:1252",
+	"COMPRESSION:NONE",
+	"OLDFILEUID:NONE",
+	"NEWFILEUID:NONE",
+	"",
+	"",
+))
+XML_HEADER = (
+	'<?xml version="1.0" encoding="UTF-8"?>\n'
+	'<?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>\n'
+)
+
+def _transaction(i: int, xml: bool) -> str:
+	"Get the STMTTRN aggregate of the i-th synthetic transaction."
+	posted = datetime.date(2010, 1, 1) + datetime.timedelta(days=i // 50)
+	amount = -((i * 37) % 20000) / 100 if i % 7 else (i % 300000) / 100
+	elements = (
+		("TRNTYPE", "DEBIT" if amount < 0 else "CREDIT"),
+		("DTPOSTED", posted.strftime("%Y%m%d") + "120000.000[-5:EST]"),
+		("TRNAMT", f"{amount:.2f}"),
+		("FITID", f"{posted:%Y%m%d}{i:08d}"),
+		("NAME", f"MERCHANT {i % 977} &amp; CO"),
+		("MEMO", f"PURCHASE REF {i}"),
+	)
+	if xml:
+		body = "".join(f"<{name}>{value}</{name}>" for name, value in elements)
+	else:
+		body = "".join(f"<{name}>{value}\r\n" for name, value in elements)
+	return f"<STMTTRN>\r\n{body}</STMTTRN>\r\n"
+
+def _write_ofx(path: str, rows: int, xml: bool) -> None:
+	"Write a bank statement with rows transactions."
+	with open(path, "w", encoding="UTF-8", newline="") as f:
+		f.write(XML_HEADER if xml else SGML_HEADER)
+		f.write("<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>USD</CURDEF><BANKTRANLIST>\r\n")
+		for i in range(rows):
+			f.write(_transaction(i, xml))
+		f.write("</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\r\n")
+
+def _count_rows(path: str) -> int:
+	with open(path, "rb") as f:
+		return sum(1 for _ in budgery.ofx.extract_rows(f))
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=500000, help="Transactions in the generated file")
+	args = parser.parse_args()
+
+	print(f"{'format':<8}{'MiB':>8}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak MiB':>10}")
+	with tempfile.TemporaryDirectory() as tmp:
+		for name, xml in (("sgml", False), ("xml", True)):
+			path = os.path.join(tmp, f"bench.{name}.ofx")
+			_write_ofx(path, args.rows, xml)
+			size = os.path.getsize(path) / 2**20
+			start = time.perf_counter()
+			count = _count_rows(path)
+			elapsed = time.perf_counter() - start
+			# Tracing slows everything down, so measure memory on a separate run.
+			tracemalloc.start()
+			_count_rows(path)
+			peak = tracemalloc.get_traced_memory()[1] / 2**20
+			tracemalloc.stop()
+			print(f"{name:<8}{size:>8.1f}{count:>10}{elapsed:>10.2f}{count / elapsed:>12.0f}{peak:>10.1f}")
+
+if __name__ == "__main__":
+	main()
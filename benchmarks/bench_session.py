@@ -0,0 +1,51 @@
+"""Benchmark what each request pays to get a database session.
+
+Compares building a versioned sessionmaker for every session, as get_db used
+to, with the shared factory in budgery.db.connection. Each request gets a
+session, runs one small query and closes it.
+
+	python benchmarks/bench_session.py --requests 20000
+"""
+import argparse
+import gc
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.event import registry
+from sqlalchemy.orm import sessionmaker
+
+from budgery.db import connection, models
+from budgery.db.history_meta import versioned_session
+
+def per_request_factory(engine):
+	maker = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+	versioned_session(maker)
+	return maker()
+
+def _before_flush_listeners() -> int:
+	gc.collect()
+	return sum(1 for _, identifier, _ in registry._key_to_collection if identifier == "before_flush")
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--requests", type=int, default=20000, help="Sessions to get")
+	args = parser.parse_args()
+
+	engine = create_engine("sqlite://")
+	models.Base.metadata.create_all(engine)
+	query = select(models.Budget).where(models.Budget.id == 1)
+
+	print(f"{'factory':<16}{'seconds':>10}{'us/request':>12}{'listeners':>11}")
+	for name, get_session in (("per request", per_request_factory), ("shared", connection.session)):
+		listeners = _before_flush_listeners()
+		begin = time.perf_counter()
+		for _ in range(args.requests):
+			db = get_session(engine)
+			db.execute(query).first()
+			db.close()
+		elapsed = time.perf_counter() - begin
+		grown = _before_flush_listeners() - listeners
+		print(f"{name:<16}{elapsed:>10.3f}{elapsed / args.requests * 1e6:>12.1f}{grown:>+11}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,100 @@
+"""Load test SQLite with imports writing while pages are read.
+
+Runs writer threads that commit batches of transactions, as imports do, and
+reader threads that list recent transactions, as page loads do. They run
+against a database with SQLite's defaults and again with the profile from
+db.connection.connect, and the throughput of each is reported.
+
+	python benchmarks/bench_sqlite_load.py --seconds 10 --readers 8 --writers 2
+"""
+import argparse
+import datetime
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from starlette.config import Config
+
+from budgery.db import crud, models
+from budgery.db.connection import connect, session
+
+def _default_engine(path: str):
+	"An engine set up the way connect used to."
+	return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+def _tuned_engine(path: str):
+	return connect(Config(environ={"SQL_ALCHEMY_DATABASE_URL": f"sqlite:///{path}"}))
+
+def _run(engine, seconds: float, readers: int, writers: int, batch_size: int, seed_rows: int):
+	models.Base.metadata.create_all(engine)
+	counter = itertools.count()
+	start = datetime.datetime(2023, 1, 1)
+	def rows(n):
+		return [{
+			"amount": 1.0,
+			"at": start + datetime.timedelta(minutes=i),
+			"description": f"Transaction {i}",
+			"fingerprint": f"f{i}",
+		} for i in itertools.islice(counter, n)]
+	db = session(engine)
+	db.execute(insert(models.Transaction), rows(seed_rows))
+	db.commit()
+	db.close()
+
+	stop = threading.Event()
+	counts = {"reads": 0, "writes": 0, "errors": 0}
+	lock = threading.Lock()
+	def work(name, operation):
+		done = errors = 0
+		db = session(engine)
+		while not stop.is_set():
+			try:
+				operation(db)
+				done += 1
+			except OperationalError:
+				db.rollback()
+				errors += 1
+		db.close()
+		with lock:
+			counts[name] += done
+			counts["errors"] += errors
+	def read(db):
+		crud.transaction_list(db, limit=50)
+		db.rollback()
+	def write(db):
+		db.execute(insert(models.Transaction), rows(batch_size))
+		db.commit()
+	threads = [threading.Thread(target=work, args=("reads", read)) for _ in range(readers)]
+	threads += [threading.Thread(target=work, args=("writes", write)) for _ in range(writers)]
+	for thread in threads:
+		thread.start()
+	time.sleep(seconds)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	engine.dispose()
+	return counts
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--batch-size", type=int, default=100, help="Transactions per write")
+	parser.add_argument("--readers", type=int, default=8, help="Threads listing transactions")
+	parser.add_argument("--seconds", type=float, default=10, help="How long to run each profile")
+	parser.add_argument("--seed-rows", type=int, default=20000, help="Transactions to start with")
+	parser.add_argument("--writers", type=int, default=2, help="Threads writing transactions")
+	args = parser.parse_args()
+
+	print(f"{'profile':<10}{'reads/s':>10}{'rows written/s':>16}{'errors':>8}")
+	for name, make_engine in (("default", _default_engine), ("tuned", _tuned_engine)):
+		with tempfile.TemporaryDirectory() as directory:
+			engine = make_engine(os.path.join(directory, "load.db"))
+			counts = _run(engine, args.seconds, args.readers, args.writers, args.batch_size, args.seed_rows)
+		print(f"{name:<10}{counts['reads'] / args.seconds:>10.0f}"
+			f"{counts['writes'] * args.batch_size / args.seconds:>16.0f}{counts['errors']:>8}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,113 @@
+"""Benchmark extracting rows from a large Amex-style xlsx file.
+
+Compares loading the whole workbook and building lists, as the importer used
+to, with the read-only streaming budgery.xlsx.extract_rows.
+
+	python benchmarks/bench_xlsx_extract.py --rows 100000
+"""
+import argparse
+import datetime
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import openpyxl
+
+import budgery.xlsx
+
+HEADER = (
+	"Date",
+	"Description",
+	"Card Member",
+	"Account #",
+	"Amount",
+	"Extended Details",
+	"Appears On Your Statement As",
+	"Address",
+	"City/State",
+	"Zip Code",
+	"Country",
+	"Reference",
+	"Category",
+)
+
+def _write_sheet(path: str, rows: int) -> None:
+	"Write a synthetic 'Transaction Details' sheet laid out like an Amex export."
+	workbook = openpyxl.Workbook(write_only=True)
+	sheet = workbook.create_sheet("Transaction Details")
+	sheet.append(("Transaction Details", "Synthetic Card / Jan 01, 2023 to Dec 31, 2023"))
+	for label in ("Prepared for", "A CARD MEMBER", "Account Number", "XXXX-XXXXXX-00000", ""):
+		sheet.append((label, ""))
+	sheet.append(HEADER)
+	start = datetime.date(2023, 1, 1)
+	for i in range(rows):
+		at = start + datetime.timedelta(days=i % 365)
+		sheet.append((
+			at.strftime("%m/%d/%Y"),
+			f"MERCHANT {i % 500}            AZ",
+			"A CARD MEMBER",
+			"-00000",
+			round((i % 10000) / 100, 2),
+			f"DETAILS {i}\nMERCHANT {i % 500}\nCHANDLER\nAZ",
+			f"MERCHANT {i % 500}            AZ",
+			"100 MAIN ST",
+			"CHANDLER\nAZ",
+			"85286",
+			"UNITED STATES",
+			str(320230000000000000 + i),
+			"Merchandise & Supplies-Department Stores",
+		))
+	workbook.save(path)
+
+def _extract_rows_full(content: bytes):
+	"The previous full-load implementation of budgery.xlsx.extract_rows."
+	with warnings.catch_warnings(record=True):
+		warnings.simplefilter("always")
+		workbook = openpyxl.load_workbook(io.BytesIO(content))
+		sheet = workbook["Transaction Details"]
+	itr = sheet.iter_rows()
+	for i in range(6):
+		next(itr)
+	headers = tuple(c.value for c in next(itr))
+	rows = ({h: row[i].value for i, h in enumerate(headers)} for row in itr)
+	data = [budgery.xlsx._process_amex(row) for row in rows]
+	return [d for d in data if d]
+
+def _measure(fn):
+	"Time fn, then run it again under tracemalloc for its peak memory."
+	start = time.perf_counter()
+	count = fn()
+	elapsed = time.perf_counter() - start
+	tracemalloc.start()
+	fn()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return count, elapsed, peak
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--rows", type=int, default=100000, help="Transactions in the synthetic sheet")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "amex.xlsx")
+		_write_sheet(path, args.rows)
+
+		def full():
+			with open(path, "rb") as f:
+				return len(_extract_rows_full(f.read()))
+
+		def streaming():
+			with open(path, "rb") as f:
+				return sum(1 for _ in budgery.xlsx.extract_rows(f))
+
+		print(f"{'mode':<12}{'rows':>10}{'seconds':>10}{'peak MiB':>10}")
+		for name, fn in (("full", full), ("streaming", streaming)):
+			count, elapsed, peak = _measure(fn)
+			print(f"{name:<12}{count:>10}{elapsed:>10.2f}{peak / 2**20:>10.1f}")
+
+if __name__ == "__main__":
+	main()
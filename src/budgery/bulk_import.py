@@ -0,0 +1,275 @@
+"Import a directory of statements without going through the web server."
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import logging
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.config import Config
+
+from budgery import task
+from budgery.db import crud, models
+from budgery.db.connection import connect, session
+
+LOGGER = logging.getLogger(__name__)
+
+@dataclasses.dataclass
+class BulkImportSummary:
+	"What importing a directory did."
+	files: int
+	# Files that had already been imported into the same account.
+	duplicates: int
+	finished: int
+	failed: int
+	rows: int
+	# Transactions that were already in the database.
+	skipped: int
+	seconds: float
+	# Total rows and seconds of each stage across all the imports.
+	stages: Dict[str, Tuple[int, float]]
+
+	@property
+	def rows_per_second(self) -> Optional[float]:
+		return self.rows / self.seconds if self.seconds else None
+
+def find_import_files(directory: Path) -> List[Path]:
+	"Get the files under directory in name order, skipping hidden files and directories."
+	return sorted(
+		p for p in directory.rglob("*")
+		if p.is_file() and not any(part.startswith(".") for part in p.relative_to(directory).parts)
+	)
+
+def _accounts_for_files(
+		directory: Path,
+		paths: List[Path],
+		account_id: Optional[int],
+		mapping: Mapping[str, int],
+	) -> Dict[Path, int]:
+	"""Get the account to import each file into.
+
+	A file's path relative to directory is looked up in mapping, then its name,
+	then it falls back to account_id. Raises ValueError if a file has no account.
+	"""
+	accounts = {}
+	missing = []
+	for path in paths:
+		relative = path.relative_to(directory).as_posix()
+		account = mapping.get(relative, mapping.get(path.name, account_id))
+		if account is None:
+			missing.append(relative)
+		accounts[path] = account
+	if missing:
+		raise ValueError(f"No account for {', '.join(missing)}")
+	return accounts
+
+def queue_directory(
+		db: Session,
+		directory: Path,
+		user: models.User,
+		upload_directory: str,
+		account_id: Optional[int] = None,
+		mapping: Optional[Mapping[str, int]] = None,
+	) -> Tuple[int, List[models.ImportJob], int]:
+	"""Queue an import job for each file under directory, expanding ZIP archives.
+
+	Returns how many files were found, the jobs that were created and how many
+	files had already been imported into their account.
+	"""
+	paths = find_import_files(directory)
+	accounts = _accounts_for_files(directory, paths, account_id, mapping or {})
+	for account in set(accounts.values()):
+		if db.get(models.Account, account) is None:
+			raise ValueError(f"There is no account {account}")
+	import_jobs = []
+	duplicates = 0
+	for path in paths:
+		with open(path, "rb") as f:
+			uploads = task.spool_uploads(f, path.name, upload_directory)
+		for filename, upload in uploads:
+			import_job, created = task.import_job_create_for_upload(
+				db=db,
+				account_id=accounts[path],
+				filename=filename,
+				upload=upload,
+				user=user,
+			)
+			if created:
+				import_jobs.append(import_job)
+			else:
+				duplicates += 1
+	return len(paths), import_jobs, duplicates
+
+def run_queued_imports(
+		db_engine: Engine,
+		import_job_ids: List[int],
+		concurrency: int = 1,
+		parse_workers: int = 1,
+		chunk_size: int = crud.TRANSACTION_BULK_CHUNK_SIZE,
+		archive_directory: Optional[str] = None,
+	) -> None:
+	"""Work the import queue on concurrency threads until it is empty.
+
+	Like an import worker this runs any queued job, not just import_job_ids,
+	which are only used to report progress. A thread whose jobs fail waits
+	longer after each failure in a row, like an in-process runner. Raises
+	RuntimeError once a thread has failed task.IMPORT_MAX_FAILURES times in a
+	row, after stopping the others.
+	"""
+	wanted = set(import_job_ids)
+	done = []
+	lock = threading.Lock()
+	give_up = threading.Event()
+	def drain() -> None:
+		failures = 0
+		while not give_up.is_set():
+			try:
+				import_job_id = task.run_next_import_job(
+					db_engine,
+					parse_workers=parse_workers,
+					archive_directory=archive_directory,
+					chunk_size=chunk_size,
+				)
+			except Exception:
+				# The job's lease will lapse and a worker will retry it.
+				LOGGER.exception("Import job failed")
+				failures += 1
+				if failures >= task.IMPORT_MAX_FAILURES:
+					give_up.set()
+					return
+				give_up.wait(task.IMPORT_FAILURE_DELAY * 2 ** (failures - 1))
+				continue
+			failures = 0
+			if import_job_id is None:
+				return
+			if import_job_id in wanted:
+				with lock:
+					done.append(import_job_id)
+					LOGGER.info("Ran import job %d (%d/%d)", import_job_id, len(done), len(wanted))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for future in [executor.submit(drain) for _ in range(concurrency)]:
+			future.result()
+	if give_up.is_set():
+		raise RuntimeError(f"Gave up after {task.IMPORT_MAX_FAILURES} failed import jobs in a row")
+
+def summarize(
+		db: Session,
+		files: int,
+		import_job_ids: List[int],
+		duplicates: int,
+		seconds: float,
+	) -> BulkImportSummary:
+	"Total up the results of the import jobs created for a directory."
+	import_jobs = [db.get(models.ImportJob, i) for i in import_job_ids]
+	stages = collections.defaultdict(lambda: (0, 0.0))
+	for import_job in import_jobs:
+		for stage in import_job.stages:
+			rows, stage_seconds = stages[stage.name]
+			stages[stage.name] = (rows + stage.rows, stage_seconds + stage.seconds)
+	finished = [j for j in import_jobs if j.status == models.ImportJobStatus.finished]
+	return BulkImportSummary(
+		files=files,
+		duplicates=duplicates,
+		finished=len(finished),
+		failed=len(import_jobs) - len(finished),
+		rows=sum(j.row_count or 0 for j in finished),
+		skipped=sum(j.skipped_count or 0 for j in finished),
+		seconds=seconds,
+		stages=dict(stages),
+	)
+
+def import_directory(
+		db_engine: Engine,
+		directory: Path,
+		username: str,
+		upload_directory: str,
+		account_id: Optional[int] = None,
+		mapping: Optional[Mapping[str, int]] = None,
+		concurrency: int = 1,
+		parse_workers: int = 1,
+		chunk_size: int = crud.TRANSACTION_BULK_CHUNK_SIZE,
+		archive_directory: Optional[str] = None,
+	) -> BulkImportSummary:
+	"""Import every file under directory as username and wait for them to finish.
+
+	Each file becomes its own import job, exactly as if it had been uploaded,
+	so it can be seen, retried and replayed from the web server afterwards.
+	"""
+	start = time.perf_counter()
+	db = session(db_engine)
+	try:
+		user = crud.user_get_by_username(db, username)
+		if user is None:
+			raise ValueError(f"There is no user '{username}'")
+		files, import_jobs, duplicates = queue_directory(
+			db=db,
+			directory=directory,
+			user=user,
+			upload_directory=upload_directory,
+			account_id=account_id,
+			mapping=mapping,
+		)
+		import_job_ids = [j.id for j in import_jobs]
+		LOGGER.info("Queued %d import jobs for %d files", len(import_job_ids), files)
+		run_queued_imports(
+			db_engine,
+			import_job_ids,
+			concurrency=concurrency,
+			parse_workers=parse_workers,
+			chunk_size=chunk_size,
+			archive_directory=archive_directory,
+		)
+		db.expire_all()
+		return summarize(db, files, import_job_ids, duplicates, time.perf_counter() - start)
+	finally:
+		db.close()
+
+def _print_summary(summary: BulkImportSummary) -> None:
+	print(f"Files:      {summary.files} ({summary.duplicates} already imported)")
+	print(f"Jobs:       {summary.finished} finished, {summary.failed} failed")
+	print(f"Rows:       {summary.rows} ({summary.skipped} already in the database)")
+	rate = summary.rows_per_second
+	print(f"Time:       {summary.seconds:.1f}s" + (f", {rate:.0f} rows/s" if rate else ""))
+	for name, (rows, seconds) in summary.stages.items():
+		print(f"  {name:<10}{rows:>10} rows {seconds:>8.2f}s")
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Import a directory of statements into Budgery.")
+	parser.add_argument("--env", default="env", help="Path to the config file")
+	parser.add_argument("directory", type=Path, help="Directory of files to import")
+	parser.add_argument("--user", required=True, help="Username to import as")
+	parser.add_argument("--account", type=int, default=None, help="Account to import files into when --mapping doesn't say")
+	parser.add_argument("--mapping", type=Path, default=None, help="File of 'filename = account ID' lines")
+	parser.add_argument("--concurrency", type=int, default=2, help="Files to import at once")
+	parser.add_argument("--parse-workers", type=int, default=1, help="Processes to parse each large CSV file with")
+	parser.add_argument("--batch-size", type=int, default=crud.TRANSACTION_BULK_CHUNK_SIZE, help="Transactions per commit")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	config = Config(args.env)
+	try:
+		mapping = task.parse_account_mapping(args.mapping.read_text()) if args.mapping else {}
+		summary = import_directory(
+			connect(config),
+			directory=args.directory,
+			username=args.user,
+			upload_directory=config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads"),
+			account_id=args.account,
+			mapping=mapping,
+			concurrency=args.concurrency,
+			parse_workers=args.parse_workers,
+			chunk_size=args.batch_size,
+			archive_directory=config("IMPORT_ARCHIVE_DIRECTORY", default="./import-archive"),
+		)
+	except (RuntimeError, ValueError) as e:
+		sys.exit(str(e))
+	_print_summary(summary)
+
+if __name__ == "__main__":
+	main()
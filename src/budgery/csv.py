@@ -1,14 +1,42 @@
-import codecs
+import collections
+import concurrent.futures
 import csv
 import datetime
 import io
+import itertools
 import logging
-from typing import Iterable, List, Mapping, Optional, Tuple
+import mmap
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
 
-from budgery.dataclasses import ImportRow
+from budgery import dates
+from budgery.dataclasses import IMPORT_BATCH_SIZE, ImportBatch, ImportRow
+from budgery.metrics import ImportMetrics
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of characters from the start of the file used to detect the CSV dialect.
+SNIFF_SAMPLE_SIZE = 64 * 1024
+# Files smaller than this are always parsed serially since starting worker
+# processes would cost more than it saves.
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+# Approximate number of bytes of records a worker parses at a time.
+PARALLEL_CHUNK_SIZE = 1024 * 1024
+# Attributes that make up a dialect. Sniffed dialects are dynamically created
+# classes which can't be sent to another process, but these values can.
+_DIALECT_ATTRIBUTES = (
+	"delimiter",
+	"doublequote",
+	"escapechar",
+	"lineterminator",
+	"quotechar",
+	"quoting",
+	"skipinitialspace",
+)
+
+_parse_afcu_date = dates.import_date_parser("%m/%d/%Y")
+
 # Fake type definitions for CSV classes which are implemented in C and
 # the classes are *not* exposed anywhere.
 # class CSVReader(Generic):
@@ -16,7 +44,7 @@ LOGGER = logging.getLogger(__name__)
 def _process_afcu_transaction(data: Mapping[str, str]) -> Optional[ImportRow]:
 	"Process a single line of an America First Credit Union CSV."
 	try:
-		at = datetime.datetime.strptime(data["Date"], "%m/%d/%Y")
+		at = _parse_afcu_date(data["Date"])
 	except ValueError:
 		raise ValueError(f"Failed to parse timestame {data['Date']}")
 	description = data["Description"]
@@ -149,27 +177,232 @@ HEADER_TO_PROCESSOR = {(
 ): _process_afcu_transaction
 }
 
+def _dialect_params(dialect: csv.Dialect) -> Dict[str, Any]:
+	"Get the formatting parameters of a dialect."
+	return {a: getattr(dialect, a) for a in _DIALECT_ATTRIBUTES}
+
+# The dialect every known format is written in.
+KNOWN_FORMAT_DIALECT_PARAMS = _dialect_params(csv.excel)
+# Dialects already worked out, by the first line of the file. Only lines that
+# are the header of a known format are kept so this stays small.
+_DIALECT_CACHE: Dict[str, Dict[str, Any]] = {}
+
 def _processor_from_header(header):
 	"Get the processor based on the header"
-	for header_pattern, p in HEADER_TO_PROCESSOR.items():
-		if header == header_pattern:
-			return p
-	raise Exception(f"No header pattern found that matches {header}")
-
-def extract_rows(content: bytes) -> List[ImportRow]:
-	decoded = codecs.decode(content, "UTF-8")
-	dialect = csv.Sniffer().sniff(decoded)
-	reader = csv.DictReader(io.StringIO(decoded), dialect=dialect)
+	try:
+		return HEADER_TO_PROCESSOR[header]
+	except KeyError:
+		raise Exception(f"No header pattern found that matches {header}")
+
+def _sample_header(sample: str, dialect_params: Mapping[str, Any]) -> Tuple[str, ...]:
+	"Get the field names from the start of a file, empty if there are none."
+	try:
+		return tuple(_read_header(io.StringIO(sample, newline=""), dialect_params))
+	except StopIteration:
+		return ()
+
+def _sniff_dialect(sample: str) -> Dict[str, Any]:
+	"""Get the formatting parameters of a CSV file from the whole lines at its start.
+
+	Files in a known format are recognised by their header, so the sniffer,
+	which is slow, only has to run the first time a file starts with some other
+	line.
+	"""
+	first_line = sample.partition("\n")[0]
+	dialect_params = _DIALECT_CACHE.get(first_line)
+	if dialect_params is not None:
+		return dialect_params
+	if _sample_header(sample, KNOWN_FORMAT_DIALECT_PARAMS) in HEADER_TO_PROCESSOR:
+		dialect_params = KNOWN_FORMAT_DIALECT_PARAMS
+	else:
+		dialect_params = _dialect_params(csv.Sniffer().sniff(sample))
+		if _sample_header(sample, dialect_params) not in HEADER_TO_PROCESSOR:
+			return dialect_params
+	_DIALECT_CACHE[first_line] = dialect_params
+	return dialect_params
+
+def _read_header(lines: Iterator[str], dialect_params: Mapping[str, Any]) -> List[str]:
+	"Read the field names from the first record in lines."
+	header = next(csv.reader(lines, **dialect_params))
 	# Fix bad files where the fields end up with whitespace, like Ally
-	reader.fieldnames = [f.strip() for f in reader.fieldnames]
-	processor = _processor_from_header(tuple(reader.fieldnames))
-	rows = []
+	return [f.strip() for f in header]
+
+def _process_lines(
+		lines: Iterable[str],
+		dialect_params: Mapping[str, Any],
+		fieldnames: Sequence[str],
+		processor: Callable[[Mapping[str, str]], Optional[ImportRow]],
+	) -> Iterator[ImportRow]:
+	"Turn lines of CSV records into import rows."
+	reader = csv.DictReader(lines, fieldnames=fieldnames, **dialect_params)
 	for i, line in enumerate(reader):
 		try:
-			rows.append(processor(line))
+			row = processor(line)
 		except ValueError as x:
 			LOGGER.error("Failed to parse line %d: %s", i, line)
 			raise
-	# Remove empty rows caused by the processor dropping a row
-	rows = [r for r in rows if r]
-	return rows
+		# Skip empty rows caused by the processor dropping a row
+		if row:
+			yield row
+
+def _parse_span(
+		path: str,
+		start: int,
+		end: int,
+		dialect_params: Mapping[str, Any],
+		fieldnames: Sequence[str],
+		processor: Callable[[Mapping[str, str]], Optional[ImportRow]],
+		batch_size: int,
+	) -> List[ImportBatch]:
+	"Parse the whole records between two offsets of a file into batches. This runs in a worker process."
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+		lines = io.StringIO(str(view[start:end], "UTF-8"), newline="")
+	return list(ImportBatch.batched(_process_lines(lines, dialect_params, fieldnames, processor), batch_size))
+
+def _quote_parity(path: str, start: int, end: int, quotechar: bytes) -> int:
+	"Count the quote characters between two offsets of a file, modulo 2. This runs in a worker process."
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+		return view[start:end].count(quotechar) % 2
+
+def _line_chunks(view: mmap.mmap, start: int, chunk_size: int) -> List[Tuple[int, int]]:
+	"""Split view from start into chunks of at least chunk_size bytes that end after a newline.
+
+	Only the bytes from each split point up to the next newline are read.
+	"""
+	chunks = []
+	size = len(view)
+	while start < size:
+		newline = view.find(b"\n", start + chunk_size - 1)
+		end = size if newline < 0 else newline + 1
+		chunks.append((start, end))
+		start = end
+	return chunks
+
+def _record_spans(chunks: Iterable[Tuple[int, int]], parities: Iterable[int]) -> Iterator[Tuple[int, int]]:
+	"""Join consecutive chunks into spans that end between records.
+
+	A newline only ends a record when it is not inside a quoted field, which is
+	the case when it is preceded by an even number of quote characters. parities
+	has the number of quote characters in each chunk modulo 2 and a chunk that
+	ends inside a quoted field is joined with the next one.
+	"""
+	quoted = 0
+	span_start = None
+	for (start, end), parity in zip(chunks, parities):
+		if span_start is None:
+			span_start = start
+		quoted ^= parity
+		if not quoted:
+			yield span_start, end
+			span_start = None
+	if span_start is not None:
+		# The quotes never balance, leave the parser to complain about it.
+		yield span_start, end
+
+def _file_path(f: IO[bytes]) -> Optional[str]:
+	"Get the path of the file on disk f reads from, None if it isn't one."
+	name = getattr(f, "name", None)
+	if isinstance(name, str) and os.path.isfile(name):
+		return name
+	return None
+
+def _file_size(f: IO[bytes]) -> int:
+	"Get the size of a seekable file, leaving it positioned at the start."
+	size = f.seek(0, io.SEEK_END)
+	f.seek(0)
+	return size
+
+def _extract_rows_serial(f: IO[bytes], metrics: ImportMetrics) -> Iterator[ImportRow]:
+	"Extract the rows of a CSV file in this process."
+	text = io.TextIOWrapper(f, encoding="UTF-8", newline="")
+	try:
+		with metrics.stage("sniff"):
+			# Finish the line the sample ends in so the sniffer only sees whole rows.
+			sample = text.read(SNIFF_SAMPLE_SIZE) + text.readline()
+			dialect_params = _sniff_dialect(sample)
+		lines = itertools.chain(io.StringIO(sample, newline=""), text)
+		fieldnames = _read_header(lines, dialect_params)
+		processor = _processor_from_header(tuple(fieldnames))
+		yield from _process_lines(lines, dialect_params, fieldnames, processor)
+	finally:
+		# Don't let the wrapper close the caller's file when it is collected.
+		try:
+			text.detach()
+		except ValueError:
+			# The caller already closed it.
+			pass
+
+def _extract_batches_parallel(
+		f: IO[bytes],
+		workers: int,
+		batch_size: int,
+		metrics: ImportMetrics,
+	) -> Iterator[ImportBatch]:
+	"""Extract the rows of a CSV file on disk using a pool of worker processes.
+
+	The file is memory mapped and the records after the header are split into
+	spans which are parsed in parallel, each into batches of at most batch_size
+	rows. Workers map the file themselves and are only sent offsets, so the
+	records are read straight from the page cache rather than copied between
+	processes. The parent only reads the bytes around each split point: the
+	workers count the quote characters between them first so that a split
+	inside a quoted field can be skipped. Batches are yielded in the same order
+	as the file and only a few spans per worker are in flight at once.
+	"""
+	path = _file_path(f)
+	with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+		sample = view[:SNIFF_SAMPLE_SIZE]
+		header_end = sample.find(b"\n") + 1
+		if not header_end:
+			yield from ImportBatch.batched(_extract_rows_serial(f, metrics), batch_size)
+			return
+		with metrics.stage("sniff"):
+			# Only sniff whole lines so we never split a multi-byte character.
+			sample = sample[:sample.rfind(b"\n") + 1]
+			dialect_params = _sniff_dialect(sample.decode("UTF-8"))
+		header = sample[:header_end].decode("UTF-8")
+		fieldnames = _read_header(iter([header]), dialect_params)
+		processor = _processor_from_header(tuple(fieldnames))
+		quotechar = (dialect_params["quotechar"] or '"').encode("UTF-8")
+		chunks = _line_chunks(view, header_end, PARALLEL_CHUNK_SIZE)
+		# Spawn rather than fork, we may be running alongside other threads.
+		context = multiprocessing.get_context("spawn")
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+			parities = executor.map(
+				_quote_parity,
+				itertools.repeat(path),
+				[start for start, _ in chunks],
+				[end for _, end in chunks],
+				itertools.repeat(quotechar),
+			)
+			pending = collections.deque()
+			for start, end in _record_spans(chunks, parities):
+				pending.append(executor.submit(
+					_parse_span, path, start, end, dialect_params, fieldnames, processor, batch_size))
+				if len(pending) >= workers * 2:
+					yield from pending.popleft().result()
+			while pending:
+				yield from pending.popleft().result()
+
+def extract_batches(
+		f: IO[bytes],
+		workers: int = 1,
+		batch_size: int = IMPORT_BATCH_SIZE,
+		metrics: Optional[ImportMetrics] = None,
+	) -> Iterator[ImportBatch]:
+	"""Lazily extract the rows of a CSV file in batches.
+
+	The file is decoded incrementally as rows are consumed and only a bounded
+	sample from the start of the file is used to detect the dialect. With more
+	than one worker, files of at least PARALLEL_MIN_SIZE are parsed by a pool of
+	that many processes, provided the file is on disk. Detecting the dialect is
+	timed as the "sniff" stage of metrics.
+	"""
+	metrics = metrics or ImportMetrics()
+	if workers > 1 and _file_path(f) and _file_size(f) >= PARALLEL_MIN_SIZE:
+		return _extract_batches_parallel(f, workers, batch_size, metrics)
+	return ImportBatch.batched(_extract_rows_serial(f, metrics), batch_size)
+
+def extract_rows(f: IO[bytes], workers: int = 1) -> Iterator[ImportRow]:
+	"Lazily extract the rows of a CSV file."
+	return ImportBatch.rows(extract_batches(f, workers=workers))
@@ -1,8 +1,18 @@
+import array
 import dataclasses
 import datetime
-from typing import Optional
+import itertools
+import sys
+from typing import Iterable, Iterator, List, Optional
 
-@dataclasses.dataclass
+# Number of rows importers put in each ImportBatch.
+IMPORT_BATCH_SIZE = 1000
+
+# Rows are created for every line of every import, so avoid giving each one a
+# __dict__ where the Python version lets us.
+_ROW_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclasses.dataclass(frozen=True, **_ROW_OPTIONS)
 class ImportRow:
 	"""A single row of an import with the ideal data.
 
@@ -36,4 +46,111 @@ class ImportRow:
 	reference: Optional[str] = None
 	# ZIP code where the transaction occurred
 	zipcode: Optional[str] = None
-	
+
+@dataclasses.dataclass
+class ImportPreview:
+	"What the start of an import file looks like to the importer."
+	# Why the file can't be imported, if it can't.
+	error: Optional[str]
+	# The type of file that was detected.
+	file_type: str
+	# The first rows of the file.
+	rows: List[ImportRow]
+
+@dataclasses.dataclass
+class SpooledUpload:
+	"An uploaded file copied to disk to be imported."
+	path: str
+	# SHA-256 of the content, in hex.
+	sha256: str
+	# Size of the content in bytes.
+	size: int
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+# UTC offset stored for times without a timezone.
+_NO_OFFSET = -2**31
+
+class ImportBatch:
+	"""A batch of import rows stored column by column.
+
+	The direction, amount and time of each row are kept in compact arrays
+	and the text fields in lists, which takes far less memory than an
+	ImportRow per row and pickles quickly between processes. Times are stored
+	as wall clock microseconds since the epoch plus their UTC offset, if any,
+	in seconds.
+	"""
+	TEXT_FIELDS = (
+		"description",
+		"sourcink_from",
+		"sourcink_to",
+		"address",
+		"category",
+		"city",
+		"country",
+		"extended_details",
+		"reference",
+		"zipcode",
+	)
+	__slots__ = ("account_id_is_from", "amount", "at", "utc_offset") + TEXT_FIELDS
+
+	def __init__(self) -> None:
+		self.account_id_is_from = array.array("b")
+		self.amount = array.array("d")
+		self.at = array.array("q")
+		self.utc_offset = array.array("i")
+		for name in self.TEXT_FIELDS:
+			setattr(self, name, [])
+
+	def __len__(self) -> int:
+		return len(self.amount)
+
+	def __iter__(self) -> Iterator[ImportRow]:
+		return (self[i] for i in range(len(self)))
+
+	def __getitem__(self, i: int) -> ImportRow:
+		return ImportRow(
+			account_id_is_from=bool(self.account_id_is_from[i]),
+			amount=self.amount[i],
+			at=self._datetime(self.at[i], self.utc_offset[i]),
+			**{name: getattr(self, name)[i] for name in self.TEXT_FIELDS},
+		)
+
+	def append(self, row: ImportRow) -> None:
+		"Add a row to the end of the batch."
+		self.account_id_is_from.append(row.account_id_is_from)
+		self.amount.append(float(row.amount))
+		offset = row.at.utcoffset()
+		self.at.append((row.at.replace(tzinfo=None) - _EPOCH) // _MICROSECOND)
+		self.utc_offset.append(_NO_OFFSET if offset is None else offset // datetime.timedelta(seconds=1))
+		for name in self.TEXT_FIELDS:
+			getattr(self, name).append(getattr(row, name))
+
+	def datetimes(self) -> Iterator[datetime.datetime]:
+		"Get the time of each row in the batch."
+		return (self._datetime(at, offset) for at, offset in zip(self.at, self.utc_offset))
+
+	@staticmethod
+	def _datetime(at: int, utc_offset: int) -> datetime.datetime:
+		result = _EPOCH + at * _MICROSECOND
+		if utc_offset == _NO_OFFSET:
+			return result
+		return result.replace(tzinfo=datetime.timezone(datetime.timedelta(seconds=utc_offset)))
+
+	@classmethod
+	def batched(cls, rows: Iterable[ImportRow], size: int) -> Iterator["ImportBatch"]:
+		"Pack rows into batches of at most size rows."
+		itr = iter(rows)
+		while True:
+			batch = cls()
+			for row in itertools.islice(itr, size):
+				batch.append(row)
+			if not batch:
+				return
+			yield batch
+
+	@staticmethod
+	def rows(batches: Iterable["ImportBatch"]) -> Iterator[ImportRow]:
+		"Unpack the rows from a sequence of batches."
+		for batch in batches:
+			yield from batch
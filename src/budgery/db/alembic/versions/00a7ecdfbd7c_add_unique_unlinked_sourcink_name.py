@@ -0,0 +1,61 @@
+"""add unique unlinked sourcink name
+
+Revision ID: 00a7ecdfbd7c
+Revises: 1a2ca46fa7a0
+Create Date: 2026-10-18 13:04:16.521615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '00a7ecdfbd7c'
+down_revision = '1a2ca46fa7a0'
+branch_labels = None
+depends_on = None
+
+sourcink = sa.table('sourcink',
+    sa.column('id', sa.Integer),
+    sa.column('account_id', sa.Integer),
+    sa.column('name', sa.String),
+)
+transaction = sa.table('transaction',
+    sa.column('sourcink_id_from', sa.Integer),
+    sa.column('sourcink_id_to', sa.Integer),
+)
+
+
+def upgrade():
+    # Merge sourcinks without an account that share a name into the oldest
+    # one so their names can be made unique. Sourcinks of accounts are never
+    # merged, each account keeps its own.
+    connection = op.get_bind()
+    by_name = {}
+    for id_, name in connection.execute(
+            sa.select(sourcink.c.id, sourcink.c.name)
+            .where(sourcink.c.account_id.is_(None))
+            .order_by(sourcink.c.id)):
+        by_name.setdefault(name, []).append(id_)
+    for ids in by_name.values():
+        if len(ids) < 2:
+            continue
+        keep, merged = ids[0], ids[1:]
+        connection.execute(transaction.update().where(
+            transaction.c.sourcink_id_from.in_(merged)).values(sourcink_id_from=keep))
+        connection.execute(transaction.update().where(
+            transaction.c.sourcink_id_to.in_(merged)).values(sourcink_id_to=keep))
+        connection.execute(sourcink.delete().where(sourcink.c.id.in_(merged)))
+
+    op.create_index(
+        'ix_sourcink_name_unlinked',
+        'sourcink',
+        ['name'],
+        unique=True,
+        postgresql_where=sa.text('account_id IS NULL'),
+        sqlite_where=sa.text('account_id IS NULL'),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_sourcink_name_unlinked', table_name='sourcink')
@@ -0,0 +1,115 @@
+"""add transaction fingerprint
+
+Revision ID: 4971e40d7002
+Revises: f7783b94fc14
+Create Date: 2026-10-18 13:21:07.418522
+
+"""
+import collections
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4971e40d7002'
+down_revision = 'f7783b94fc14'
+branch_labels = None
+depends_on = None
+
+import_job = sa.table('import_job',
+    sa.column('id', sa.Integer),
+    sa.column('account_id', sa.Integer),
+)
+transaction = sa.table('transaction',
+    sa.column('id', sa.Integer),
+    sa.column('account_id_from', sa.Integer),
+    sa.column('amount', sa.Float),
+    sa.column('at', sa.DateTime),
+    sa.column('description', sa.String),
+    sa.column('fingerprint', sa.String),
+    sa.column('import_job_id', sa.Integer),
+)
+
+
+def _fingerprint(account_id, account_id_is_from, amount, at, description, occurrence):
+    # A frozen copy of budgery.util.transaction_fingerprint as of this revision.
+    normalized = " ".join((description or "").split()).casefold()
+    description_hash = hashlib.sha256(normalized.encode("UTF-8")).hexdigest()
+    key = "|".join((
+        str(account_id),
+        "from" if account_id_is_from else "to",
+        f"{amount:.2f}",
+        at.replace(tzinfo=None).isoformat(),
+        description_hash,
+        str(occurrence),
+    ))
+    return hashlib.sha256(key.encode("UTF-8")).hexdigest()
+
+
+def _backfill_fingerprints():
+    "Fingerprint the transactions that were already imported."
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(
+        transaction.c.id,
+        transaction.c.account_id_from,
+        transaction.c.amount,
+        transaction.c.at,
+        transaction.c.description,
+        transaction.c.import_job_id,
+        import_job.c.account_id,
+    ).join(
+        import_job, import_job.c.id == transaction.c.import_job_id,
+    ).order_by(transaction.c.import_job_id, transaction.c.id))
+    occurrences = collections.Counter()
+    seen = set()
+    updates = []
+    for row in rows:
+        if row.amount is None or row.at is None:
+            continue
+        is_from = row.account_id_from == row.account_id
+        first = _fingerprint(row.account_id, is_from, row.amount, row.at, row.description, 0)
+        key = (row.import_job_id, first)
+        occurrence = occurrences[key]
+        occurrences[key] += 1
+        if occurrence:
+            fingerprint = _fingerprint(row.account_id, is_from, row.amount, row.at, row.description, occurrence)
+        else:
+            fingerprint = first
+        # Overlapping imports before this revision already created duplicates,
+        # only the first of them can have the fingerprint.
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        updates.append({"row_id": row.id, "fingerprint": fingerprint})
+    if updates:
+        connection.execute(
+            transaction.update()
+                .where(transaction.c.id == sa.bindparam("row_id"))
+                .values(fingerprint=sa.bindparam("fingerprint")),
+            updates,
+        )
+
+
+def upgrade():
+    with op.batch_alter_table('import_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('skipped_count', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('fingerprint', sa.String(), nullable=True))
+
+    _backfill_fingerprints()
+    op.execute("UPDATE import_job SET skipped_count = 0")
+
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_transaction_fingerprint'), ['fingerprint'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_transaction_fingerprint'))
+        batch_op.drop_column('fingerprint')
+
+    with op.batch_alter_table('import_job', schema=None) as batch_op:
+        batch_op.drop_column('skipped_count')
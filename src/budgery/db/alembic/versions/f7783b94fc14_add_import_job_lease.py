@@ -0,0 +1,51 @@
+"""add import_job lease
+
+Revision ID: f7783b94fc14
+Revises: 8c3c344d21cc
+Create Date: 2026-10-18 12:47:40.278325
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7783b94fc14'
+down_revision = '8c3c344d21cc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('import_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('lease_expires', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('lease_owner', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('upload_path', sa.String(), nullable=True))
+        batch_op.alter_column('error',
+               existing_type=sa.Enum('NONE', 'FAILED_PARSING_FILE', name='importjoberror'),
+               type_=sa.Enum('NONE', 'FAILED_PARSING_FILE', 'TOO_MANY_ATTEMPTS', name='importjoberror'),
+               existing_nullable=True)
+        batch_op.alter_column('status',
+               existing_type=sa.Enum('error', 'started', 'finished', name='importjobstatus'),
+               type_=sa.Enum('error', 'started', 'finished', 'queued', name='importjobstatus'),
+               existing_nullable=True)
+        batch_op.create_index(batch_op.f('ix_import_job_status'), ['status'], unique=False)
+    op.execute("UPDATE import_job SET attempts = 0")
+
+
+def downgrade():
+    with op.batch_alter_table('import_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_import_job_status'))
+        batch_op.alter_column('status',
+               existing_type=sa.Enum('error', 'started', 'finished', 'queued', name='importjobstatus'),
+               type_=sa.Enum('error', 'started', 'finished', name='importjobstatus'),
+               existing_nullable=True)
+        batch_op.alter_column('error',
+               existing_type=sa.Enum('NONE', 'FAILED_PARSING_FILE', 'TOO_MANY_ATTEMPTS', name='importjoberror'),
+               type_=sa.Enum('NONE', 'FAILED_PARSING_FILE', name='importjoberror'),
+               existing_nullable=True)
+        batch_op.drop_column('upload_path')
+        batch_op.drop_column('lease_owner')
+        batch_op.drop_column('lease_expires')
+        batch_op.drop_column('attempts')
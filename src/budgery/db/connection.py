@@ -1,22 +1,131 @@
+import functools
 import logging
-from sqlalchemy import create_engine
+from typing import Any, Callable, Mapping
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url, URL
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from starlette.config import Config
 
 from budgery.db.history_meta import versioned_session
 
 LOGGER = logging.getLogger(__name__)
 
-def connect(config: Config):
-	url = config("SQL_ALCHEMY_DATABASE_URL", default="sqlite:///./budgery.db")
-	LOGGER.info("Connecting to DB at %s", url)
-	return create_engine(
+# Pragmas set on every SQLite connection, each overridden by the config value
+# SQLITE_<NAME>. WAL lets pages be read while an import writes, and with it
+# NORMAL only syncs at checkpoints. cache_size is in KiB when negative.
+SQLITE_PRAGMAS = {
+	"journal_mode": "WAL",
+	"synchronous": "NORMAL",
+	"cache_size": "-65536",
+	"mmap_size": "268435456",
+	"temp_store": "MEMORY",
+}
+
+# The driver used for each kind of database by connect_async.
+ASYNC_DRIVERS = {
+	"postgresql": "asyncpg",
+	"sqlite": "aiosqlite",
+}
+
+def connect(config: Config) -> Engine:
+	"""Create an engine for the database at SQL_ALCHEMY_DATABASE_URL.
+
+	Its pool keeps DB_POOL_SIZE connections, by default enough for the web
+	server plus two for each of IMPORT_CONCURRENCY imports, and opens up to
+	DB_MAX_OVERFLOW more when they are all busy. A connection waiting on
+	another's lock gives up after DB_BUSY_TIMEOUT seconds.
+	"""
+	url = make_url(config("SQL_ALCHEMY_DATABASE_URL", default="sqlite:///./budgery.db"))
+	return _connect(config, url, create_engine)
+
+def connect_async(config: Config) -> AsyncEngine:
+	"""Create an engine like connect does with the asyncio driver for the database.
+
+	Dispose of it before its event loop closes. aiosqlite runs each connection
+	on its own thread, and the threads of pooled connections keep the process
+	alive.
+	"""
+	url = make_url(config("SQL_ALCHEMY_DATABASE_URL", default="sqlite:///./budgery.db"))
+	url = url.set(drivername=f"{url.get_backend_name()}+{ASYNC_DRIVERS[url.get_backend_name()]}")
+	return _connect(config, url, create_async_engine)
+
+def _connect(config: Config, url: URL, make_engine: Callable[..., Any]) -> Any:
+	LOGGER.info("Connecting to DB at %s", url.render_as_string(hide_password=True))
+	busy_timeout_ms = int(config("DB_BUSY_TIMEOUT", cast=float, default=30) * 1000)
+	pool = {
+		"max_overflow": config("DB_MAX_OVERFLOW", cast=int, default=10),
+		"pool_size": config("DB_POOL_SIZE", cast=int, default=5 + 2 * config("IMPORT_CONCURRENCY", cast=int, default=2)),
+	}
+	if url.get_backend_name() == "sqlite":
+		return _connect_sqlite(config, url, make_engine, busy_timeout_ms, pool)
+	connect_args = {}
+	if url.get_driver_name() == "asyncpg":
+		connect_args["server_settings"] = {"lock_timeout": str(busy_timeout_ms)}
+	elif url.get_backend_name() == "postgresql":
+		connect_args["options"] = f"-c lock_timeout={busy_timeout_ms}"
+	return make_engine(
+		url,
+		connect_args=connect_args,
+		pool_pre_ping=True,
+		pool_recycle=config("DB_POOL_RECYCLE", cast=int, default=1800),
+		**pool,
+	)
+
+def _connect_sqlite(
+		config: Config,
+		url: URL,
+		make_engine: Callable[..., Any],
+		busy_timeout_ms: int,
+		pool: Mapping[str, Any],
+	) -> Any:
+	"Create an engine for a SQLite database that sets SQLITE_PRAGMAS on each connection."
+	pragmas = {name: config(f"SQLITE_{name.upper()}", default=value) for name, value in SQLITE_PRAGMAS.items()}
+	pragmas["busy_timeout"] = busy_timeout_ms
+	if url.database in (None, "", ":memory:"):
+		# Each in-memory database belongs to a single connection, so there is no
+		# pool to size and nothing to share with a journal.
+		pool = {}
+		del pragmas["journal_mode"]
+	elif make_engine is create_async_engine:
+		# aiosqlite would otherwise open a new connection for every session,
+		# setting every pragma again and starting with an empty page cache.
+		pool = dict(pool, poolclass=AsyncAdaptedQueuePool)
+	engine = make_engine(
 		url,
 		connect_args={"check_same_thread": False},
+		**pool,
 	)
+	# Async engines run their connection events on the sync engine inside them.
+	event.listen(getattr(engine, "sync_engine", engine), "connect", functools.partial(_set_pragmas, pragmas))
+	return engine
+
+def _set_pragmas(pragmas: Mapping[str, Any], dbapi_connection, connection_record) -> None:
+	cursor = dbapi_connection.cursor()
+	try:
+		for name, value in pragmas.items():
+			cursor.execute(f"PRAGMA {name}={value}")
+	finally:
+		cursor.close()
+
+# Builds the sessions for every engine. Making the factory and registering its
+# versioning listener happens once here rather than for every session.
+SESSION_FACTORY = sessionmaker(autocommit=False, autoflush=False)
+versioned_session(SESSION_FACTORY)
+
+# The same for asyncio sessions. They share the versioned sync session class
+# so changes made through either are recorded in history.
+ASYNC_SESSION_FACTORY = async_sessionmaker(
+	autoflush=False,
+	expire_on_commit=False,
+	sync_session_class=SESSION_FACTORY.class_,
+)
 
 def session(engine):
-	maker = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-	versioned_session(maker)
-	return maker()
+	return SESSION_FACTORY(bind=engine)
+
+def async_session(engine: AsyncEngine) -> AsyncSession:
+	return ASYNC_SESSION_FACTORY(bind=engine)
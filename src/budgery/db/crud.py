@@ -1,18 +1,118 @@
+import contextlib
 import dataclasses
 import datetime
+import itertools
 import logging
-from typing import Iterable, Optional, Set
+import threading
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
 
-from sqlalchemy import func, update
+from sqlalchemy import and_, delete, func, insert, or_, select, tuple_, update, Select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.interfaces import ORMOption
 
 from budgery.db import models
 from budgery.db import schemas
+from budgery.metrics import ImportMetrics, Stage
 from budgery.user import User
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of transactions to insert per database transaction when bulk creating.
+TRANSACTION_BULK_CHUNK_SIZE = 1000
+
+# Number of transactions shown on each page of a transaction list.
+TRANSACTION_PAGE_SIZE = 100
+
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+	"Split items into lists of at most size items."
+	itr = iter(items)
+	while True:
+		chunk = list(itertools.islice(itr, size))
+		if not chunk:
+			return
+		yield chunk
+
+def _insert_ignoring_conflicts(db: Session, model: type):
+	"Build an INSERT for model that skips rows which would break a unique constraint."
+	if db.get_bind().dialect.name == "postgresql":
+		return postgresql.insert(model).on_conflict_do_nothing()
+	return sqlite.insert(model).on_conflict_do_nothing()
+
+class SourcinkResolver:
+	"""Resolves sourcink names to IDs, creating any that don't exist yet.
+
+	Only sourcinks without an account are resolved, their names are unique.
+	The IDs are cached for the whole process and shared between imports and
+	requests. Other processes may create sourcinks at any time, so a name that
+	isn't cached is always looked up before it is created. Call invalidate if
+	sourcinks are ever renamed or removed.
+	"""
+	def __init__(self) -> None:
+		self._ids: Dict[str, int] = {}
+		self._lock = threading.Lock()
+
+	def invalidate(self) -> None:
+		"Forget every cached sourcink."
+		with self._lock:
+			self._ids = {}
+
+	def preload(self, db: Session) -> None:
+		"Replace the cache with every sourcink without an account in the database."
+		ids = {name: id_ for id_, name in db.execute(
+			select(models.Sourcink.id, models.Sourcink.name).where(models.Sourcink.account_id.is_(None)),
+		)}
+		with self._lock:
+			self._ids = ids
+
+	def resolve(self, db: Session, names: Iterable[str], create: bool = True) -> Dict[str, int]:
+		"""Get the IDs of the sourcinks with the given names.
+
+		Names that aren't cached take one query to look up and the sourcinks that
+		don't exist are created with a single INSERT. Without create they are
+		left out instead and nothing is written.
+		"""
+		names = set(names)
+		with self._lock:
+			found = {name: self._ids[name] for name in names if name in self._ids}
+		missing = names - found.keys()
+		if not missing:
+			return found
+		new_names = missing - self._lookup(db, missing, found)
+		if new_names and create:
+			db.execute(
+				_insert_ignoring_conflicts(db, models.Sourcink),
+				[{"account_id": None, "name": name} for name in sorted(new_names)],
+			)
+			db.commit()
+			# Another process may have created some of them first.
+			self._lookup(db, new_names, found)
+		return found
+
+	def _lookup(self, db: Session, names: Set[str], found: Dict[str, int]) -> Set[str]:
+		"Add the IDs of the sourcinks with names to found and the cache. Returns the names found."
+		ids = {name: id_ for id_, name in db.execute(
+			select(models.Sourcink.id, models.Sourcink.name).where(
+				models.Sourcink.account_id.is_(None),
+				models.Sourcink.name.in_(names),
+			),
+		)}
+		with self._lock:
+			self._ids.update(ids)
+		found.update(ids)
+		return set(ids)
+
+# Shared by everything in the process that resolves sourcinks by name.
+SOURCINK_RESOLVER = SourcinkResolver()
+
+@dataclasses.dataclass
+class BulkCreateResult:
+	created: int
+	skipped: int
+
 @dataclasses.dataclass
 class DatetimeRange:
 	end: Optional[datetime.datetime]
@@ -23,6 +123,37 @@ class Category:
 	name: str
 	transaction_count: int
 
+@dataclasses.dataclass(frozen=True)
+class TransactionCursor:
+	"""A position in a list of transactions ordered newest first.
+
+	Lists are ordered by (at, id) so that transactions at the same time still
+	have a fixed order, and a page starts from here with an index seek however
+	far into the list it is.
+	"""
+	at: datetime.datetime
+	id: int
+
+	@classmethod
+	def of(cls, transaction: models.Transaction) -> "TransactionCursor":
+		return cls(at=transaction.at, id=transaction.id)
+
+	@classmethod
+	def decode(cls, text: str) -> "TransactionCursor":
+		"Read a cursor made by encode. Raises ValueError if it isn't one."
+		at, _, transaction_id = text.rpartition("_")
+		return cls(at=datetime.datetime.fromisoformat(at), id=int(transaction_id))
+
+	def encode(self) -> str:
+		return f"{self.at.isoformat()}_{self.id}"
+
+@dataclasses.dataclass
+class TransactionPage:
+	"One page of a transaction list with the cursors of the pages either side, if there are any."
+	transactions: List[models.Transaction]
+	next_cursor: Optional[str]
+	previous_cursor: Optional[str]
+
 def account_create(db: Session, institution_id: int, name: str, user: models.User) -> models.Account:
 	account = models.Account(
 		institution_id = institution_id,
@@ -123,39 +254,159 @@ def budget_entry_update(
 	entry.name = name
 	db.commit()
 
+def _budget_get_by_id_query(budget_id: int) -> Select:
+	return select(models.Budget).where(models.Budget.id == budget_id).limit(1)
+
 def budget_get_by_id(db: Session, budget_id: int) -> models.Budget:
-	return db.query(models.Budget).filter_by(id=budget_id).first()
+	return db.scalars(_budget_get_by_id_query(budget_id)).first()
+
+async def budget_get_by_id_async(db: AsyncSession, budget_id: int) -> models.Budget:
+	return (await db.scalars(_budget_get_by_id_query(budget_id))).first()
 
 def budget_history_list_by_budget_id(db: Session, budget_id: int) -> Iterable[models.BudgetHistory]:
 	return db.query(models.BudgetHistory).where(models.BudgetHistory.id == budget_id).all()
 
-def category_list(db: Session, user: models.User) -> Iterable[Category]:
-	rows = db.query(
+def _category_list_query() -> Select:
+	return select(
 		models.Transaction.category,
 		func.count(),
 	).group_by(models.Transaction.category)
+
+def category_list(db: Session, user: models.User) -> Iterable[Category]:
+	rows = db.execute(_category_list_query())
+	return [Category(row[0], row[1]) for row in rows]
+
+async def category_list_async(db: AsyncSession, user: models.User) -> Iterable[Category]:
+	rows = await db.execute(_category_list_query())
 	return [Category(row[0], row[1]) for row in rows]
 		
 
 def create_tables(db: Session):
 	models.Base.metadata.create_all(bind=db)
 
-def import_job_create(account_id: int, db: Session, filename: str, user: models.User) -> models.ImportJob:
+def import_job_archive(db: Session, import_job_id: int, archive_path: str) -> None:
+	"Record that the upload of an import job was moved to archive_path."
+	db.execute(update(models.ImportJob).where(
+		models.ImportJob.id == import_job_id,
+	).values(
+		archive_path=archive_path,
+		upload_path=None,
+	))
+	db.commit()
+
+def import_job_claim(
+		db: Session,
+		lease_duration: datetime.timedelta,
+		max_attempts: int,
+		worker_id: str,
+	) -> Optional[models.ImportJob]:
+	"""Claim the oldest import job that is ready to run.
+
+	A job is ready when it is queued or when the worker that started it let its
+	lease expire. Jobs that have already been attempted max_attempts times are
+	failed instead of claimed. Returns None if there is nothing to claim.
+	"""
+	now = datetime.datetime.now()
+	claimable = or_(
+		models.ImportJob.status == models.ImportJobStatus.queued,
+		and_(
+			models.ImportJob.status == models.ImportJobStatus.started,
+			models.ImportJob.lease_expires < now,
+		),
+	)
+	db.execute(update(models.ImportJob).where(
+		claimable,
+		models.ImportJob.attempts >= max_attempts,
+	).values(
+		error=models.ImportJobError.TOO_MANY_ATTEMPTS,
+		lease_expires=None,
+		lease_owner=None,
+		status=models.ImportJobStatus.error,
+	))
+	db.commit()
+	while True:
+		job_id = db.scalar(select(models.ImportJob.id)
+			.where(claimable)
+			.order_by(models.ImportJob.created)
+			.limit(1))
+		if job_id is None:
+			return None
+		# Only one worker's update can match when several race for the same job.
+		result = db.execute(update(models.ImportJob).where(
+			models.ImportJob.id == job_id,
+			claimable,
+		).values(
+			attempts=models.ImportJob.attempts + 1,
+			lease_expires=now + lease_duration,
+			lease_owner=worker_id,
+			status=models.ImportJobStatus.started,
+		))
+		db.commit()
+		if result.rowcount == 1:
+			return db.get(models.ImportJob, job_id)
+
+def import_job_count_queued(db: Session, user: Optional[models.User] = None) -> int:
+	"Get how many import jobs are waiting to be run, only counting those of user if given."
+	query = select(func.count()).select_from(models.ImportJob).where(
+		models.ImportJob.status == models.ImportJobStatus.queued,
+	)
+	if user is not None:
+		query = query.where(models.ImportJob.user_id == user.id)
+	return db.scalar(query)
+
+def import_job_list_upload_paths(db: Session) -> Set[str]:
+	"Get the paths of the uploaded files import jobs still refer to."
+	return set(db.scalars(select(models.ImportJob.upload_path).where(
+		models.ImportJob.upload_path != None,
+	)))
+
+def import_job_create(
+		account_id: int,
+		db: Session,
+		filename: str,
+		user: models.User,
+		upload_path: Optional[str] = None,
+		content_sha256: Optional[str] = None,
+		content_size: Optional[int] = None,
+	) -> models.ImportJob:
 	job = models.ImportJob(
 		account_id = account_id,
+		content_sha256 = content_sha256,
+		content_size = content_size,
 		filename = filename,
-		status = models.ImportJobStatus.started,
+		status = models.ImportJobStatus.queued,
+		upload_path = upload_path,
 		user = user,
 	)
 	db.add(job)
 	db.commit()
 	return job
 
+def import_job_get_by_content(
+		db: Session,
+		account_id: int,
+		content_sha256: str,
+		content_size: int,
+	) -> Optional[models.ImportJob]:
+	"Get the latest job that imported, or will import, the same file into an account."
+	return db.scalars(select(models.ImportJob).where(
+		models.ImportJob.account_id == account_id,
+		models.ImportJob.content_sha256 == content_sha256,
+		models.ImportJob.content_size == content_size,
+		models.ImportJob.status != models.ImportJobStatus.error,
+	).order_by(models.ImportJob.id.desc()).limit(1)).first()
+
 def import_job_error(db: Session, import_job: models.ImportJob, error: models.ImportJobError) -> None:
 	import_job.error = error
+	import_job.lease_expires = None
+	import_job.lease_owner = None
+	import_job.status = models.ImportJobStatus.error
 	db.commit()
 
-def import_job_finish(db: Session, import_job: models.ImportJob) -> None:
+def import_job_finish(db: Session, import_job: models.ImportJob, skipped_count: int = 0) -> None:
+	import_job.lease_expires = None
+	import_job.skipped_count = skipped_count
+	import_job.lease_owner = None
 	import_job.status = models.ImportJobStatus.finished
 	db.commit()
 
@@ -165,12 +416,78 @@ def import_job_get_by_id(
 		import_job_id: int) -> models.ImportJob:
 	return db.query(models.ImportJob).filter_by(id=import_job_id).first()
 
+def import_job_list_archived(
+		db: Session,
+		account_id: Optional[int] = None,
+	) -> List[models.ImportJob]:
+	"Get the finished import jobs whose uploaded file was archived, optionally only those for account_id."
+	query = select(models.ImportJob).where(
+		models.ImportJob.archive_path != None,
+		models.ImportJob.status == models.ImportJobStatus.finished,
+	).order_by(models.ImportJob.id)
+	if account_id is not None:
+		query = query.where(models.ImportJob.account_id == account_id)
+	return list(db.scalars(query))
+
 def import_job_list(
 		db: Session,
 		user: models.User,
 		name: str = "") -> Iterable[models.ImportJob]:
 	return db.query(models.ImportJob).order_by(models.ImportJob.created).all()
 
+def import_job_queue_position(db: Session, import_job: models.ImportJob) -> int:
+	"Get how many queued import jobs will be run before import_job, plus one."
+	return db.scalar(select(func.count()).select_from(models.ImportJob).where(
+		models.ImportJob.status == models.ImportJobStatus.queued,
+		models.ImportJob.created < import_job.created,
+	)) + 1
+
+def import_job_record_metrics(
+		db: Session,
+		import_job: models.ImportJob,
+		stages: Iterable[Stage],
+		row_count: Optional[int],
+		date_cache_hit_rate: Optional[float],
+	) -> None:
+	"Save how an import job went, replacing what was saved for any earlier attempt."
+	import_job.stages = [
+		models.ImportJobStage(
+			name=stage.name,
+			position=position,
+			rows=stage.rows,
+			seconds=stage.seconds,
+		) for position, stage in enumerate(stages)
+	]
+	import_job.date_cache_hit_rate = date_cache_hit_rate
+	import_job.row_count = row_count
+	db.commit()
+
+def import_job_retry(db: Session, import_job: models.ImportJob) -> None:
+	"Queue a failed import job to run again from the start of its uploaded file."
+	transaction_delete_by_import_job(db, import_job.id)
+	import_job.attempts = 0
+	import_job.error = models.ImportJobError.NONE
+	import_job.skipped_count = 0
+	import_job.status = models.ImportJobStatus.queued
+	db.commit()
+
+def import_job_renew_lease(
+		db: Session,
+		import_job_id: int,
+		lease_duration: datetime.timedelta,
+		worker_id: str,
+	) -> bool:
+	"Extend a worker's lease on an import job. Returns False if the worker no longer holds it."
+	result = db.execute(update(models.ImportJob).where(
+		models.ImportJob.id == import_job_id,
+		models.ImportJob.lease_owner == worker_id,
+		models.ImportJob.status == models.ImportJobStatus.started,
+	).values(
+		lease_expires=datetime.datetime.now() + lease_duration,
+	))
+	db.commit()
+	return result.rowcount == 1
+
 def institution_get_by_name(db: Session, name: str) -> models.Institution:
 	return db.query(models.Institution).filter_by(name=name).first()
 
@@ -206,15 +523,11 @@ def sourcink_get_or_create(
 		db: Session,
 		name: str,
 	) -> models.Sourcink:
-	found = db.query(models.Sourcink).filter_by(name=name).first()
-	if found:
-		return found
-	sourcink = models.Sourcink(
-		account=None,
-		name=name,
-	)
-	db.add(sourcink)
-	db.commit()
+	sourcink = db.get(models.Sourcink, SOURCINK_RESOLVER.resolve(db, [name])[name])
+	if sourcink is None or sourcink.name != name:
+		# The cache is out of date with the database.
+		SOURCINK_RESOLVER.invalidate()
+		sourcink = db.get(models.Sourcink, SOURCINK_RESOLVER.resolve(db, [name])[name])
 	return sourcink
 
 def transaction_create(
@@ -244,14 +557,131 @@ def transaction_create(
 	db.commit()
 	return transaction
 
+def transaction_bulk_create(
+		db: Session,
+		transactions: Iterable[Mapping[str, Any]],
+		import_job: Optional[models.ImportJob],
+		chunk_size: int = TRANSACTION_BULK_CHUNK_SIZE,
+		metrics: Optional[ImportMetrics] = None,
+		write_lock: ContextManager = contextlib.nullcontext(),
+	) -> BulkCreateResult:
+	"""Create many transactions at once.
+
+	Each item in transactions maps Transaction column names to values. The rows
+	are inserted in chunks of chunk_size with a single commit per chunk rather
+	than one per transaction. Transactions with a fingerprint that is already
+	in the database are skipped, which takes one lookup per chunk. The lookups
+	and inserts are timed as the "dedup" and "insert" stages of metrics. Each
+	chunk is written while holding write_lock, rows are produced without it.
+	"""
+	metrics = metrics or ImportMetrics()
+	import_job_id = import_job.id if import_job else None
+	result = BulkCreateResult(created=0, skipped=0)
+	for chunk in _chunked(transactions, chunk_size):
+		values = [dict(t, import_job_id=import_job_id) for t in chunk]
+		with write_lock:
+			new_values = _insert_new_transactions(db, values, metrics)
+		result.created += len(new_values)
+		result.skipped += len(values) - len(new_values)
+	return result
+
+def _insert_new_transactions(
+		db: Session,
+		values: List[Mapping[str, Any]],
+		metrics: ImportMetrics,
+	) -> List[Mapping[str, Any]]:
+	"Insert the transactions that aren't in the database yet and commit. Returns those inserted."
+	# Another import may insert the same fingerprints between our lookup and
+	# insert, in which case look again.
+	for attempt in itertools.count(1):
+		with metrics.stage("dedup") as stage:
+			new_values = _without_existing_fingerprints(db, values)
+			stage.rows += len(values)
+		try:
+			with metrics.stage("insert") as stage:
+				if new_values:
+					db.execute(insert(models.Transaction), new_values)
+				db.commit()
+				stage.rows += len(new_values)
+			return new_values
+		except IntegrityError:
+			db.rollback()
+			if attempt >= 3:
+				raise
+
+def _without_existing_fingerprints(db: Session, values: List[Mapping[str, Any]]) -> List[Mapping[str, Any]]:
+	"""Remove the transactions whose fingerprint is already in the database or earlier in values.
+
+	A provider may give the same reference to more than one row of a file.
+	"""
+	existing = transaction_existing_fingerprints(db, [v.get("fingerprint") for v in values])
+	new_values = []
+	for value in values:
+		fingerprint = value.get("fingerprint")
+		if fingerprint in existing:
+			continue
+		if fingerprint:
+			existing.add(fingerprint)
+		new_values.append(value)
+	return new_values
+
+def transaction_existing_fingerprints(
+		db: Session,
+		fingerprints: Iterable[Optional[str]],
+		exclude_import_job_id: Optional[int] = None,
+	) -> Set[str]:
+	"Get which of fingerprints are already in the database, ignoring those created by exclude_import_job_id."
+	existing = set()
+	for chunk in _chunked((f for f in fingerprints if f), TRANSACTION_BULK_CHUNK_SIZE):
+		query = select(models.Transaction.fingerprint).where(
+			models.Transaction.fingerprint.in_(chunk),
+		)
+		if exclude_import_job_id is not None:
+			query = query.where(or_(
+				models.Transaction.import_job_id != exclude_import_job_id,
+				models.Transaction.import_job_id == None,
+			))
+		existing.update(db.scalars(query))
+	return existing
+
+def transaction_apply_corrections(
+		db: Session,
+		import_job_id: int,
+		updates: List[Mapping[str, Any]],
+		inserts: List[Mapping[str, Any]],
+		delete_ids: List[int],
+	) -> None:
+	"""Correct the transactions created by an import job in a single commit.
+
+	Each item in updates maps Transaction column names to values and includes
+	the id of the row to change. Each item in inserts is a new row for the job.
+	"""
+	for chunk in _chunked(delete_ids, TRANSACTION_BULK_CHUNK_SIZE):
+		db.execute(delete(models.Transaction).where(
+			models.Transaction.id.in_(chunk),
+			models.Transaction.import_job_id == import_job_id,
+		))
+	if updates:
+		db.execute(update(models.Transaction), updates)
+	if inserts:
+		db.execute(insert(models.Transaction), [dict(v, import_job_id=import_job_id) for v in inserts])
+	db.commit()
+
+def transaction_delete_by_import_job(db: Session, import_job_id: int) -> int:
+	"Delete all the transactions created by an import job. Returns the number deleted."
+	result = db.execute(delete(models.Transaction).where(
+		models.Transaction.import_job_id == import_job_id,
+	))
+	db.commit()
+	return result.rowcount
+
 def transaction_get_by_id(db: Session, transaction_id: int) -> models.Transaction:
 	return db.query(models.Transaction).filter_by(id=transaction_id).first()
 
 def transaction_get_categories(
 		db: Session,
 		) -> Set[str]:
-	query = (db.query(models.Transaction).distinct(models.Transaction.category))
-	return {t.category for t in query.all()}
+	return set(db.scalars(select(models.Transaction.category).distinct()))
 
 def transaction_get_one(
 		db: Session,
@@ -266,24 +696,96 @@ def transaction_get_one(
 	return query.first()
 
 
-def transaction_list(db: Session,
-		category: Optional[str] = None,
-		at: Optional[DatetimeRange] = None,
-		limit: Optional[int] = None,
-	):
-	query = db.query(models.Transaction).order_by(models.Transaction.at.desc())
+def _transaction_list_query(
+		category: Optional[str],
+		at: Optional[DatetimeRange],
+		limit: Optional[int],
+		after: Optional[TransactionCursor] = None,
+		before: Optional[TransactionCursor] = None,
+	) -> Select:
+	query = _transaction_keyset(select(models.Transaction), limit, after, before)
 	if category == "None":
-		query = query.filter_by(category=None)
+		query = query.where(models.Transaction.category == None)
 	elif category:
-		query = query.filter_by(category=category)
+		query = query.where(models.Transaction.category == category)
 	if at:
 		if at.end:
-			query = query.filter(models.Transaction.at <= at.end)
+			query = query.where(models.Transaction.at <= at.end)
 		if at.start:
-			query = query.filter(models.Transaction.at >= at.start)
+			query = query.where(models.Transaction.at >= at.start)
+	return query
+
+def _transaction_keyset(
+		query: Select,
+		limit: Optional[int],
+		after: Optional[TransactionCursor],
+		before: Optional[TransactionCursor],
+	) -> Select:
+	"""Order query newest first, starting after or before a cursor.
+
+	A page before a cursor is read oldest first from the cursor so that limit
+	takes the rows nearest it; _newest_first puts them back in order.
+	"""
+	key = tuple_(models.Transaction.at, models.Transaction.id)
+	if before:
+		query = query.where(key > tuple_(before.at, before.id)).order_by(
+			models.Transaction.at, models.Transaction.id)
+	else:
+		if after:
+			query = query.where(key < tuple_(after.at, after.id))
+		query = query.order_by(models.Transaction.at.desc(), models.Transaction.id.desc())
 	if limit:
 		query = query.limit(limit)
-	return query.all()
+	return query
+
+def _newest_first(transactions: List[models.Transaction], before: Optional[TransactionCursor]) -> List[models.Transaction]:
+	return transactions[::-1] if before else list(transactions)
+
+def transaction_list(db: Session,
+		category: Optional[str] = None,
+		at: Optional[DatetimeRange] = None,
+		limit: Optional[int] = None,
+		after: Optional[TransactionCursor] = None,
+		before: Optional[TransactionCursor] = None,
+	):
+	"Get transactions newest first, only those older than after or newer than before if given."
+	return _newest_first(db.scalars(_transaction_list_query(category, at, limit, after, before)).all(), before)
+
+async def transaction_list_async(db: AsyncSession,
+		category: Optional[str] = None,
+		at: Optional[DatetimeRange] = None,
+		limit: Optional[int] = None,
+		after: Optional[TransactionCursor] = None,
+		before: Optional[TransactionCursor] = None,
+	):
+	return _newest_first((await db.scalars(_transaction_list_query(category, at, limit, after, before))).all(), before)
+
+def transaction_page(
+		transactions: List[models.Transaction],
+		page_size: int,
+		after: Optional[TransactionCursor] = None,
+		before: Optional[TransactionCursor] = None,
+	) -> TransactionPage:
+	"""Make a page from transactions listed with a limit of page_size + 1.
+
+	The extra transaction, if there is one, is only there to show that there
+	is another page beyond this one. The cursor a page was asked for shows
+	there is one on the other side.
+	"""
+	more = len(transactions) > page_size
+	if before:
+		transactions = transactions[len(transactions) - page_size:] if more else transactions
+		newer, older = more, True
+	else:
+		transactions = transactions[:page_size]
+		newer, older = after is not None, more
+	if not transactions:
+		return TransactionPage(transactions=[], next_cursor=None, previous_cursor=None)
+	return TransactionPage(
+		transactions=transactions,
+		next_cursor=TransactionCursor.of(transactions[-1]).encode() if older else None,
+		previous_cursor=TransactionCursor.of(transactions[0]).encode() if newer else None,
+	)
 
 def transaction_list_between_dates(
 		db: Session,
@@ -300,9 +802,28 @@ def transaction_list_between_dates(
 def transaction_list_by_import_job(
 		db: Session,
 		import_job_id: int,
+		limit: Optional[int] = None,
+		after: Optional[TransactionCursor] = None,
+		before: Optional[TransactionCursor] = None,
 	):
-	query = db.query(models.Transaction).order_by(models.Transaction.at.desc()).filter_by(import_job_id=import_job_id)
-	return query.all()
+	"Get the transactions created by an import job newest first, paged like transaction_list."
+	query = _transaction_keyset(select(models.Transaction), limit, after, before).where(
+		models.Transaction.import_job_id == import_job_id)
+	return _newest_first(db.scalars(query).all(), before)
+
+def transaction_list_fingerprints_by_import_job(
+		db: Session,
+		import_job_id: int,
+	) -> List[Tuple[int, Optional[str], datetime.datetime, Optional[str]]]:
+	"Get the ID, fingerprint, time and description of each transaction created by an import job, oldest first."
+	return [tuple(row) for row in db.execute(select(
+		models.Transaction.id,
+		models.Transaction.fingerprint,
+		models.Transaction.at,
+		models.Transaction.description,
+	).where(
+		models.Transaction.import_job_id == import_job_id,
+	).order_by(models.Transaction.at, models.Transaction.id))]
 
 def transaction_list_with_category(
 		db: Session,
@@ -336,8 +857,15 @@ def user_ensure_exists(db: Session, user: User) -> models.User:
 	db.commit()
 	return db_user
 
+def _user_get_by_username_query(username: str) -> Select:
+	return select(models.User).where(models.User.username == username).limit(1)
+
 def user_get_by_username(db: Session, username: str):
-	return db.query(models.User).filter(models.User.username == username).first()
+	return db.scalars(_user_get_by_username_query(username)).first()
+
+async def user_get_by_username_async(db: AsyncSession, username: str, *options: ORMOption):
+	"Get a user, loading whatever relationships options ask for since they can't be loaded lazily."
+	return (await db.scalars(_user_get_by_username_query(username).options(*options))).first()
 
 def user_list(db: Session):
 	return db.query(models.User).all()
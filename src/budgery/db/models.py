@@ -2,7 +2,7 @@ import datetime
 import enum
 from typing import Optional
 
-from sqlalchemy import Boolean, Column, Date, DateTime, Enum, Float, ForeignKey, Integer, MetaData, String
+from sqlalchemy import Boolean, Column, Date, DateTime, Enum, Float, ForeignKey, Index, Integer, MetaData, String, text
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import backref, declarative_base, relationship
 
@@ -100,34 +100,83 @@ class ImportJobStatus(enum.Enum):
 	error = 0
 	started = 1
 	finished = 2
+	# Waiting for a worker to claim it.
+	queued = 3
 
 class ImportJobError(enum.Enum):
 	# No error
 	NONE = 0
 	# A file we recognize but we failed to parse it correctly.
 	FAILED_PARSING_FILE = 1
+	# Workers kept losing their lease on the job before finishing it.
+	TOO_MANY_ATTEMPTS = 2
 
 class ImportJob(Base):
-	"A background task to import a large set of transactions."
+	"""A background task to import a large set of transactions.
+
+	Jobs are queued when created and claimed by a worker, which holds a lease
+	on the job until lease_expires. A job whose lease expires before it is
+	finished is claimed again by another worker.
+	"""
 	__tablename__ = "import_job"
 	id = Column(Integer, primary_key=True, index=True)
 	account_id = Column(Integer, ForeignKey("account.id"), nullable=True)
+	# Where the compressed uploaded file is kept once the job has finished.
+	archive_path = Column(String, nullable=True)
+	attempts = Column(Integer, default=0)
+	# SHA-256 of the uploaded file, used to spot the same file being uploaded again.
+	content_sha256 = Column(String, nullable=True, index=True)
+	# Size of the uploaded file in bytes.
+	content_size = Column(Integer, nullable=True)
 	created = Column(DateTime, default=datetime.datetime.now)
+	# Fraction of dates in the file that were parsed from the importer date cache.
+	date_cache_hit_rate = Column(Float, nullable=True)
 	error = Column(Enum(ImportJobError), default=ImportJobError.NONE)
 	filename = Column(String)
-	status = Column(Enum(ImportJobStatus))
+	lease_expires = Column(DateTime, nullable=True)
+	lease_owner = Column(String, nullable=True)
+	# Rows read from the file.
+	row_count = Column(Integer, nullable=True)
+	# Rows in the file that were already imported and so were not created again.
+	skipped_count = Column(Integer, default=0)
+	status = Column(Enum(ImportJobStatus), index=True)
+	# Where the uploaded file is kept until the job is done with it.
+	upload_path = Column(String, nullable=True)
 	user_id = Column(Integer, ForeignKey("user.id"))
 
 	def __init__(self,
 		account_id: int,
 		filename: str,
 		status: ImportJobStatus,
-		user: "User") -> None:
+		user: "User",
+		upload_path: Optional[str] = None,
+		content_sha256: Optional[str] = None,
+		content_size: Optional[int] = None) -> None:
 		self.account_id = account_id
+		self.attempts = 0
+		self.content_sha256 = content_sha256
+		self.content_size = content_size
 		self.filename = filename
+		self.skipped_count = 0
 		self.status = status
+		self.upload_path = upload_path
 		self.user = user
 
+class ImportJobStage(Base):
+	"How long one stage of an import job took and how many rows it handled."
+	__tablename__ = "import_job_stage"
+	id = Column(Integer, primary_key=True, index=True)
+	import_job_id = Column(Integer, ForeignKey("import_job.id"), index=True)
+	name = Column(String)
+	# Order the stages were first started in during the import.
+	position = Column(Integer)
+	rows = Column(Integer)
+	seconds = Column(Float)
+
+	@property
+	def rows_per_second(self) -> float:
+		return self.rows / self.seconds if self.seconds else 0.0
+
 class Institution(Base):
 	__tablename__ = "institution"
 	id = Column(Integer, primary_key=True, index=True)
@@ -161,6 +210,17 @@ class Sourcink(Base):
 	Sourcinks are shared between all users in the system.
 	"""
 	__tablename__ = "sourcink"
+	# Imports create sourcinks without an account by name, so those names must
+	# be unique. Each account has its own sourcink whatever its name.
+	__table_args__ = (
+		Index(
+			"ix_sourcink_name_unlinked",
+			"name",
+			unique=True,
+			postgresql_where=text("account_id IS NULL"),
+			sqlite_where=text("account_id IS NULL"),
+		),
+	)
 	id = Column(Integer, primary_key=True, index=True)
 	account_id = Column(Integer, ForeignKey("account.id", name="fk_account_id"), nullable=True)
 	name = Column(String())
@@ -176,15 +236,24 @@ class Transaction(Base):
 	up to one sourcink to/from. It is invalid to have both sourcink from and to
 	populated."""
 	__tablename__ = "transaction"
+	# Transactions are nearly always listed newest first, either all of them,
+	# those in a category or those from one import.
+	__table_args__ = (
+		Index("ix_transaction_category_at", "category", "at"),
+		Index("ix_transaction_import_job_id_at", "import_job_id", "at"),
+	)
 
 	id = Column(Integer, primary_key=True, index=True)
 	account_id_from = Column(Integer, ForeignKey("account.id", name="fk_account_id_from"), nullable=True)
 	account_id_to = Column(Integer, ForeignKey("account.id", name="fk_account_id_to"), nullable=True)
 	amount = Column(Float)
-	at = Column(DateTime())
+	at = Column(DateTime(), index=True)
 	budget_entry_id = Column(Integer, ForeignKey("budget_entry.id", name="fk_budget_entry_id"), nullable=True)
 	description = Column(String(), nullable=True)
 	category = Column(String(), nullable=True)
+	# Identifies imported transactions so importing them again can be skipped.
+	# See util.transaction_fingerprint.
+	fingerprint = Column(String(), nullable=True, unique=True, index=True)
 	import_job_id = Column(Integer, ForeignKey("import_job.id", name="fk_import_job_id"), nullable=True)
 	sourcink_id_from = Column(Integer, ForeignKey("sourcink.id", name="fk_sourcink_id_from"), nullable=True)
 	sourcink_id_to = Column(Integer, ForeignKey("sourcink.id", name="fk_sourcink_id_to"), nullable=True)
@@ -234,6 +303,7 @@ BudgetPermission.user = relationship(User,
 BudgetEntry.budget = relationship(Budget)
 BudgetEntry.transactions = relationship(Transaction)
 ImportJob.account = relationship(Account)
+ImportJob.stages = relationship(ImportJobStage, order_by=ImportJobStage.position, cascade="all, delete-orphan")
 ImportJob.transactions = relationship(Transaction)
 ImportJob.user = relationship(User)
 Sourcink.account = relationship(Account)
@@ -1,16 +1,20 @@
+import asyncio
 import calendar
 import collections
 from contextlib import asynccontextmanager
 import datetime
 from functools import lru_cache
 import logging
-from typing import Annotated, Mapping, Optional, Union
+import os
+from typing import Annotated, List, Mapping, Optional, Tuple, Union
 
 from authlib.integrations.starlette_client import OAuth, OAuthError
-from fastapi import BackgroundTasks, Depends, FastAPI, File, Form, Request, UploadFile
+from fastapi import BackgroundTasks, Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from sqlalchemy.orm import selectinload, Session
+from starlette.concurrency import run_in_threadpool
 from starlette.config import Config
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import RedirectResponse
@@ -18,11 +22,15 @@ from starlette.routing import Route
 
 from budgery import budget, custom_filters, dates, infer, task, util
 from budgery.db import crud, models
-from budgery.db.connection import connect, Engine, session, Session
+from budgery.db.connection import async_session, connect, connect_async, AsyncEngine, AsyncSession, Engine, session
 from budgery.user import User
 
 LOGGER = logging.getLogger(__name__)
 
+# How many previewed uploads a session remembers importing, so sending the
+# confirm form again goes to the job it already created.
+IMPORTED_UPLOADS_REMEMBERED = 20
+
 templates = Jinja2Templates(directory="templates") 
 templates.env.filters["currency"] = custom_filters.currency
 
@@ -40,7 +48,34 @@ async def lifespan(app: FastAPI):
 			}
 		)
 	app.mount("/static", StaticFiles(directory="static"), name="static")
+	# Called the way FastAPI calls it, so the engine the handlers use is reused.
+	db_engine = get_db_engine(config=config)
+	upload_directory = config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads")
+	upload_max_age = datetime.timedelta(seconds=config(
+		"IMPORT_PREVIEW_MAX_AGE",
+		cast=float,
+		default=task.IMPORT_PREVIEW_MAX_AGE.total_seconds(),
+	))
+	await run_in_threadpool(task.remove_stale_uploads, db_engine, upload_directory, upload_max_age)
+	poller = None
+	stop_polling = asyncio.Event()
+	# Without in-process imports the queue is worked by budgery-import-worker.
+	if config("IMPORT_IN_PROCESS", cast=bool, default=True):
+		poller = asyncio.create_task(task.poll_import_queue(
+			db_engine,
+			stop=stop_polling,
+			interval=config("IMPORT_POLL_INTERVAL", cast=float, default=60),
+			upload_directory=upload_directory,
+			upload_max_age=upload_max_age,
+			**_import_queue_options(config),
+		))
 	yield
+	# Let the imports already running finish rather than leave them for their
+	# leases to lapse.
+	stop_polling.set()
+	if poller is not None:
+		await poller
+	await get_async_db_engine(config=config).dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -63,6 +98,15 @@ def get_db(
 	finally:
 		db.close()
 
+@lru_cache()
+def get_async_db_engine(config: Annotated[Config, Depends(get_config)]) -> AsyncEngine:
+	return connect_async(config)
+
+async def get_async_db(db_engine: Annotated[AsyncEngine, Depends(get_async_db_engine)]):
+	"Get a session for handlers that query without blocking the event loop."
+	async with async_session(db_engine) as db:
+		yield db
+
 @lru_cache()
 def get_oauth():
 	config = get_config()
@@ -96,6 +140,16 @@ def _parse_user(user_data: Mapping[str, Union[int, str]]) -> User:
 		username = user_data["preferred_username"],)	
 	return user_model
 
+def _parse_cursors(after: Optional[str], before: Optional[str]) -> Tuple[Optional[crud.TransactionCursor], Optional[crud.TransactionCursor]]:
+	"Read the cursors of a transaction page from its query parameters."
+	try:
+		return (
+			crud.TransactionCursor.decode(after) if after else None,
+			crud.TransactionCursor.decode(before) if before else None,
+		)
+	except ValueError:
+		raise HTTPException(status_code=400, detail="Not a valid page of transactions")
+
 @app.get("/")
 async def root(
 		request: Request,
@@ -230,9 +284,13 @@ async def auth(request: Request,
 @app.get("/budget")
 async def budget_list_get(
 		request: Request,
-		db: Annotated[Session, Depends(get_db)],
+		db: Annotated[AsyncSession, Depends(get_async_db)],
 		user: Annotated[User, Depends(get_user)]):
-	db_user = crud.user_get_by_username(db, user.username)
+	db_user = await crud.user_get_by_username_async(
+		db,
+		user.username,
+		selectinload(models.User.user_budget_permissions).selectinload(models.BudgetPermission.budget),
+	)
 	budgets = db_user.budgets
 	sorted_budgets = sorted(budgets, key=lambda b: b.start_date, reverse=True)
 	return templates.TemplateResponse("budget-list.html.jinja", {
@@ -309,9 +367,9 @@ async def budget_create_monthly_post(
 async def budget_entry_create_get(
 		request: Request,
 		budget_id: int,
-		db: Annotated[Session, Depends(get_db)],
+		db: Annotated[AsyncSession, Depends(get_async_db)],
 		user: Annotated[User, Depends(get_user)]):
-	budget = crud.budget_get_by_id(db, budget_id)
+	budget = await crud.budget_get_by_id_async(db, budget_id)
 	return templates.TemplateResponse("budget-entry-create.html.jinja", {
 		"budget": budget,
 		"request": request,
@@ -421,10 +479,10 @@ async def budget_entry_get(
 @app.get("/category")
 async def category_list_get(
 		request: Request,
-		db: Annotated[Session, Depends(get_db)],
+		db: Annotated[AsyncSession, Depends(get_async_db)],
 		user: Annotated[User, Depends(get_user)]):
 	user = request.session.get("user")
-	categories = crud.category_list(db, user)
+	categories = await crud.category_list_async(db, user)
 	return templates.TemplateResponse("category.html.jinja", {
 		"categories": categories,
 		"current_page": "category",
@@ -468,20 +526,35 @@ async def import_job_get(
 		request: Request,
 		import_job_id: int,
 		db: Annotated[Session, Depends(get_db)],
-		user: Annotated[User, Depends(get_user)]):
+		user: Annotated[User, Depends(get_user)],
+		after: Optional[str] = None,
+		before: Optional[str] = None):
+	after_cursor, before_cursor = _parse_cursors(after, before)
 	db_user = crud.user_get_by_username(db, user.username)
 	import_job = crud.import_job_get_by_id(
 		db=db,
 		user=db_user,
 		import_job_id=import_job_id)
-	transactions = crud.transaction_list_by_import_job(
-		db=db,
-		import_job_id=import_job_id
+	page = crud.transaction_page(
+		crud.transaction_list_by_import_job(
+			db=db,
+			import_job_id=import_job_id,
+			limit=crud.TRANSACTION_PAGE_SIZE + 1,
+			after=after_cursor,
+			before=before_cursor,
+		),
+		crud.TRANSACTION_PAGE_SIZE,
+		after=after_cursor,
+		before=before_cursor,
 	)
+	queue_position = None
+	if import_job and import_job.status == models.ImportJobStatus.queued:
+		queue_position = crud.import_job_queue_position(db, import_job)
 	return templates.TemplateResponse("import-job.html.jinja", {
 		"import_job": import_job,
+		"page": page,
+		"queue_position": queue_position,
 		"request": request,
-		"transactions": transactions,
 		"user": user})
 
 @app.get("/import-job")
@@ -498,10 +571,55 @@ async def import_job_list_get(request: Request, db: Annotated[Session, Depends(g
 		"user": user,
 	})
 
-@app.get("/import-job/create")
-async def import_job_create_get(request: Request,
-	db: Annotated[Session, Depends(get_db)],
-	user: Annotated[User, Depends(get_user)]):
+def _import_queue_options(config: Config) -> Mapping[str, Union[int, str]]:
+	"Get how the import queue is run in this process from config."
+	return {
+		"parse_workers": config("IMPORT_PARSE_WORKERS", cast=int, default=1),
+		"concurrency": config("IMPORT_CONCURRENCY", cast=int, default=2),
+		"archive_directory": config("IMPORT_ARCHIVE_DIRECTORY", default="./import-archive"),
+	}
+
+def _process_import_queue_later(background_tasks: BackgroundTasks, config: Config, db_engine: Engine) -> None:
+	"Work through queued import jobs after the response is sent."
+	# Without in-process imports the job waits for a budgery-import-worker.
+	if config("IMPORT_IN_PROCESS", cast=bool, default=True):
+		background_tasks.add_task(
+			task.process_import_queue,
+			db_engine=db_engine,
+			**_import_queue_options(config),
+		)
+
+def _check_import_queue(config: Config, db: Session, db_user: models.User, new_jobs: int = 1) -> None:
+	"""Refuse to queue new_jobs more import jobs for db_user if the queue is too full.
+
+	No user may have more than IMPORT_QUEUE_DEPTH_PER_USER jobs waiting, so one
+	user's backfill can't fill the queue for everyone, and there may be no more
+	than IMPORT_QUEUE_DEPTH waiting in total.
+	"""
+	user_depth = config("IMPORT_QUEUE_DEPTH_PER_USER", cast=int, default=20)
+	user_queued = crud.import_job_count_queued(db, db_user)
+	if user_queued + new_jobs > user_depth:
+		raise HTTPException(
+			status_code=429,
+			detail=f"You already have {user_queued} imports waiting, try again once some have finished",
+			headers={"Retry-After": "60"},
+		)
+	depth = config("IMPORT_QUEUE_DEPTH", cast=int, default=100)
+	queued = crud.import_job_count_queued(db)
+	if queued + new_jobs > depth:
+		raise HTTPException(
+			status_code=503,
+			detail=f"There are already {queued} imports waiting, try again once some have finished",
+			headers={"Retry-After": "60"},
+		)
+
+def _import_job_create_response(
+		request: Request,
+		db: Session,
+		user: User,
+		**context,
+	):
+	"Render the page for starting an import, along with anything extra in context."
 	db_user = crud.user_get_by_username(db, user.username)
 	accounts = crud.account_list(db, db_user)
 	institutions = crud.institution_list(db)
@@ -511,34 +629,171 @@ async def import_job_create_get(request: Request,
 		"institutions_by_id": institutions_by_id,
 		"request": request,
 		"user": user,
+		**context,
 	})
 
+@app.get("/import-job/create")
+async def import_job_create_get(request: Request,
+	db: Annotated[Session, Depends(get_db)],
+	user: Annotated[User, Depends(get_user)]):
+	return _import_job_create_response(request, db, user)
+
+@app.post("/import-job/preview")
+async def import_job_preview_post(
+		request: Request,
+		account_id: Annotated[int, Form()],
+		config: Annotated[Config, Depends(get_config)],
+		db: Annotated[Session, Depends(get_db)],
+		user: Annotated[User, Depends(get_user)],
+		import_file: UploadFile = File(...),
+	):
+	"Show the first rows of an upload so they can be checked before it is imported."
+	upload = await run_in_threadpool(
+		task.spool_upload,
+		import_file.file,
+		config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads"),
+	)
+	def preview() -> task.ImportPreview:
+		with open(upload.path, "rb") as f:
+			return task.preview_upload(f)
+	preview_result = await run_in_threadpool(preview)
+	duplicate_of = crud.import_job_get_by_content(
+		db=db,
+		account_id=account_id,
+		content_sha256=upload.sha256,
+		content_size=upload.size,
+	)
+	upload_token = os.path.basename(upload.path)
+	if preview_result.error or duplicate_of:
+		# There is nothing to confirm, so the upload won't be needed again.
+		os.remove(upload.path)
+		upload_token = None
+	return _import_job_create_response(request, db, user,
+		account_id=account_id,
+		duplicate_of=duplicate_of,
+		filename=import_file.filename,
+		preview=preview_result,
+		upload_token=upload_token,
+	)
+
 @app.post("/import-job/create")
 async def import_job_create_post(
 		request: Request,
 		background_tasks: BackgroundTasks,
 		account_id: Annotated[int, Form()],
+		config: Annotated[Config, Depends(get_config)],
 		db: Annotated[Session, Depends(get_db)],
+		db_engine: Annotated[Engine, Depends(get_db_engine)],
 		user: Annotated[User, Depends(get_user)],
-		import_file: UploadFile = File(...),
+		import_file: Optional[UploadFile] = File(None),
+		filename: Annotated[Optional[str], Form()] = None,
+		upload_token: Annotated[Optional[str], Form()] = None,
 	):
+	"Import a file that is uploaded now or was uploaded to be previewed."
+	imported = request.session.get("imported_uploads", {})
+	if upload_token in imported:
+		# The confirm form was sent again, the first time already queued it.
+		return RedirectResponse(status_code=303, url=f"/import-job/{imported[upload_token]}")
 	db_user = crud.user_get_by_username(db, user.username)
-	import_job = crud.import_job_create(
-		account_id = account_id,
-		db = db,
-		filename = import_file.filename,
-		user = db_user,
-	)
-	background_tasks.add_task(
-		task.process_transaction_upload,
-		import_file=import_file.file,
-		filename=import_file.filename,
+	_check_import_queue(config, db, db_user)
+	directory = config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads")
+	if upload_token:
+		upload_path = task.spooled_upload_path(directory, upload_token)
+		if upload_path is None:
+			raise HTTPException(status_code=400, detail="The previewed upload is no longer available")
+		upload = await run_in_threadpool(task.hash_spooled_upload, upload_path)
+	elif import_file is not None:
+		upload = await run_in_threadpool(task.spool_upload, import_file.file, directory)
+		filename = import_file.filename
+	else:
+		raise HTTPException(status_code=400, detail="No file to import")
+	import_job, created = task.import_job_create_for_upload(
 		db=db,
-		import_job=import_job,
+		account_id=account_id,
+		filename=filename,
+		upload=upload,
 		user=db_user,
 	)
+	if upload_token:
+		# Only the most recent are kept so the session cookie stays small.
+		imported = dict(list(imported.items())[-(IMPORTED_UPLOADS_REMEMBERED - 1):])
+		imported[upload_token] = import_job.id
+		request.session["imported_uploads"] = imported
+	if created:
+		_process_import_queue_later(background_tasks, config, db_engine)
 	return RedirectResponse(status_code=303, url=f"/import-job/{import_job.id}")
 
+@app.post("/import-job/create-many")
+async def import_job_create_many_post(
+		request: Request,
+		background_tasks: BackgroundTasks,
+		config: Annotated[Config, Depends(get_config)],
+		db: Annotated[Session, Depends(get_db)],
+		db_engine: Annotated[Engine, Depends(get_db_engine)],
+		user: Annotated[User, Depends(get_user)],
+		import_files: List[UploadFile] = File(...),
+		account_id: Annotated[Optional[int], Form()] = None,
+		account_mapping: Annotated[str, Form()] = "",
+	):
+	"Import several files, or the files in ZIP archives, each into its mapped account."
+	try:
+		mapping = task.parse_account_mapping(account_mapping)
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	db_user = crud.user_get_by_username(db, user.username)
+	_check_import_queue(config, db, db_user, new_jobs=len(import_files))
+	directory = config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads")
+	spooled = []
+	for import_file in import_files:
+		spooled.extend(await run_in_threadpool(
+			task.spool_uploads,
+			import_file.file,
+			import_file.filename,
+			directory,
+		))
+	unmapped = [filename for filename, _ in spooled if mapping.get(filename, account_id) is None]
+	try:
+		if unmapped:
+			raise HTTPException(status_code=400, detail=f"No account for {', '.join(unmapped)}")
+		# Archives may hold many more files than were uploaded.
+		_check_import_queue(config, db, db_user, new_jobs=len(spooled))
+	except HTTPException:
+		for _, upload in spooled:
+			os.remove(upload.path)
+		raise
+	for filename, upload in spooled:
+		task.import_job_create_for_upload(
+			db=db,
+			account_id=mapping.get(filename, account_id),
+			filename=filename,
+			upload=upload,
+			user=db_user,
+		)
+	_process_import_queue_later(background_tasks, config, db_engine)
+	return RedirectResponse(status_code=303, url="/import-job")
+
+@app.post("/import-job/{import_job_id:int}/retry")
+async def import_job_retry_post(
+		request: Request,
+		background_tasks: BackgroundTasks,
+		import_job_id: int,
+		config: Annotated[Config, Depends(get_config)],
+		db: Annotated[Session, Depends(get_db)],
+		db_engine: Annotated[Engine, Depends(get_db_engine)],
+		user: Annotated[User, Depends(get_user)],
+	):
+	db_user = crud.user_get_by_username(db, user.username)
+	import_job = crud.import_job_get_by_id(
+		db=db,
+		user=db_user,
+		import_job_id=import_job_id)
+	# Only failed jobs whose upload was kept can be run again.
+	if import_job and import_job.status == models.ImportJobStatus.error and import_job.upload_path:
+		_check_import_queue(config, db, db_user)
+		crud.import_job_retry(db, import_job)
+		_process_import_queue_later(background_tasks, config, db_engine)
+	return RedirectResponse(status_code=303, url=f"/import-job/{import_job_id}")
+
 @app.get("/institution")
 async def institution_list_get(
 		request: Request,
@@ -676,29 +931,40 @@ async def tag_list_get(request: Request, user: Annotated[User, Depends(get_user)
 
 @app.get("/transaction")
 async def transaction_list_get(
-		db: Annotated[Session, Depends(get_db)],
+		db: Annotated[AsyncSession, Depends(get_async_db)],
 		user: Annotated[User, Depends(get_user)],
 		request: Request,
+		after: Optional[str] = None,
 		at_end: Optional[str] = None,
 		at_start: Optional[str] = None,
+		before: Optional[str] = None,
 		category: Optional[str] = None,
 	):
 
+	after_cursor, before_cursor = _parse_cursors(after, before)
 	at = crud.DatetimeRange(
 		end=dates.parse(at_end) if at_end else None,
 		start=dates.parse(at_start) if at_start else dates.this_month_start(),
 	)
-	transactions = crud.transaction_list(
-		at=at,
-		category=category,
-		db=db,
+	page = crud.transaction_page(
+		await crud.transaction_list_async(
+			after=after_cursor,
+			at=at,
+			before=before_cursor,
+			category=category,
+			db=db,
+			limit=crud.TRANSACTION_PAGE_SIZE + 1,
+		),
+		crud.TRANSACTION_PAGE_SIZE,
+		after=after_cursor,
+		before=before_cursor,
 	)
 	return templates.TemplateResponse("transaction-list.html.jinja", {
 		"at": at,
 		"category": category,
 		"current_page": "transaction",
+		"page": page,
 		"request": request,
-		"transactions": transactions,
 		"user": user})
 
 @app.get("/transaction/create")
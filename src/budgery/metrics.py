@@ -0,0 +1,57 @@
+"Measure where the time goes while importing."
+import contextlib
+import dataclasses
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+@dataclasses.dataclass
+class Stage:
+	name: str
+	rows: int = 0
+	seconds: float = 0.0
+
+	@property
+	def rows_per_second(self) -> float:
+		return self.rows / self.seconds if self.seconds else 0.0
+
+class ImportMetrics:
+	"""The time spent and rows handled by each stage of an import.
+
+	Stages may run inside one another, as when writing pulls rows through the
+	parser. The time of a stage excludes the time of any stage inside it, so the
+	stages add up to the total. Use one per import, it is not thread safe.
+	"""
+	def __init__(self) -> None:
+		self.stages: Dict[str, Stage] = {}
+		# Time spent in nested stages, for each stage that is running.
+		self._nested_seconds: List[float] = []
+
+	@contextlib.contextmanager
+	def stage(self, name: str) -> Iterator[Stage]:
+		"Time a block of code as part of the named stage."
+		stage = self.stages.get(name)
+		if stage is None:
+			stage = self.stages[name] = Stage(name)
+		self._nested_seconds.append(0.0)
+		start = time.perf_counter()
+		try:
+			yield stage
+		finally:
+			elapsed = time.perf_counter() - start
+			stage.seconds += elapsed - self._nested_seconds.pop()
+			if self._nested_seconds:
+				self._nested_seconds[-1] += elapsed
+
+	def timed(self, name: str, items: Iterable[T], count: Callable[[T], int] = lambda item: 1) -> Iterator[T]:
+		"Time producing each item of items as part of the named stage, counting count(item) rows for it."
+		itr = iter(items)
+		while True:
+			with self.stage(name) as stage:
+				try:
+					item = next(itr)
+				except StopIteration:
+					return
+				stage.rows += count(item)
+			yield item
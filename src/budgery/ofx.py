@@ -0,0 +1,126 @@
+"""Import OFX and QFX files.
+
+Both the SGML flavour of OFX 1.x, where most closing tags are left out, and
+the XML of OFX 2.x are read by the same tokenizer. Files are read a piece at
+a time and never built into a document tree, since brokerages can export
+years of transactions at once.
+"""
+import datetime
+import html
+import io
+import re
+from typing import Dict, IO, Iterator, Mapping, Optional, Tuple
+
+from budgery import dates
+from budgery.dataclasses import IMPORT_BATCH_SIZE, ImportBatch, ImportRow
+from budgery.metrics import ImportMetrics
+
+# Number of characters read from the file at a time.
+READ_SIZE = 64 * 1024
+# A tag and the text after it up to the next tag.
+_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)[^>]*>([^<]*)")
+# Dates look like 20230131, 20230131120000 or 20230131120000.000[-7:MST].
+_DATETIME = re.compile(r"(\d{8})(?:(\d{2})(\d{2})(\d{2})?)?(?:\.\d+)?(?:\[([+-]?\d+(?:\.\d+)?)(?::[^\]]*)?\])?$")
+
+_parse_ofx_date = dates.import_date_parser("%Y%m%d")
+
+def is_ofx(head: bytes) -> bool:
+	"Check if the start of a file looks like OFX."
+	head = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+	return head.startswith(b"OFXHEADER") or b"<?OFX" in head or b"<OFX>" in head.upper()
+
+def _encoding(head: bytes) -> str:
+	"Get the text encoding of an OFX file from its header."
+	if head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<?xml") or b"ENCODING:UTF-8" in head:
+		return "UTF-8"
+	# OFX 1.x files are USASCII with a Windows code page, 1252 everywhere we care about.
+	return "cp1252"
+
+def _parse_datetime(value: str) -> datetime.datetime:
+	"Parse an OFX date and time, keeping the timezone when it is given."
+	match = _DATETIME.match(value)
+	if not match:
+		raise ValueError(f"'{value}' is not an OFX date")
+	day, hour, minute, second, offset = match.groups()
+	at = _parse_ofx_date(day)
+	if hour:
+		at = at.replace(hour=int(hour), minute=int(minute), second=int(second or 0))
+	if offset:
+		at = at.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=float(offset))))
+	return at
+
+def _process_transaction(data: Mapping[str, str]) -> Optional[ImportRow]:
+	"Process the elements of a single STMTTRN aggregate."
+	try:
+		amount = float(data["TRNAMT"].replace(",", "."))
+		at = _parse_datetime(data["DTPOSTED"])
+	except KeyError as e:
+		raise ValueError(f"Transaction {data.get('FITID')} has no {e.args[0]}")
+	memo = data.get("MEMO")
+	return ImportRow(
+		account_id_is_from=amount < 0,
+		amount=abs(amount),
+		at=at,
+		category=None,
+		description=data.get("NAME") or memo,
+		extended_details=memo,
+		reference=data.get("FITID"),
+		sourcink_from=None,
+		sourcink_to=None,
+	)
+
+def _tokens(text: IO[str]) -> Iterator[Tuple[bool, str, str]]:
+	"Get whether each tag closes an element, its name and the text after it."
+	pending = ""
+	while True:
+		block = text.read(READ_SIZE)
+		data = pending + block
+		# Only the text up to the last tag started is known to be complete.
+		end = data.rfind("<") if block else len(data)
+		if end < 0:
+			end = 0
+		for match in _TAG.finditer(data, 0, end):
+			closing, name, value = match.groups()
+			yield bool(closing), name.upper(), value
+		pending = data[end:]
+		if not block:
+			return
+
+def extract_rows(f: IO[bytes], metrics: Optional[ImportMetrics] = None) -> Iterator[ImportRow]:
+	"""Lazily get the bank and credit card transactions in an OFX file.
+
+	FITID, the ID the institution gave the transaction, is kept as the
+	reference of each row. Working out the encoding is timed as the "sniff"
+	stage of metrics.
+	"""
+	metrics = metrics or ImportMetrics()
+	with metrics.stage("sniff"):
+		encoding = _encoding(f.read(2048))
+		f.seek(0)
+	text = io.TextIOWrapper(f, encoding=encoding, errors="replace", newline="")
+	try:
+		transaction: Optional[Dict[str, str]] = None
+		for closing, name, value in _tokens(text):
+			if name == "STMTTRN":
+				if closing and transaction is not None:
+					yield _process_transaction(transaction)
+					transaction = None
+				elif not closing:
+					transaction = {}
+			elif transaction is not None and not closing:
+				transaction[name] = html.unescape(value.strip())
+	finally:
+		# Don't let the wrapper close the caller's file when it is collected.
+		try:
+			text.detach()
+		except ValueError:
+			# The caller already closed it.
+			pass
+
+def extract_batches(
+		f: IO[bytes],
+		batch_size: int = IMPORT_BATCH_SIZE,
+		metrics: Optional[ImportMetrics] = None,
+	) -> Iterator[ImportBatch]:
+	"Lazily get the transactions in an OFX file in batches."
+	return ImportBatch.batched(extract_rows(f, metrics), batch_size)
@@ -0,0 +1,241 @@
+"Re-parse archived import files with the current parsers and correct the transactions they created."
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import datetime
+import gzip
+import logging
+import multiprocessing
+import os
+from typing import Any, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.config import Config
+
+from budgery import task
+from budgery.dataclasses import ImportBatch
+from budgery.db import crud, models
+from budgery.db.connection import connect, session
+
+LOGGER = logging.getLogger(__name__)
+
+# Columns people edit by hand after an import, which a replay leaves alone.
+PRESERVED_COLUMNS = ("category",)
+
+@dataclasses.dataclass
+class ReplayResult:
+	"What replaying one import job changed."
+	import_job_id: int
+	error: Optional[str] = None
+	unchanged: int = 0
+	updated: int = 0
+	inserted: int = 0
+	deleted: int = 0
+	# Rows the replay produced that another import already created.
+	skipped: int = 0
+
+@dataclasses.dataclass
+class Corrections:
+	"The changes that make the transactions of an import job match a fresh parse."
+	unchanged: int
+	updates: List[Mapping[str, Any]]
+	inserts: List[Mapping[str, Any]]
+	delete_ids: List[int]
+
+def diff_transactions(
+		stored: Iterable[Tuple[int, Optional[str], datetime.datetime, Optional[str]]],
+		values: Iterable[Mapping[str, Any]],
+	) -> Corrections:
+	"""Work out how to turn the stored transactions of an import job into values.
+
+	stored is the (id, fingerprint, at, description) of each existing
+	transaction and values the freshly parsed rows. The two are hash joined on
+	fingerprint: a row whose fingerprint is already stored is unchanged. The
+	rest are joined again on time and description, then paired in order, and
+	updated in place so their IDs and PRESERVED_COLUMNS survive. Whatever is
+	left over on either side is deleted or inserted. Times are compared without
+	their timezone, which the database doesn't keep.
+	"""
+	by_fingerprint = {}
+	unmatched = []
+	for transaction_id, fingerprint, at, description in stored:
+		at = at.replace(tzinfo=None)
+		if fingerprint and fingerprint not in by_fingerprint:
+			by_fingerprint[fingerprint] = (transaction_id, at, description)
+		else:
+			unmatched.append((transaction_id, at, description))
+	unchanged = 0
+	unmatched_values = []
+	for value in values:
+		if by_fingerprint.pop(value["fingerprint"], None) is None:
+			unmatched_values.append(value)
+		else:
+			unchanged += 1
+	unmatched.extend(by_fingerprint.values())
+
+	by_key = collections.defaultdict(collections.deque)
+	for transaction_id, at, description in sorted(unmatched):
+		by_key[at, description].append(transaction_id)
+	pairs = []
+	leftover_values = []
+	for value in unmatched_values:
+		ids = by_key.get((value["at"].replace(tzinfo=None), value["description"]))
+		if ids:
+			pairs.append((ids.popleft(), value))
+		else:
+			leftover_values.append(value)
+	leftover_ids = sorted(i for ids in by_key.values() for i in ids)
+	paired = min(len(leftover_ids), len(leftover_values))
+	pairs.extend(zip(leftover_ids, leftover_values))
+
+	updates = [
+		dict({k: v for k, v in value.items() if k not in PRESERVED_COLUMNS}, id=transaction_id)
+		for transaction_id, value in pairs
+	]
+	return Corrections(
+		unchanged=unchanged,
+		updates=updates,
+		inserts=leftover_values[paired:],
+		delete_ids=leftover_ids[paired:],
+	)
+
+def _parse_archive(archive_path: str) -> List[ImportBatch]:
+	"Parse an archived import file. Runs in a worker process."
+	with gzip.open(archive_path, "rb") as f:
+		return list(task._extract_batches(f))
+
+def _parse_archives(archive_paths: List[str], workers: int) -> Iterator[Tuple[str, Any]]:
+	"""Parse archived import files, yielding each path with its batches as it finishes.
+
+	Files are parsed by up to workers processes. A file that can't be parsed is
+	yielded with the exception instead.
+	"""
+	if workers <= 1:
+		for archive_path in archive_paths:
+			try:
+				yield archive_path, _parse_archive(archive_path)
+			except Exception as e:
+				yield archive_path, e
+		return
+	context = multiprocessing.get_context("spawn")
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+		futures = {executor.submit(_parse_archive, p): p for p in archive_paths}
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				yield futures[future], future.result()
+			except Exception as e:
+				yield futures[future], e
+
+def replay_import_job(
+		db: Session,
+		import_job: models.ImportJob,
+		batches: Iterable[ImportBatch],
+		dry_run: bool = False,
+	) -> ReplayResult:
+	"""Correct the transactions of an import job to match batches parsed from its file.
+
+	Rows whose corrected fingerprint belongs to another import are dropped
+	rather than duplicated. All the changes are written in one commit. A dry
+	run writes nothing, not even the sourcinks the file names that don't exist
+	yet.
+	"""
+	def sourcink_ids(names: Set[str]) -> Mapping[str, Optional[int]]:
+		if not dry_run:
+			return crud.SOURCINK_RESOLVER.resolve(db, names)
+		# Sourcinks that would be created have no ID yet.
+		found = crud.SOURCINK_RESOLVER.resolve(db, names, create=False)
+		return {name: found.get(name) for name in names}
+	values = list(task._transaction_values(
+		batches,
+		account_id=import_job.account_id,
+		sourcink_ids=sourcink_ids,
+	))
+	corrections = diff_transactions(
+		crud.transaction_list_fingerprints_by_import_job(db, import_job.id),
+		values,
+	)
+	elsewhere = crud.transaction_existing_fingerprints(
+		db,
+		[v["fingerprint"] for v in corrections.updates + corrections.inserts],
+		exclude_import_job_id=import_job.id,
+	)
+	updates = [v for v in corrections.updates if v["fingerprint"] not in elsewhere]
+	inserts = [v for v in corrections.inserts if v["fingerprint"] not in elsewhere]
+	delete_ids = corrections.delete_ids + [v["id"] for v in corrections.updates if v["fingerprint"] in elsewhere]
+	if not dry_run:
+		crud.transaction_apply_corrections(db, import_job.id, updates, inserts, delete_ids)
+	return ReplayResult(
+		import_job_id=import_job.id,
+		unchanged=corrections.unchanged,
+		updated=len(updates),
+		inserted=len(inserts),
+		deleted=len(delete_ids),
+		skipped=len(corrections.updates) + len(corrections.inserts) - len(updates) - len(inserts),
+	)
+
+def replay(
+		db_engine: Engine,
+		import_job_ids: Optional[List[int]] = None,
+		account_id: Optional[int] = None,
+		workers: int = 1,
+		dry_run: bool = False,
+	) -> List[ReplayResult]:
+	"""Replay archived import jobs, all of them unless import_job_ids or account_id is given.
+
+	The files are parsed in parallel and the corrections written from this
+	process as each file finishes. Returns what was done to each job in order
+	of ID.
+	"""
+	db = session(db_engine)
+	try:
+		import_jobs = crud.import_job_list_archived(db, account_id=account_id)
+		if import_job_ids is not None:
+			wanted = set(import_job_ids)
+			import_jobs = [j for j in import_jobs if j.id in wanted]
+			for missing in sorted(wanted - {j.id for j in import_jobs}):
+				LOGGER.warning("Import job %d is not a finished job with an archived file", missing)
+		by_path = {j.archive_path: j for j in import_jobs}
+		results = []
+		for archive_path, batches in _parse_archives(list(by_path), workers):
+			import_job = by_path[archive_path]
+			if isinstance(batches, Exception):
+				LOGGER.error("Failed to parse %s for import job %d: %s", archive_path, import_job.id, batches)
+				results.append(ReplayResult(import_job_id=import_job.id, error=str(batches)))
+				continue
+			results.append(replay_import_job(db, import_job, batches, dry_run=dry_run))
+		return sorted(results, key=lambda r: r.import_job_id)
+	finally:
+		db.close()
+
+def _print_results(results: List[ReplayResult]) -> None:
+	print(f"{'job':>6} {'unchanged':>9} {'updated':>7} {'inserted':>8} {'deleted':>7} {'skipped':>7}")
+	for r in results:
+		if r.error:
+			print(f"{r.import_job_id:>6} error: {r.error}")
+			continue
+		print(f"{r.import_job_id:>6} {r.unchanged:>9} {r.updated:>7} {r.inserted:>8} {r.deleted:>7} {r.skipped:>7}")
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Re-parse archived Budgery imports and correct their transactions.")
+	parser.add_argument("--env", default="env", help="Path to the config file")
+	parser.add_argument("import_job_ids", type=int, nargs="*", help="Import jobs to replay, all archived jobs if none")
+	parser.add_argument("--account", type=int, default=None, help="Only replay imports into this account")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes to parse files with")
+	parser.add_argument("--dry-run", action="store_true", help="Report the changes without making them")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	engine = connect(Config(args.env))
+	results = replay(
+		engine,
+		import_job_ids=args.import_job_ids or None,
+		account_id=args.account,
+		workers=args.workers,
+		dry_run=args.dry_run,
+	)
+	_print_results(results)
+
+if __name__ == "__main__":
+	main()
@@ -1,76 +1,686 @@
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import gzip
+import hashlib
+import itertools
 import logging
+import os
 from pathlib import Path
+import re
+import shutil
+import socket
 import tempfile
-from typing import IO, List
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, IO, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+import uuid
+import zipfile
 
 import magic
+from sqlalchemy.exc import DBAPIError
 
-from budgery import infer
-from budgery.dataclasses import ImportRow
+from budgery import dates, infer, util
+from budgery.dataclasses import IMPORT_BATCH_SIZE, ImportBatch, ImportPreview, ImportRow, SpooledUpload
 from budgery.db import crud, models
+from budgery.db.connection import Engine, session
+from budgery.metrics import ImportMetrics
+import budgery.csv
+import budgery.ofx
 import budgery.xlsx
 from budgery.user import User
 
 LOGGER = logging.getLogger(__name__)
 
-def _extract_rows(f: IO) -> List[ImportRow]:
-	"Extract the rows from an import file."
+# SQLite allows one writer at a time. Imports running at once in this process
+# take turns writing rather than waiting on the database lock.
+_SQLITE_WRITE_LOCK = threading.Lock()
+# How long a worker may hold an import job without renewing its lease before
+# another worker is allowed to take the job over.
+IMPORT_LEASE_DURATION = datetime.timedelta(minutes=5)
+# How many times a job may be claimed before it is considered failed.
+IMPORT_MAX_ATTEMPTS = 3
+# Seconds a runner waits after an import job raises before trying the queue
+# again, doubled for each failure in a row.
+IMPORT_FAILURE_DELAY = 1.0
+# Failures in a row after which a runner stops. Whatever is queued is run
+# again on the next upload or poll.
+IMPORT_MAX_FAILURES = 5
+# Number of bytes copied at a time when spooling an upload.
+SPOOL_BLOCK_SIZE = 1024 * 1024
+# Number of rows parsed to preview an import.
+IMPORT_PREVIEW_ROWS = 20
+# How long a previewed upload is kept waiting for the import to be confirmed.
+IMPORT_PREVIEW_MAX_AGE = datetime.timedelta(days=1)
+# Name of the sourcink used when an import file doesn't say where money went.
+UNKNOWN_SOURCINK = "Unknown"
+# Identifies this process as the holder of import job leases.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def _write_lock(db_engine: Engine) -> ContextManager:
+	"Get the lock to hold while an import writes to the database."
+	if db_engine.dialect.name == "sqlite":
+		return _SQLITE_WRITE_LOCK
+	return contextlib.nullcontext()
+
+def _detect_type(f: IO[bytes]) -> str:
+	"Get the type of an import file from its start, leaving it positioned at the start."
 	head = f.read(2048)
-	detected = magic.from_buffer(head)
-	parts = []
-	while True:
-		p = f.read(2048 * 8)
-		if not p:
-			break
-		parts.append(p)
-	content = head + b''.join(parts)
 	f.seek(0)
-	
-	if detected == "CSV text":
-		return budgery.csv.extract_rows(content)
-	elif detected == "Microsoft OOXML":
-		return budgery.xlsx.extract_rows(content)
+	# libmagic calls OFX plain text or XML, so look for it first.
+	return "OFX" if budgery.ofx.is_ofx(head) else magic.from_buffer(head)
+
+def _extract_batches(
+		f: IO[bytes],
+		workers: int = 1,
+		batch_size: int = IMPORT_BATCH_SIZE,
+		metrics: Optional[ImportMetrics] = None,
+	) -> Iterator[ImportBatch]:
+	"""Extract the rows from an import file in batches.
+
+	Rows are produced lazily as the file is read so that callers can write them
+	out as they go rather than holding the whole file in memory. Large CSV files
+	are parsed by up to workers processes. Working out the type of file is timed
+	as the "detect" stage of metrics.
+	"""
+	metrics = metrics or ImportMetrics()
+	with metrics.stage("detect"):
+		detected = _detect_type(f)
+
+	if detected == "OFX":
+		return budgery.ofx.extract_batches(f, batch_size=batch_size, metrics=metrics)
+	elif detected == "CSV text":
+		return budgery.csv.extract_batches(f, workers=workers, batch_size=batch_size, metrics=metrics)
+	elif detected in ("Microsoft OOXML", "Microsoft Excel 2007+"):
+		return budgery.xlsx.extract_batches(f, batch_size=batch_size, metrics=metrics)
 	else:
 		raise Exception(f"No idea what to do with a '{detected}' file")
 
+def _extract_rows(f: IO[bytes], workers: int = 1) -> Iterator[ImportRow]:
+	"Extract the rows from an import file."
+	return ImportBatch.rows(_extract_batches(f, workers=workers))
+
+def preview_upload(f: IO[bytes], limit: int = IMPORT_PREVIEW_ROWS) -> ImportPreview:
+	"""Parse just the first rows of an import file to show what importing it would do.
+
+	Only the start of the file is read, so this takes about as long for any
+	size of file.
+	"""
+	file_type = _detect_type(f)
+	rows = []
+	try:
+		batches = _extract_batches(f, batch_size=limit)
+		rows.extend(itertools.islice(ImportBatch.rows(batches), limit))
+	except Exception as e:
+		return ImportPreview(error=str(e), file_type=file_type, rows=rows)
+	return ImportPreview(error=None, file_type=file_type, rows=rows)
+
+def _transaction_values(
+		batches: Iterable[ImportBatch],
+		account_id: int,
+		sourcink_ids: Callable[[Set[str]], Mapping[str, int]],
+	) -> Iterator[Mapping[str, Any]]:
+	"""Convert batches of import rows to the column values of the transactions to create.
+
+	sourcink_ids gets the IDs of a set of sourcink names and is called once per
+	batch. Rows without a sourcink name are given UNKNOWN_SOURCINK. Rows with a
+	reference from the provider are fingerprinted by it alone.
+	"""
+	# How many times each transaction has been seen in this import, keyed by
+	# the fingerprint of its first occurrence.
+	occurrences = collections.Counter()
+	for batch in batches:
+		names = {n for n in itertools.chain(batch.sourcink_from, batch.sourcink_to) if n}
+		ids = sourcink_ids(names | {UNKNOWN_SOURCINK})
+		sourcink_id_unknown = ids[UNKNOWN_SOURCINK]
+		for is_from, amount, at, description, reference, sourcink_from, sourcink_to in zip(
+				batch.account_id_is_from,
+				batch.amount,
+				batch.datetimes(),
+				batch.description,
+				batch.reference,
+				batch.sourcink_from,
+				batch.sourcink_to):
+			if reference:
+				fingerprint = util.reference_fingerprint(account_id, reference)
+			else:
+				first = util.transaction_fingerprint(account_id, is_from, amount, at, description, 0)
+				occurrence = occurrences[first]
+				occurrences[first] += 1
+				if occurrence:
+					fingerprint = util.transaction_fingerprint(account_id, is_from, amount, at, description, occurrence)
+				else:
+					fingerprint = first
+			yield {
+				"account_id_from": account_id if is_from else None,
+				"account_id_to": None if is_from else account_id,
+				"amount": amount,
+				"at": at,
+				"category": None,
+				"description": description,
+				"fingerprint": fingerprint,
+				"sourcink_id_from": ids[sourcink_from] if sourcink_from else sourcink_id_unknown,
+				"sourcink_id_to": ids[sourcink_to] if sourcink_to else sourcink_id_unknown,
+			}
+
+def _hit_rate(hits: int, misses: int) -> Optional[float]:
+	"Get the fraction of lookups that were hits, None if there were no lookups."
+	total = hits + misses
+	return hits / total if total else None
+
+def run_transaction_upload(
+		import_file: IO,
+		db_engine: Engine,
+		import_job_id: int,
+		chunk_size: int = crud.TRANSACTION_BULK_CHUNK_SIZE,
+		parse_workers: int = 1,
+	) -> bool:
+	"""Import the transactions in a file.
+
+	This blocks until the import is done and uses its own database session, so
+	it is safe to run on a thread other than the one that created the job.
+	Returns True if the job finished, False if it failed. Either way the time
+	spent in each stage of the import is saved on the job.
+	"""
+	db = session(db_engine)
+	metrics = ImportMetrics()
+	try:
+		import_job = db.get(models.ImportJob, import_job_id)
+		with metrics.stage("sourcink"):
+			crud.SOURCINK_RESOLVER.preload(db)
+		write_lock = _write_lock(db_engine)
+		def sourcink_ids(names: Set[str]) -> Mapping[str, int]:
+			with metrics.stage("sourcink"), write_lock:
+				return crud.SOURCINK_RESOLVER.resolve(db, names)
+		date_hits, date_misses = dates.import_date_cache_stats()
+		try:
+			batches = metrics.timed(
+				"parse",
+				_extract_batches(import_file, workers=parse_workers, batch_size=chunk_size, metrics=metrics),
+				count=len,
+			)
+			values = metrics.timed("prepare", _transaction_values(
+				batches=batches,
+				account_id=import_job.account_id,
+				sourcink_ids=sourcink_ids,
+			))
+			result = crud.transaction_bulk_create(
+				db=db,
+				transactions=values,
+				import_job=import_job,
+				chunk_size=chunk_size,
+				metrics=metrics,
+				write_lock=write_lock,
+			)
+		except DBAPIError:
+			# The database may well work next time, so the lease is left to lapse
+			# and the job is retried.
+			raise
+		except Exception:
+			# A file that can't be imported fails the same way every time, so
+			# the job is failed now rather than left for its lease to lapse.
+			LOGGER.exception("Failed to import the file for import job %d", import_job_id)
+			db.rollback()
+			# Earlier chunks were already committed, a file that fails writes nothing.
+			crud.transaction_delete_by_import_job(db, import_job_id)
+			_record_metrics(db, import_job, metrics, date_hits, date_misses)
+			crud.import_job_error(db, import_job, models.ImportJobError.FAILED_PARSING_FILE)
+			return False
+		_record_metrics(db, import_job, metrics, date_hits, date_misses)
+		crud.import_job_finish(db, import_job, skipped_count=result.skipped)
+		if result.skipped:
+			LOGGER.info("Import job %d skipped %d transactions that were already imported", import_job_id, result.skipped)
+		return True
+	finally:
+		db.close()
+
+def _record_metrics(
+		db: crud.Session,
+		import_job: models.ImportJob,
+		metrics: ImportMetrics,
+		date_hits: int,
+		date_misses: int,
+	) -> None:
+	"""Save the metrics of an import on its job and log them.
+
+	date_hits and date_misses are the date cache stats from before the import
+	started. The cache is shared by every import in the process so the rate is
+	only exact when one import runs at a time.
+	"""
+	hits, misses = dates.import_date_cache_stats()
+	date_cache_hit_rate = _hit_rate(hits - date_hits, misses - date_misses)
+	parse = metrics.stages.get("parse")
+	crud.import_job_record_metrics(
+		db=db,
+		import_job=import_job,
+		stages=metrics.stages.values(),
+		row_count=parse.rows if parse else 0,
+		date_cache_hit_rate=date_cache_hit_rate,
+	)
+	LOGGER.info("Import job %d date cache hit rate %s, stages: %s",
+		import_job.id,
+		date_cache_hit_rate,
+		", ".join(f"{s.name} {s.seconds:.3f}s/{s.rows} rows" for s in metrics.stages.values()),
+	)
+
 async def process_transaction_upload(
 		import_file: IO,
+		db_engine: Engine,
+		import_job_id: int,
+		chunk_size: int = crud.TRANSACTION_BULK_CHUNK_SIZE,
+		parse_workers: int = 1,
+	) -> None:
+	"Run an import on the import pool and wait for it without blocking the event loop."
+	loop = asyncio.get_running_loop()
+	await loop.run_in_executor(IMPORT_SCHEDULER.executor(1), functools.partial(
+		run_transaction_upload,
+		import_file=import_file,
+		db_engine=db_engine,
+		import_job_id=import_job_id,
+		chunk_size=chunk_size,
+		parse_workers=parse_workers,
+	))
+
+def spool_upload(import_file: IO[bytes], directory: str) -> SpooledUpload:
+	"Copy an uploaded file to directory so any worker can import it, hashing it on the way."
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.abspath(os.path.join(directory, uuid.uuid4().hex))
+	sha256 = hashlib.sha256()
+	size = 0
+	with open(path, "wb") as f:
+		while True:
+			block = import_file.read(SPOOL_BLOCK_SIZE)
+			if not block:
+				break
+			sha256.update(block)
+			size += len(block)
+			f.write(block)
+	return SpooledUpload(path=path, sha256=sha256.hexdigest(), size=size)
+
+def hash_spooled_upload(path: str) -> SpooledUpload:
+	"Get the hash and size of a file that was already spooled."
+	sha256 = hashlib.sha256()
+	size = 0
+	with open(path, "rb") as f:
+		while True:
+			block = f.read(SPOOL_BLOCK_SIZE)
+			if not block:
+				break
+			sha256.update(block)
+			size += len(block)
+	return SpooledUpload(path=path, sha256=sha256.hexdigest(), size=size)
+
+def import_job_create_for_upload(
 		db: crud.Session,
+		account_id: int,
 		filename: str,
-		import_job: models.ImportJob,
-		user: User,
+		upload: SpooledUpload,
+		user: models.User,
+	) -> Tuple[models.ImportJob, bool]:
+	"""Queue an import of a spooled upload, unless the account already has a job for the same file.
+
+	Returns the job and whether it was created. When an existing job is
+	returned the spooled copy is removed, unless it is the existing job's own
+	upload, and nothing is parsed or written again.
+	"""
+	existing = crud.import_job_get_by_content(
+		db=db,
+		account_id=account_id,
+		content_sha256=upload.sha256,
+		content_size=upload.size,
+	)
+	if existing is not None:
+		LOGGER.info("Upload %s is the same as import job %d", filename, existing.id)
+		if upload.path != existing.upload_path:
+			os.remove(upload.path)
+		return existing, False
+	import_job = crud.import_job_create(
+		account_id=account_id,
+		content_sha256=upload.sha256,
+		content_size=upload.size,
+		db=db,
+		filename=filename,
+		upload_path=upload.path,
+		user=user,
+	)
+	return import_job, True
+
+def spooled_upload_path(directory: str, token: str) -> Optional[str]:
+	"""Get the path of a file spool_upload wrote to directory from its name.
+
+	Returns None if the name isn't one spool_upload would make or the file is gone.
+	"""
+	if not re.fullmatch(r"[0-9a-f]{32}", token):
+		return None
+	path = os.path.abspath(os.path.join(directory, token))
+	return path if os.path.isfile(path) else None
+
+def remove_stale_uploads(
+		db_engine: Engine,
+		directory: str,
+		max_age: datetime.timedelta = IMPORT_PREVIEW_MAX_AGE,
+	) -> int:
+	"""Remove files spooled to directory over max_age ago that no import job refers to.
+
+	These are uploads that were previewed and never imported. Returns how many
+	were removed.
+	"""
+	if not os.path.isdir(directory):
+		return 0
+	db = session(db_engine)
+	try:
+		in_use = crud.import_job_list_upload_paths(db)
+	finally:
+		db.close()
+	cutoff = time.time() - max_age.total_seconds()
+	removed = 0
+	for entry in os.scandir(directory):
+		path = os.path.abspath(entry.path)
+		if spooled_upload_path(directory, entry.name) != path or path in in_use:
+			continue
+		if entry.stat().st_mtime < cutoff:
+			os.remove(path)
+			removed += 1
+	if removed:
+		LOGGER.info("Removed %d previewed uploads that were never imported", removed)
+	return removed
+
+def _is_archive(f: IO[bytes]) -> bool:
+	"Check if f is a ZIP archive of import files, as opposed to a spreadsheet that is stored as one."
+	try:
+		if not zipfile.is_zipfile(f):
+			return False
+		f.seek(0)
+		with zipfile.ZipFile(f) as archive:
+			return "[Content_Types].xml" not in archive.namelist()
+	finally:
+		f.seek(0)
+
+def _is_import_member(info: zipfile.ZipInfo) -> bool:
+	"Check if a member of an archive is a file to import rather than a directory or metadata."
+	name = os.path.basename(info.filename)
+	return not info.is_dir() and not name.startswith(".") and not info.filename.startswith("__MACOSX/")
+
+def spool_uploads(import_file: IO[bytes], filename: str, directory: str) -> List[Tuple[str, SpooledUpload]]:
+	"""Spool an uploaded file, or each file in it if it is a ZIP archive.
+
+	Returns the filename and spooled upload of each file to import.
+	"""
+	if not _is_archive(import_file):
+		return [(filename, spool_upload(import_file, directory))]
+	spooled = []
+	with zipfile.ZipFile(import_file) as archive:
+		for info in archive.infolist():
+			if _is_import_member(info):
+				with archive.open(info) as member:
+					spooled.append((os.path.basename(info.filename), spool_upload(member, directory)))
+	return spooled
+
+def parse_account_mapping(text: str) -> Dict[str, int]:
+	"""Parse lines of 'filename = account ID' into a mapping.
+
+	Blank lines are ignored. Raises ValueError if a line is not in that form.
+	"""
+	mapping = {}
+	for line in text.splitlines():
+		if not line.strip():
+			continue
+		filename, sep, account_id = line.rpartition("=")
+		if not sep or not filename.strip():
+			raise ValueError(f"Expected 'filename = account ID', got '{line}'")
+		mapping[filename.strip()] = int(account_id)
+	return mapping
+
+def _renew_lease_until(
+		stop: threading.Event,
+		db_engine: Engine,
+		import_job_id: int,
+		worker_id: str,
 	) -> None:
-	# Immediately push this coroutine to the bottom of the stack.
-	await asyncio.sleep(0)
+	"Keep renewing the lease on an import job until stop is set."
+	db = session(db_engine)
 	try:
-		rows = _extract_rows(import_file)
-	except ValueError as e:
-		LOGGER.error("Faled to read import file: %s", e)
-		crud.import_job_error(db, import_job, models.ImportJobError.FAILED_PARSING_FILE)
-		return
-	sourcink_unknown = crud.sourcink_get_or_create(db, "Unknown")
-	for row in rows:
-		if row.account_id_is_from:
-			account_id_from = import_job.account_id
-			account_id_to = None
-		else:
-			account_id_from = None
-			account_id_to = import_job.account_id
-		crud.transaction_create(
+		while not stop.wait(IMPORT_LEASE_DURATION.total_seconds() / 3):
+			renewed = crud.import_job_renew_lease(
+				db=db,
+				import_job_id=import_job_id,
+				lease_duration=IMPORT_LEASE_DURATION,
+				worker_id=worker_id,
+			)
+			if not renewed:
+				LOGGER.warning("Lost the lease on import job %d", import_job_id)
+				return
+	finally:
+		db.close()
+
+def archive_upload(upload_path: str, directory: str, import_job_id: int) -> str:
+	"""Compress an uploaded file into directory, removing the original. Returns the archive's path.
+
+	Archive names are unique so a directory can be shared between databases or
+	outlive one whose IDs start again without any archive being replaced.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	archive_path = os.path.abspath(os.path.join(directory, f"import-job-{import_job_id}-{uuid.uuid4().hex}.gz"))
+	with open(upload_path, "rb") as src, gzip.open(archive_path, "xb") as dst:
+		shutil.copyfileobj(src, dst, SPOOL_BLOCK_SIZE)
+	os.remove(upload_path)
+	return archive_path
+
+def run_next_import_job(
+		db_engine: Engine,
+		worker_id: str = WORKER_ID,
+		parse_workers: int = 1,
+		archive_directory: Optional[str] = None,
+		chunk_size: int = crud.TRANSACTION_BULK_CHUNK_SIZE,
+	) -> Optional[int]:
+	"""Claim the next queued import job and run it.
+
+	The lease on the job is renewed for as long as the import runs. Once the job
+	finishes, the uploaded file is compressed into archive_directory so the job
+	can be replayed later, or removed if there is no archive_directory. Returns
+	the ID of the job that was run or None if there was nothing to do.
+	"""
+	db = session(db_engine)
+	try:
+		import_job = crud.import_job_claim(
 			db=db,
-			description=row.description,
-			account_id_from=account_id_from,
-			account_id_to=account_id_to,
-			amount=row.amount,
-			at=row.at,
-			category=None,
-			import_job=import_job,
-			sourcink_from=sourcink_unknown,
-			sourcink_to=sourcink_unknown,
+			lease_duration=IMPORT_LEASE_DURATION,
+			max_attempts=IMPORT_MAX_ATTEMPTS,
+			worker_id=worker_id,
 		)
-	crud.import_job_finish(db, import_job)
+		if import_job is None:
+			return None
+		import_job_id = import_job.id
+		upload_path = import_job.upload_path
+		LOGGER.info("Claimed import job %d, attempt %d", import_job_id, import_job.attempts)
+		if not upload_path or not os.path.exists(upload_path):
+			LOGGER.error("Import job %d has no uploaded file at '%s'", import_job_id, upload_path)
+			crud.import_job_error(db, import_job, models.ImportJobError.FAILED_PARSING_FILE)
+			return import_job_id
+		if import_job.attempts > 1:
+			# Throw away whatever an earlier attempt managed to write.
+			crud.transaction_delete_by_import_job(db, import_job_id)
+	finally:
+		db.close()
+
+	stop = threading.Event()
+	heartbeat = threading.Thread(
+		target=_renew_lease_until,
+		args=(stop, db_engine, import_job_id, worker_id),
+		daemon=True,
+		name=f"budgery-import-lease-{import_job_id}",
+	)
+	heartbeat.start()
+	try:
+		with open(upload_path, "rb") as f:
+			finished = run_transaction_upload(
+				import_file=f,
+				db_engine=db_engine,
+				import_job_id=import_job_id,
+				chunk_size=chunk_size,
+				parse_workers=parse_workers,
+			)
+	finally:
+		stop.set()
+		heartbeat.join()
+	if finished:
+		if archive_directory:
+			archive_path = archive_upload(upload_path, archive_directory, import_job_id)
+			db = session(db_engine)
+			try:
+				crud.import_job_archive(db, import_job_id, archive_path)
+			finally:
+				db.close()
+		else:
+			os.remove(upload_path)
+	return import_job_id
+
+class ImportScheduler:
+	"""Runs queued import jobs in this process, no more than a set number at once.
+
+	Every request that queues a job asks the scheduler to run the queue. Rather
+	than each request starting its own runners, the scheduler only starts
+	enough to bring the total up to the limit. Runners are only ever started
+	and stopped on the event loop, so no locking is needed.
+
+	Imports parse files and write to the database, all of which blocks, so they
+	run on a thread pool rather than on the event loop serving requests. The
+	pool has as many threads as the largest limit asked for.
+	"""
+	def __init__(self):
+		self.running = 0
+		# Bumped whenever the queue is asked to run, so a runner that found the
+		# queue empty can tell a job may have been added since it looked.
+		self._requests = 0
+		self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+		self._executor_size = 0
+
+	def executor(self, workers: int) -> concurrent.futures.ThreadPoolExecutor:
+		"Get the pool imports run on, replacing it with a bigger one if it has fewer than workers threads."
+		if workers > self._executor_size:
+			if self._executor is not None:
+				# Imports already running on the old pool still finish there.
+				self._executor.shutdown(wait=False)
+			self._executor = concurrent.futures.ThreadPoolExecutor(
+				max_workers=workers,
+				thread_name_prefix="budgery-import",
+			)
+			self._executor_size = workers
+		return self._executor
+
+	async def run(
+			self,
+			db_engine: Engine,
+			parse_workers: int = 1,
+			concurrency: int = 1,
+			archive_directory: Optional[str] = None,
+			stop: Optional[asyncio.Event] = None,
+		) -> None:
+		"""Make sure up to concurrency runners are working through the queue and wait for any started.
+
+		Runners started here stop taking new jobs once stop is set.
+		"""
+		self._requests += 1
+		self.executor(concurrency)
+		started = max(0, concurrency - self.running)
+		self.running += started
+		await asyncio.gather(*(
+			self._drain(db_engine, parse_workers, archive_directory, stop)
+			for _ in range(started)
+		))
+
+	async def _drain(
+			self,
+			db_engine: Engine,
+			parse_workers: int,
+			archive_directory: Optional[str],
+			stop: Optional[asyncio.Event],
+		) -> None:
+		"Run queued import jobs one after another on the pool until there are none left or stop is set."
+		loop = asyncio.get_running_loop()
+		failures = 0
+		try:
+			while stop is None or not stop.is_set():
+				requests = self._requests
+				try:
+					# Looked up each time as a bigger pool may have replaced it.
+					import_job_id = await loop.run_in_executor(self._executor, functools.partial(
+						run_next_import_job,
+						db_engine=db_engine,
+						parse_workers=parse_workers,
+						archive_directory=archive_directory,
+					))
+				except Exception:
+					# The job's lease will lapse and a runner will retry it.
+					LOGGER.exception("Import job failed")
+					failures += 1
+					if failures >= IMPORT_MAX_FAILURES:
+						LOGGER.error("Stopping an import runner after %d failures in a row", failures)
+						return
+					await asyncio.sleep(IMPORT_FAILURE_DELAY * 2 ** (failures - 1))
+					continue
+				failures = 0
+				if import_job_id is None and requests == self._requests:
+					return
+		finally:
+			self.running -= 1
+
+IMPORT_SCHEDULER = ImportScheduler()
+
+async def process_import_queue(
+		db_engine: Engine,
+		parse_workers: int = 1,
+		concurrency: int = 1,
+		archive_directory: Optional[str] = None,
+	) -> None:
+	"""Run queued import jobs on a thread pool until there are none left.
+
+	Up to concurrency jobs are run at once across every caller in this process.
+	"""
+	await IMPORT_SCHEDULER.run(
+		db_engine,
+		parse_workers=parse_workers,
+		concurrency=concurrency,
+		archive_directory=archive_directory,
+	)
+
+async def poll_import_queue(
+		db_engine: Engine,
+		stop: asyncio.Event,
+		interval: float,
+		parse_workers: int = 1,
+		concurrency: int = 1,
+		archive_directory: Optional[str] = None,
+		upload_directory: Optional[str] = None,
+		upload_max_age: datetime.timedelta = IMPORT_PREVIEW_MAX_AGE,
+	) -> None:
+	"""Run the import queue now and then every interval seconds until stop is set.
+
+	This picks up jobs left queued when the server stopped and jobs whose
+	worker let their lease lapse, which no upload would otherwise start. Once
+	stop is set the jobs already running here are finished but no more are
+	started. Each time round, previewed uploads in upload_directory that were
+	never imported are removed once they are upload_max_age old.
+	"""
+	loop = asyncio.get_running_loop()
+	while not stop.is_set():
+		try:
+			await IMPORT_SCHEDULER.run(
+				db_engine,
+				parse_workers=parse_workers,
+				concurrency=concurrency,
+				archive_directory=archive_directory,
+				stop=stop,
+			)
+			if upload_directory:
+				await loop.run_in_executor(None, remove_stale_uploads, db_engine, upload_directory, upload_max_age)
+		except Exception:
+			LOGGER.exception("Failed to run the import queue")
+		with contextlib.suppress(asyncio.TimeoutError):
+			await asyncio.wait_for(stop.wait(), interval)
 
 async def train_transaction_categorizor(
 		db: crud.Session,
@@ -1,5 +1,7 @@
 "Dumping ground for functions."
-from typing import Iterable, Mapping
+import datetime
+import hashlib
+from typing import Iterable, Mapping, Optional
 
 from budgery.db import models
 
@@ -28,3 +30,42 @@ def transaction_count_by_budget_id(
 	result = {b.id: counts[i] for i, b in enumerate(budgets)}
 	result[None] = counts[-1]
 	return result
+
+def normalize_description(description: Optional[str]) -> str:
+	"Normalize a transaction description so cosmetic differences between exports don't matter."
+	return " ".join((description or "").split()).casefold()
+
+def transaction_fingerprint(
+		account_id: int,
+		account_id_is_from: bool,
+		amount: float,
+		at: datetime.datetime,
+		description: Optional[str],
+		occurrence: int,
+	) -> str:
+	"""Identify an imported transaction so that importing it again can be detected.
+
+	occurrence tells apart identical transactions within one import, like two
+	coffees on the same day, so only the first would be considered the same as
+	the first one in an overlapping import, and so on.
+	"""
+	description_hash = hashlib.sha256(normalize_description(description).encode("UTF-8")).hexdigest()
+	key = "|".join((
+		str(account_id),
+		"from" if account_id_is_from else "to",
+		f"{amount:.2f}",
+		# The database doesn't keep timezones, so neither do fingerprints.
+		at.replace(tzinfo=None).isoformat(),
+		description_hash,
+		str(occurrence),
+	))
+	return hashlib.sha256(key.encode("UTF-8")).hexdigest()
+
+def reference_fingerprint(account_id: int, reference: str) -> str:
+	"""Identify an imported transaction by the ID its provider gave it.
+
+	Providers like OFX banks keep these IDs the same across exports, which makes
+	them a better key than the details of the transaction.
+	"""
+	key = "|".join((str(account_id), "reference", reference))
+	return hashlib.sha256(key.encode("UTF-8")).hexdigest()
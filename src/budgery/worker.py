@@ -0,0 +1,55 @@
+"Run queued import jobs outside of the web server."
+import argparse
+import datetime
+import logging
+import time
+
+from starlette.config import Config
+
+from budgery import task
+from budgery.db.connection import connect
+
+LOGGER = logging.getLogger(__name__)
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description="Run queued Budgery import jobs.")
+	parser.add_argument("--env", default="env", help="Path to the config file")
+	parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+	parser.add_argument("--parse-workers", type=int, default=1, help="Processes to parse each large CSV file with")
+	parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds to wait when the queue is empty")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	config = Config(args.env)
+	engine = connect(config)
+	archive_directory = config("IMPORT_ARCHIVE_DIRECTORY", default="./import-archive")
+	upload_directory = config("IMPORT_UPLOAD_DIRECTORY", default="./import-uploads")
+	upload_max_age = datetime.timedelta(seconds=config(
+		"IMPORT_PREVIEW_MAX_AGE",
+		cast=float,
+		default=task.IMPORT_PREVIEW_MAX_AGE.total_seconds(),
+	))
+	LOGGER.info("Import worker %s started", task.WORKER_ID)
+	while True:
+		try:
+			import_job_id = task.run_next_import_job(
+				engine,
+				parse_workers=args.parse_workers,
+				archive_directory=archive_directory,
+			)
+		except Exception:
+			# The job's lease will lapse and it will be retried.
+			LOGGER.exception("Import job failed")
+			import_job_id = None
+		if import_job_id is not None:
+			continue
+		try:
+			task.remove_stale_uploads(engine, upload_directory, upload_max_age)
+		except Exception:
+			LOGGER.exception("Failed to remove previewed uploads")
+		if args.once:
+			return
+		time.sleep(args.poll_interval)
+
+if __name__ == "__main__":
+	main()
@@ -1,11 +1,13 @@
-import datetime
-import io
-from typing import Iterable, List, Mapping, Optional, Tuple
+from typing import IO, Iterator, Mapping, Optional
 import warnings
 
 import openpyxl
 
-from budgery.dataclasses import ImportRow
+from budgery import dates
+from budgery.dataclasses import IMPORT_BATCH_SIZE, ImportBatch, ImportRow
+from budgery.metrics import ImportMetrics
+
+_parse_amex_date = dates.import_date_parser("%m/%d/%Y")
 
 (
 	"Date",
@@ -25,11 +27,13 @@ from budgery.dataclasses import ImportRow
 
 def _process_amex(data: Mapping[str, str]) -> Optional[ImportRow]:
 	"Process a single row of Amex data."
-	at = datetime.datetime.strptime(data["Date"], "%m/%d/%Y")
+	at = _parse_amex_date(data["Date"])
+	# Charges are positive, payments and refunds are negative.
+	amount = float(data["Amount"])
 	return ImportRow(
-		account_id_is_from=True,
+		account_id_is_from=amount >= 0,
 		address=data["Address"],
-		amount=data["Amount"],
+		amount=abs(amount),
 		at=at,
 		category=data["Category"],
 		city=data["City/State"],
@@ -42,26 +46,43 @@ def _process_amex(data: Mapping[str, str]) -> Optional[ImportRow]:
 
 def _xlsx_row_dict_iterator(headers, sheet_iterator):
 	for row in sheet_iterator:
-		yield {h: row[i].value for i, h in enumerate(headers)}
+		# Read-only sheets may omit trailing empty cells.
+		yield {h: row[i] if i < len(row) else None for i, h in enumerate(headers)}
+
 
+def extract_rows(f: IO[bytes], metrics: Optional[ImportMetrics] = None) -> Iterator[ImportRow]:
+	"""Lazily get all the content from the xlsx file.
 
-def extract_rows(content: bytes) -> List[ImportRow]:
-	"Get all the content from the xlsx file"
+	The workbook is opened in read-only mode so cells are read from the file as
+	the rows are iterated rather than loaded into memory up front. Opening it is
+	timed as the "open" stage of metrics.
+	"""
+	metrics = metrics or ImportMetrics()
 	# There's no way to keep openpyxl from emitting warnings about the internal
 	# mechanics of the file we are importing. This looks like
 	# "Workbook contains no default style, apply openpyxl's default"
-	with warnings.catch_warnings(record=True):
+	with warnings.catch_warnings(record=True), metrics.stage("open"):
 		warnings.simplefilter("always")
-		workbook = openpyxl.load_workbook(io.BytesIO(content))
-		sheet_names = workbook.get_sheet_names()
+		workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+	try:
 		# For now, assume AMEX
 		# Amex spreadsheet has headers starting at row 7
-		sheet = workbook.get_sheet_by_name("Transaction Details")
-	itr = sheet.iter_rows()
-	for i in range(6):
-		next(itr)
-	head_row = next(itr)
-	headers = tuple(c.value for c in head_row)
-	data = [_process_amex(row) for row in _xlsx_row_dict_iterator(headers, itr)]
-	data = [d for d in data if d]
-	return data
+		sheet = workbook["Transaction Details"]
+		itr = sheet.iter_rows(values_only=True)
+		for i in range(6):
+			next(itr)
+		headers = next(itr)
+		for row in _xlsx_row_dict_iterator(headers, itr):
+			data = _process_amex(row)
+			if data:
+				yield data
+	finally:
+		workbook.close()
+
+def extract_batches(
+		f: IO[bytes],
+		batch_size: int = IMPORT_BATCH_SIZE,
+		metrics: Optional[ImportMetrics] = None,
+	) -> Iterator[ImportBatch]:
+	"Lazily get all the content from the xlsx file in batches."
+	return ImportBatch.batched(extract_rows(f, metrics), batch_size)
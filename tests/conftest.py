@@ -3,6 +3,21 @@ from pytest_alembic.config import Config
 import pytest
 import sqlalchemy
 
+from budgery.main import get_config
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+	"""Point the app's config at a database and import directories in tmp_path.
+
+	Settings in the environment take precedence over any env file.
+	"""
+	monkeypatch.setenv("SQL_ALCHEMY_DATABASE_URL", f"sqlite:///{tmp_path / 'budgery-test.db'}")
+	monkeypatch.setenv("IMPORT_UPLOAD_DIRECTORY", str(tmp_path / "import-uploads"))
+	monkeypatch.setenv("IMPORT_ARCHIVE_DIRECTORY", str(tmp_path / "import-archive"))
+	get_config.cache_clear()
+	yield get_config()
+	get_config.cache_clear()
+
 @pytest.fixture
 def alembic_config():
 	"""Override this fixture to configure the exact alembic context setup required.
@@ -11,7 +26,7 @@ def alembic_config():
 	return config
 
 @pytest.fixture
-def alembic_engine(alembic_config):
+def alembic_engine(alembic_config, tmp_path):
     """Override this fixture to provide pytest-alembic powered tests with a database handle.
     """
-    return sqlalchemy.create_engine("sqlite:///./budgery-test.db")
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'alembic.db'}")
@@ -0,0 +1,68 @@
+import asyncio
+import gc
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.event import registry
+from starlette.config import Config
+
+from budgery.db import connection, models
+
+def _before_flush_listeners() -> int:
+	"Get how many before_flush listeners are registered anywhere."
+	gc.collect()
+	return sum(1 for _, identifier, _ in registry._key_to_collection if identifier == "before_flush")
+
+def test_session_factory_is_reused():
+	"Test that sessions share one factory, so getting one doesn't register more event listeners."
+	engine = create_engine("sqlite://")
+	models.Base.metadata.create_all(engine)
+	connection.session(engine).close()
+	listeners = _before_flush_listeners()
+	for i in range(200):
+		db = connection.session(engine)
+		db.add(models.Institution(aba_routing_number=i, name=f"institution {i}"))
+		db.commit()
+		assert type(db) is connection.SESSION_FACTORY.class_
+		assert db.get_bind() is engine
+		assert len(db.dispatch.before_flush) == 1
+		db.close()
+	assert _before_flush_listeners() == listeners
+
+def test_sqlite_connections_are_tuned(tmp_path):
+	"Test that every SQLite connection gets the configured pragmas and the pool is sized."
+	config = Config(environ={
+		"SQL_ALCHEMY_DATABASE_URL": f"sqlite:///{tmp_path / 'tuned.db'}",
+		"IMPORT_CONCURRENCY": "3",
+		"SQLITE_CACHE_SIZE": "-2000",
+	})
+	engine = connection.connect(config)
+	assert engine.pool.size() == 11
+	with engine.connect() as conn:
+		pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+		assert pragma("journal_mode") == "wal"
+		assert pragma("synchronous") == 1
+		assert pragma("cache_size") == -2000
+		assert pragma("mmap_size") == 268435456
+		assert pragma("temp_store") == 2
+		assert pragma("busy_timeout") == 30000
+
+def test_async_sqlite_connections_are_pooled(tmp_path):
+	"Test that async sessions reuse tuned connections rather than opening one each."
+	config = Config(environ={
+		"SQL_ALCHEMY_DATABASE_URL": f"sqlite:///{tmp_path / 'pooled.db'}",
+		"IMPORT_CONCURRENCY": "3",
+		"SQLITE_CACHE_SIZE": "-2000",
+	})
+	connects = []
+	async def run():
+		engine = connection.connect_async(config)
+		event.listen(engine.sync_engine, "connect", lambda *args: connects.append(args))
+		try:
+			for _ in range(3):
+				async with connection.async_session(engine) as db:
+					assert await db.scalar(text("PRAGMA cache_size")) == -2000
+			return engine.pool.size()
+		finally:
+			await engine.dispose()
+	assert asyncio.run(run()) == 11
+	assert len(connects) == 1
@@ -0,0 +1,99 @@
+import asyncio
+import datetime
+
+from fastapi.testclient import TestClient
+import pytest
+
+from budgery.db import connection, crud, models
+from budgery.main import app, get_user
+from budgery.user import User
+
+USER = User(
+	auth_time=datetime.datetime.utcnow(),
+	email=None,
+	email_verified=False,
+	expiration=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+	family_name="Tester",
+	given_name="Robert",
+	name="Bobby Tester",
+	disabled=False,
+	username="bobbytester",
+)
+
+@pytest.fixture
+def config(settings):
+	"Config for a database with a user, a budget and some transactions in it."
+	engine = connection.connect(settings)
+	models.Base.metadata.create_all(engine)
+	db = connection.session(engine)
+	db_user = crud.user_ensure_exists(db, USER)
+	crud.budget_create(db, end_date=datetime.date(2023, 2, 1), start_date=datetime.date(2023, 1, 1), user=db_user)
+	for day, category in enumerate(["Rent", "Fuel", None, "Fuel"], start=1):
+		crud.transaction_create(
+			account_id_from=None,
+			account_id_to=None,
+			amount=10.0 * day,
+			at=datetime.datetime(2023, 1, day),
+			category=category,
+			db=db,
+			description=f"Transaction {day}",
+			import_job=None,
+			sourcink_from=None,
+			sourcink_to=None,
+		)
+	db.close()
+	engine.dispose()
+	return settings
+
+def test_async_crud_matches_sync(config):
+	"Test that the async crud functions get the same results as their sync versions."
+	engine = connection.connect(config)
+	db = connection.session(engine)
+	at = crud.DatetimeRange(end=datetime.datetime(2023, 1, 3), start=datetime.datetime(2023, 1, 2))
+	expected = {
+		"budget": crud.budget_get_by_id(db, 1).start_date,
+		"categories": crud.category_list(db, None),
+		"transactions": [t.id for t in crud.transaction_list(db)],
+		"fuel": [t.id for t in crud.transaction_list(db, category="Fuel")],
+		"uncategorized": [t.id for t in crud.transaction_list(db, category="None")],
+		"between": [t.id for t in crud.transaction_list(db, at=at, limit=1)],
+		"user": crud.user_get_by_username(db, USER.username).id,
+	}
+	db.close()
+
+	async def get_async():
+		engine = connection.connect_async(config)
+		try:
+			async with connection.async_session(engine) as db:
+				return {
+					"budget": (await crud.budget_get_by_id_async(db, 1)).start_date,
+					"categories": await crud.category_list_async(db, None),
+					"transactions": [t.id for t in await crud.transaction_list_async(db)],
+					"fuel": [t.id for t in await crud.transaction_list_async(db, category="Fuel")],
+					"uncategorized": [t.id for t in await crud.transaction_list_async(db, category="None")],
+					"between": [t.id for t in await crud.transaction_list_async(db, at=at, limit=1)],
+					"user": (await crud.user_get_by_username_async(db, USER.username)).id,
+				}
+		finally:
+			await engine.dispose()
+	assert asyncio.run(get_async()) == expected
+	assert expected["transactions"] == [4, 3, 2, 1]
+
+def test_read_endpoints_use_async_session(config):
+	app.dependency_overrides[get_user] = lambda: USER
+	try:
+		with TestClient(app) as client:
+			transactions = client.get("/transaction", params={"at_start": "2023-01-01"})
+			categories = client.get("/category")
+			budgets = client.get("/budget")
+			entry = client.get("/budget/1/entry/create")
+	finally:
+		app.dependency_overrides.pop(get_user)
+	assert transactions.status_code == 200
+	assert "Transaction 4" in transactions.text
+	assert categories.status_code == 200
+	assert "/transaction?category=Fuel" in categories.text
+	assert budgets.status_code == 200
+	assert "2023-01-01" in budgets.text
+	assert entry.status_code == 200
+	assert "/budget/1/entry/create" in entry.text
@@ -0,0 +1,47 @@
+import concurrent.futures
+import datetime
+import sys
+
+import pytest
+
+from budgery import dates
+
+def test_date_parser_matches_strptime():
+	"Test that the fast parsers agree with strptime."
+	parse = dates.DateParser("%m/%d/%Y")
+	assert parse("1/4/2023") == datetime.datetime(2023, 1, 4)
+	assert parse("12/31/2023") == datetime.datetime.strptime("12/31/2023", "%m/%d/%Y")
+	parse_iso = dates.DateParser("%Y-%m-%d")
+	assert parse_iso("2023-01-04") == datetime.datetime(2023, 1, 4)
+	with pytest.raises(ValueError):
+		parse("2023-01-04")
+	with pytest.raises(ValueError):
+		parse("13/01/2023")
+
+def test_date_parser_cache():
+	"Test that repeated dates are hits and the cache stays bounded."
+	parse = dates.DateParser("%m/%d/%Y", cache_size=2)
+	for value in ("1/1/2023", "1/1/2023", "1/2/2023", "1/3/2023", "1/3/2023"):
+		parse(value)
+	assert parse.hits == 2
+	assert parse.misses == 3
+	assert len(parse._cache) == 2
+	parse("1/1/2023")
+	assert parse.misses == 4
+
+def test_date_parser_shared_between_threads():
+	"Test that threads evicting from the same small cache don't trip over each other."
+	parse = dates.DateParser("%m/%d/%Y", cache_size=4)
+	values = [f"{month}/{day}/2023" for month in range(1, 13) for day in range(1, 29)]
+	def parse_all(_):
+		return [parse(v) for v in values]
+	# Switch threads as often as possible so evictions interleave.
+	switch_interval = sys.getswitchinterval()
+	sys.setswitchinterval(1e-6)
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+			results = list(executor.map(parse_all, range(64)))
+	finally:
+		sys.setswitchinterval(switch_interval)
+	assert all(r == results[0] for r in results)
+	assert len(parse._cache) <= 4
@@ -0,0 +1,117 @@
+import datetime
+import re
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+import pytest
+
+from budgery.db import connection, crud, models
+from budgery.main import app, get_user
+from budgery.user import User
+
+START = datetime.datetime(2023, 1, 1)
+USER = User(
+	auth_time=datetime.datetime.utcnow(),
+	email=None,
+	email_verified=False,
+	expiration=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+	family_name="Tester",
+	given_name="Robert",
+	name="Bobby Tester",
+	disabled=False,
+	username="bobbytester",
+)
+
+@pytest.fixture
+def db():
+	"A database of 25 transactions, several at each time so pages have to break ties by ID."
+	engine = create_engine("sqlite://")
+	models.Base.metadata.create_all(engine)
+	with Session(engine) as db:
+		db.execute(insert(models.Transaction), [{
+			"amount": float(i),
+			"at": START + datetime.timedelta(days=i // 4),
+			"category": "Rent" if i % 2 else None,
+			"import_job_id": 1,
+		} for i in range(25)])
+		db.commit()
+		yield db
+
+def _walk(db, list_page, page_size):
+	"Page through a list from the start to the end and back again, getting the IDs on each page."
+	forward = []
+	page = crud.transaction_page(list_page(limit=page_size + 1), page_size)
+	forward.append([t.id for t in page.transactions])
+	while page.next_cursor:
+		after = crud.TransactionCursor.decode(page.next_cursor)
+		page = crud.transaction_page(list_page(limit=page_size + 1, after=after), page_size, after=after)
+		forward.append([t.id for t in page.transactions])
+	backward = [[t.id for t in page.transactions]]
+	while page.previous_cursor:
+		before = crud.TransactionCursor.decode(page.previous_cursor)
+		page = crud.transaction_page(list_page(limit=page_size + 1, before=before), page_size, before=before)
+		backward.append([t.id for t in page.transactions])
+	return forward, backward
+
+@pytest.mark.parametrize("page_size", [1, 4, 7, 25, 30])
+def test_transaction_list_pages(db, page_size):
+	expected = [t.id for t in crud.transaction_list(db)]
+	assert len(expected) == 25
+	forward, backward = _walk(db, lambda **kwargs: crud.transaction_list(db, **kwargs), page_size)
+	assert [i for page in forward for i in page] == expected
+	assert all(len(page) == page_size for page in forward[:-1])
+	assert backward == forward[::-1]
+
+def test_transaction_list_pages_filtered(db):
+	expected = [t.id for t in crud.transaction_list(db, category="Rent")]
+	forward, backward = _walk(db, lambda **kwargs: crud.transaction_list(db, category="Rent", **kwargs), 5)
+	assert [i for page in forward for i in page] == expected
+	assert backward == forward[::-1]
+
+def test_transaction_list_by_import_job_pages(db):
+	expected = [t.id for t in crud.transaction_list_by_import_job(db, 1)]
+	assert expected == [t.id for t in crud.transaction_list(db)]
+	forward, backward = _walk(db, lambda **kwargs: crud.transaction_list_by_import_job(db, 1, **kwargs), 6)
+	assert [i for page in forward for i in page] == expected
+	assert backward == forward[::-1]
+
+def test_transaction_cursor_round_trip():
+	cursor = crud.TransactionCursor(at=datetime.datetime(2023, 1, 2, 3, 4, 5, 6), id=7)
+	assert crud.TransactionCursor.decode(cursor.encode()) == cursor
+	with pytest.raises(ValueError):
+		crud.TransactionCursor.decode("nonsense")
+
+def test_transaction_list_endpoint_pages(settings, monkeypatch):
+	engine = connection.connect(settings)
+	models.Base.metadata.create_all(engine)
+	with Session(engine) as db:
+		db.execute(insert(models.Transaction), [{
+			"amount": float(i),
+			"at": START + datetime.timedelta(days=i // 2),
+			"description": f"Transaction {i}",
+		} for i in range(5)])
+		db.commit()
+	engine.dispose()
+	monkeypatch.setattr(crud, "TRANSACTION_PAGE_SIZE", 2)
+	app.dependency_overrides[get_user] = lambda: USER
+	try:
+		with TestClient(app) as client:
+			pages = [client.get("/transaction", params={"at_start": "2023-01-01"})]
+			while (older := re.search(r'href="([^"]*after=[^"]*)"', pages[-1].text)):
+				pages.append(client.get(older.group(1).replace("&amp;", "&")))
+			newer = re.search(r'href="([^"]*before=[^"]*)"', pages[-1].text)
+			previous = client.get(newer.group(1).replace("&amp;", "&"))
+			invalid = client.get("/transaction", params={"after": "nonsense"})
+	finally:
+		app.dependency_overrides.pop(get_user)
+	assert [p.status_code for p in pages] == [200, 200, 200]
+	found = [re.findall(r"<td>(Transaction \d)</td>", p.text) for p in pages]
+	assert found == [
+		["Transaction 4", "Transaction 3"],
+		["Transaction 2", "Transaction 1"],
+		["Transaction 0"],
+	]
+	assert "at_start=2023-01-01" in newer.group(1)
+	assert re.findall(r"<td>(Transaction \d)</td>", previous.text) == found[1]
+	assert invalid.status_code == 400
@@ -0,0 +1,99 @@
+"Check that the transaction queries in crud are answered from an index rather than a full table scan."
+import datetime
+import random
+import re
+from typing import Callable, List
+
+import pytest
+from sqlalchemy import create_engine, event, insert, text
+from sqlalchemy.orm import Session
+
+from budgery.db import crud, models
+
+START = datetime.datetime(2022, 1, 1)
+CATEGORIES = [None, None, None, "Dining", "Fuel", "Groceries", "Rent", "Travel", "Utilities"]
+MARCH = crud.DatetimeRange(start=datetime.datetime(2022, 3, 1), end=datetime.datetime(2022, 4, 1))
+CURSOR = crud.TransactionCursor(at=datetime.datetime(2022, 3, 15), id=2500)
+# A row of the plan that reads every row of the table itself, rather than
+# searching it or walking an index.
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?transaction$")
+
+QUERIES = {
+	"transaction_list": lambda db: crud.transaction_list(db),
+	"transaction_list category": lambda db: crud.transaction_list(db, category="Rent"),
+	"transaction_list uncategorized": lambda db: crud.transaction_list(db, category="None"),
+	"transaction_list category and dates": lambda db: crud.transaction_list(db, category="Rent", at=MARCH),
+	"transaction_list dates": lambda db: crud.transaction_list(db, at=MARCH, limit=50),
+	"transaction_list page": lambda db: crud.transaction_list(db, limit=101, after=CURSOR),
+	"transaction_list previous page": lambda db: crud.transaction_list(db, limit=101, before=CURSOR),
+	"transaction_list category page": lambda db: crud.transaction_list(db, category="Rent", limit=101, after=CURSOR),
+	"transaction_list dates page": lambda db: crud.transaction_list(db, at=MARCH, limit=101, before=CURSOR),
+	"transaction_list_between_dates": lambda db: crud.transaction_list_between_dates(
+		db,
+		end_date=datetime.date(2022, 4, 1),
+		start_date=datetime.date(2022, 3, 1),
+	),
+	"transaction_list_by_import_job": lambda db: crud.transaction_list_by_import_job(db, 3),
+	"transaction_list_by_import_job page": lambda db: crud.transaction_list_by_import_job(db, 3, limit=101, after=CURSOR),
+	"transaction_list_fingerprints_by_import_job": lambda db: crud.transaction_list_fingerprints_by_import_job(db, 3),
+	"transaction_list_with_category": lambda db: crud.transaction_list_with_category(db),
+	"transaction_get_one": lambda db: crud.transaction_get_one(
+		db,
+		start=datetime.date(2022, 3, 1),
+		end=datetime.date(2022, 4, 1),
+		category=None,
+	),
+	"transaction_get_by_id": lambda db: crud.transaction_get_by_id(db, 5),
+	"transaction_get_categories": lambda db: crud.transaction_get_categories(db),
+	"transaction_existing_fingerprints": lambda db: crud.transaction_existing_fingerprints(db, ["f1", "f2"]),
+	# There is no job 9, so nothing is deleted.
+	"transaction_delete_by_import_job": lambda db: crud.transaction_delete_by_import_job(db, 9),
+	"category_list": lambda db: crud.category_list(db, None),
+}
+
+@pytest.fixture(scope="module")
+def engine():
+	"An in-memory database seeded with two years of transactions, with statistics gathered."
+	engine = create_engine("sqlite://")
+	models.Base.metadata.create_all(engine)
+	rng = random.Random(1)
+	with Session(engine) as db:
+		db.execute(insert(models.Transaction), [{
+			"amount": round(rng.uniform(1, 500), 2),
+			"at": START + datetime.timedelta(hours=rng.randrange(2 * 365 * 24)),
+			"category": rng.choice(CATEGORIES),
+			"description": f"Transaction {i}",
+			"fingerprint": f"f{i}",
+			"import_job_id": rng.choice([None, 1, 2, 3, 4, 5, 6, 7, 8]),
+		} for i in range(5000)])
+		db.execute(text("ANALYZE"))
+		db.commit()
+	return engine
+
+def _query_plans(engine, query: Callable[[Session], object]) -> List[List[str]]:
+	"Run query and get the plan SQLite chose for each statement it ran, without changing anything."
+	statements = []
+	def record(conn, cursor, statement, parameters, context, executemany):
+		statements.append((statement, parameters))
+	event.listen(engine, "before_cursor_execute", record)
+	try:
+		with Session(engine) as db:
+			query(db)
+			db.rollback()
+	finally:
+		event.remove(engine, "before_cursor_execute", record)
+	plans = []
+	with engine.connect() as conn:
+		for statement, parameters in statements:
+			if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+				rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+				plans.append([row[3] for row in rows])
+	return plans
+
+@pytest.mark.parametrize("name", QUERIES)
+def test_query_uses_index(engine, name):
+	plans = _query_plans(engine, QUERIES[name])
+	assert plans, "The query didn't run any statements"
+	for plan in plans:
+		assert not any(FULL_SCAN.match(step) for step in plan), plan
+		assert not any("USE TEMP B-TREE" in step for step in plan), plan
@@ -1,19 +1,39 @@
+import asyncio
 import csv
 import datetime
+import gzip
+import hashlib
+import io
 import logging
+import os
 from pathlib import Path
+import pickle
 import pprint
+import pytest
+import re
+import shutil
+import tempfile
+import threading
+import time
 from typing import Dict, List
 import unittest
+import unittest.mock
+import zipfile
 
 from fastapi.testclient import TestClient
-from starlette.config import Config
+import httpx
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
 
-from budgery import task
-from budgery.main import app, get_config
+from budgery import bulk_import, replay, task
+import budgery.csv
+import budgery.ofx
+from budgery.main import app, get_async_db_engine, get_config, get_user
+from budgery.dataclasses import ImportBatch
 from budgery.db import crud, models
-from budgery.db.connection import connect, Session
+from budgery.db.connection import connect
 from budgery.db.models import Base
+from budgery.metrics import ImportMetrics
 from budgery.user import User
 
 LOGGER = logging.getLogger(__name__)
@@ -21,7 +41,7 @@ LOGGER = logging.getLogger(__name__)
 def _get_import_data(filename: str) -> List[Dict[str, str]]:
 	"Get the content of a test import file."
 	with open(Path("tests") / "import_data" / filename, "rb") as f:
-		return task._extract_rows(f)
+		return list(task._extract_rows(f))
 
 def test_everydollar_import():
 	"Test that we can handle an import from Every Dollar."
@@ -45,6 +65,237 @@ def test_america_first_credit_union():
 	assert content[10].amount == -100
 	assert content[20].at == datetime.datetime(2023, 1, 4)
 
+def test_amex_import():
+	content = _get_import_data("amex.xlsx")
+	assert len(content) == 14
+	assert content[0].account_id_is_from
+	assert content[0].amount == 8.61
+	assert content[10].description == "MOBILE PAYMENT - THANK YOU"
+	assert not content[10].account_id_is_from
+	assert content[10].amount == 2796.01
+
+def test_ofx_import():
+	content = _get_import_data("checking.ofx")
+	assert len(content) == 4
+	assert content[0].account_id_is_from
+	assert content[0].amount == 51.7
+	assert content[0].at == datetime.datetime(2023, 1, 14, 12, tzinfo=datetime.timezone(datetime.timedelta(hours=-7)))
+	assert content[0].description == "SMASHBURGER 1477"
+	assert content[0].extended_details == "CHANDLER AZ"
+	assert content[0].reference == "202301141"
+	assert content[1].description == "BARNES & NOBLE"
+	assert not content[3].account_id_is_from
+	assert content[3].at == datetime.datetime(2023, 1, 17)
+
+def test_qfx_import():
+	content = _get_import_data("credit-card.qfx")
+	assert [(r.account_id_is_from, r.amount, r.reference) for r in content] == [
+		(True, 58.2, "320230130001"),
+		(False, 200.0, "320230160001"),
+	]
+
+def test_ofx_import_read_in_pieces(monkeypatch):
+	"Test that tags split between reads are put back together."
+	expected = _get_import_data("checking.ofx") + _get_import_data("credit-card.qfx")
+	monkeypatch.setattr(budgery.ofx, "READ_SIZE", 7)
+	assert _get_import_data("checking.ofx") + _get_import_data("credit-card.qfx") == expected
+
+def test_csv_import_is_streamed():
+	"Test that CSV rows are produced without reading the whole file."
+	with open(Path("tests") / "import_data" / "afcu.csv", "rb") as f:
+		header = f.readline()
+		body = f.read()
+	content = io.BytesIO(header + body * 2000)
+	rows = task._extract_rows(content)
+	first = next(rows)
+	assert first.description == "PEER TO PEER TRANSFER S 866-224-2158;301400N0HYUG;2023-01-17;DR"
+	assert content.tell() < len(content.getvalue()) / 2
+
+def test_csv_import_parallel(monkeypatch, tmp_path):
+	"Test that parsing a CSV file in parallel gives the same rows in the same order."
+	monkeypatch.setattr(budgery.csv, "PARALLEL_MIN_SIZE", 0)
+	monkeypatch.setattr(budgery.csv, "PARALLEL_CHUNK_SIZE", 512)
+	with open(Path("tests") / "import_data" / "afcu.csv", "rb") as f:
+		header = f.readline()
+		body = f.read()
+	# Chunks that end inside a quoted field must be joined with the next.
+	body += b'"1/1/2023","","' + b"LINE\n" * 200 + b'","0.5",""\r\n'
+	# A quoted newline must not be treated as the end of a record.
+	body += b'"1/2/2023","","MULTI\nLINE","1.5",""\r\n'
+	# Records longer than a span must still be kept whole.
+	body += b'"1/3/2023","","' + b"LONG" * 200 + b'","2.5",""\r\n'
+	path = tmp_path / "large.csv"
+	path.write_bytes(header + body * 20)
+	serial = list(task._extract_rows(io.BytesIO(path.read_bytes())))
+	with open(path, "rb") as f:
+		parallel = list(task._extract_rows(f, workers=2))
+	assert len(parallel) == len(serial)
+	assert parallel == serial
+	assert parallel[-2].description == "MULTI\nLINE"
+	with open(path, "rb") as f:
+		batches = list(budgery.csv.extract_batches(f, workers=2, batch_size=7))
+	assert max(len(b) for b in batches) == 7
+	assert list(ImportBatch.rows(batches)) == serial
+
+@pytest.mark.parametrize("concurrency", [2, 6])
+def test_import_scheduler_bounds_concurrency(monkeypatch, concurrency):
+	"Test that however often the queue is asked to run, only so many jobs run at once."
+	queued = list(range(20))
+	running = []
+	most = 0
+	lock = threading.Lock()
+	def run_next_import_job(**kwargs):
+		nonlocal most
+		with lock:
+			if not queued:
+				return None
+			import_job_id = queued.pop()
+			running.append(import_job_id)
+			most = max(most, len(running))
+		time.sleep(0.05)
+		with lock:
+			running.remove(import_job_id)
+		return import_job_id
+	monkeypatch.setattr(task, "run_next_import_job", run_next_import_job)
+	scheduler = task.ImportScheduler()
+	async def run_many():
+		await asyncio.gather(*(scheduler.run(None, concurrency=concurrency) for _ in range(5)))
+	asyncio.run(run_many())
+	assert not queued
+	# The thread pool grows with the limit rather than holding it back.
+	assert most == concurrency
+	assert scheduler.running == 0
+
+def test_import_scheduler_survives_failures(monkeypatch):
+	"Test that a runner carries on with the queue after a job raises."
+	results = [3, RuntimeError("database went away"), 2, None]
+	def run_next_import_job(**kwargs):
+		result = results.pop(0)
+		if isinstance(result, Exception):
+			raise result
+		return result
+	monkeypatch.setattr(task, "run_next_import_job", run_next_import_job)
+	monkeypatch.setattr(task, "IMPORT_FAILURE_DELAY", 0)
+	scheduler = task.ImportScheduler()
+	asyncio.run(scheduler.run(None, concurrency=1))
+	assert not results
+	assert scheduler.running == 0
+
+def test_import_scheduler_backs_off(monkeypatch):
+	"Test that a runner waits longer after each failure in a row and gives up in the end."
+	calls = 0
+	def run_next_import_job(**kwargs):
+		nonlocal calls
+		calls += 1
+		raise RuntimeError("database went away")
+	delays = []
+	async def sleep(delay):
+		delays.append(delay)
+	monkeypatch.setattr(task, "run_next_import_job", run_next_import_job)
+	monkeypatch.setattr(task.asyncio, "sleep", sleep)
+	scheduler = task.ImportScheduler()
+	asyncio.run(scheduler.run(None, concurrency=1))
+	assert calls == task.IMPORT_MAX_FAILURES
+	assert delays == [task.IMPORT_FAILURE_DELAY * 2 ** i for i in range(task.IMPORT_MAX_FAILURES - 1)]
+	assert scheduler.running == 0
+
+def test_bulk_import_gives_up(monkeypatch):
+	"Test that importing from the command line stops once jobs keep failing."
+	calls = 0
+	def run_next_import_job(*args, **kwargs):
+		nonlocal calls
+		calls += 1
+		raise RuntimeError("database went away")
+	monkeypatch.setattr(task, "run_next_import_job", run_next_import_job)
+	monkeypatch.setattr(task, "IMPORT_FAILURE_DELAY", 0)
+	with pytest.raises(RuntimeError, match="Gave up"):
+		bulk_import.run_queued_imports(None, [1], concurrency=2)
+	assert task.IMPORT_MAX_FAILURES <= calls < 2 * task.IMPORT_MAX_FAILURES
+
+def test_archive_upload_never_replaces(tmp_path):
+	"Test that archiving uploads for jobs with the same ID keeps every archive."
+	archive_paths = []
+	for content in (b"first", b"second"):
+		upload_path = tmp_path / "upload"
+		upload_path.write_bytes(content)
+		archive_paths.append(task.archive_upload(str(upload_path), str(tmp_path / "archive"), 1))
+		assert not upload_path.exists()
+	assert archive_paths[0] != archive_paths[1]
+	assert [gzip.decompress(Path(p).read_bytes()) for p in archive_paths] == [b"first", b"second"]
+
+def test_replay_diff_ignores_timezones():
+	"Test that parsed times with a timezone match the stored times without one."
+	at = datetime.datetime(2023, 5, 1, 12, 30)
+	offset = datetime.timezone(datetime.timedelta(hours=-7))
+	corrections = replay.diff_transactions(
+		[(1, "old", at, "Coffee"), (2, "old", at, "Tea")],
+		[
+			{"fingerprint": "new", "at": at.replace(tzinfo=offset), "description": description}
+			for description in ("Tea", "Coffee")
+		],
+	)
+	assert sorted((u["id"], u["description"]) for u in corrections.updates) == [(1, "Coffee"), (2, "Tea")]
+	assert corrections.inserts == []
+	assert corrections.delete_ids == []
+
+def test_csv_known_format_skips_sniffer(monkeypatch):
+	"Test that known formats are recognised by their header and others are sniffed once."
+	monkeypatch.setattr(budgery.csv, "_DIALECT_CACHE", {})
+	sniffs = []
+	sniff = csv.Sniffer.sniff
+	def counting_sniff(self, sample, delimiters=None):
+		sniffs.append(sample)
+		return sniff(self, sample, delimiters)
+	monkeypatch.setattr(csv.Sniffer, "sniff", counting_sniff)
+	assert len(_get_import_data("afcu.csv")) == 31
+	assert not sniffs
+
+	with open(Path("tests") / "import_data" / "ally.csv", "rb") as f:
+		content = f.read().replace(b",", b";")
+	expected = _get_import_data("ally.csv")
+	for i in range(2):
+		rows = list(budgery.csv.extract_rows(io.BytesIO(content)))
+		assert [r.amount for r in rows] == [r.amount for r in expected]
+	assert len(sniffs) == 1
+
+def test_preview_reads_only_the_start():
+	"Test that previewing a large file parses just the first rows."
+	with open(Path("tests") / "import_data" / "afcu.csv", "rb") as f:
+		header = f.readline()
+		body = f.read()
+	content = io.BytesIO(header + body * 2000)
+	preview = task.preview_upload(content, limit=5)
+	assert preview.error is None
+	assert preview.file_type == "CSV text"
+	assert preview.rows == _get_import_data("afcu.csv")[:5]
+	assert content.tell() < len(content.getvalue()) / 10
+
+	bad = io.BytesIO(header.replace(b"Debit", b"Withdrawal") + body)
+	preview = task.preview_upload(bad)
+	assert preview.error.startswith("No header pattern found")
+	assert preview.rows == []
+
+def test_import_batch_round_trip():
+	"Test that rows packed into a batch come back out unchanged."
+	rows = _get_import_data("every_dollar.csv") + _get_import_data("amex.xlsx")
+	batches = list(ImportBatch.batched(rows, 5))
+	assert [len(b) for b in batches] == [5, 5, 5, 5, 2]
+	assert list(ImportBatch.rows(pickle.loads(pickle.dumps(batches)))) == rows
+	assert batches[0][0].at.utcoffset() == datetime.timedelta(hours=-6)
+
+def test_import_metrics_exclude_nested_stages():
+	"Test that time spent in a nested stage is not counted for the outer stage too."
+	metrics = ImportMetrics()
+	with metrics.stage("outer"):
+		with metrics.stage("inner"):
+			pass
+	rows = list(metrics.timed("rows", [[1, 2], [3]], count=len))
+	assert rows == [[1, 2], [3]]
+	assert list(metrics.stages) == ["outer", "inner", "rows"]
+	assert metrics.stages["rows"].rows == 3
+	assert metrics.stages["inner"].seconds > 0
+	assert metrics.stages["outer"].seconds >= 0
+
 def test_american_express():
 	content = _get_import_data("amex.xlsx")
 	assert len(content) == 14
@@ -55,18 +306,17 @@ def test_american_express():
 class TestImport(unittest.IsolatedAsyncioTestCase):
 	def setUp(self):
 		logging.basicConfig(level=logging.INFO)
-		config = Config("test.env")
+		config = get_config()
 		self.config = config
-		def get_config_override() -> Config:
-			return config
-		app.dependency_overrides[get_config] = get_config_override
 		engine = connect(config)
+		Base.metadata.drop_all(engine)
 		Base.metadata.create_all(engine)
+		crud.SOURCINK_RESOLVER.invalidate()
+		self.engine = engine
 		self.db = Session(engine)
 
-	async def test_import_amex_csv(self):
-		filename = "tests/import_data/amex.xlsx"
-		import_file = open(filename, "rb")
+	def _create_import_job(self, filename: str) -> models.ImportJob:
+		"Create a user, account and import job to import into."
 		user = User(
 			auth_time=datetime.datetime.utcnow(),
 			email=None,
@@ -80,6 +330,7 @@ class TestImport(unittest.IsolatedAsyncioTestCase):
 		)
 		db_user = crud.user_ensure_exists(self.db, user)
 		assert db_user
+		self.user = user
 		institution = crud.institution_create(
 			db=self.db,
 			user=db_user,
@@ -99,25 +350,801 @@ class TestImport(unittest.IsolatedAsyncioTestCase):
 			user=db_user,
 		)
 		assert import_job.account_id == account.id
+		return import_job
+
+	async def test_import_amex_csv(self):
+		filename = "tests/import_data/amex.xlsx"
+		import_file = open(filename, "rb")
+		import_job = self._create_import_job(filename)
 		await task.process_transaction_upload(
 			import_file=import_file,
+			db_engine=self.engine,
+			import_job_id=import_job.id,
+		)
+		self.db.expire_all()
+		import_job = crud.import_job_get_by_id(
+			db=self.db,
+			user=import_job.user,
+			import_job_id=import_job.id,
+		)
+		assert import_job.status == models.ImportJobStatus.finished
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=import_job.id,
+		)
+		assert len(transactions) == 14
+
+	async def test_import_chunked(self):
+		"Test that a chunk size smaller than the file still imports every row."
+		filename = "tests/import_data/afcu.csv"
+		import_file = open(filename, "rb")
+		import_job = self._create_import_job(filename)
+		await task.process_transaction_upload(
+			import_file=import_file,
+			db_engine=self.engine,
+			import_job_id=import_job.id,
+			chunk_size=4,
+		)
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=import_job.id,
+		)
+		assert len(transactions) == len(_get_import_data("afcu.csv"))
+		assert all(t.import_job_id == import_job.id for t in transactions)
+		assert all(t.sourcink_from.name == "Unknown" for t in transactions)
+
+	async def test_import_bad_row_writes_nothing(self):
+		"Test that a file that fails partway through leaves none of its rows behind."
+		with open("tests/import_data/afcu.csv", "rb") as f:
+			lines = f.readlines()
+		lines.insert(20, b'"1/1/2023","","Bad row","lots",""\n')
+		import_job = self._create_import_job("bad-afcu.csv")
+		await task.process_transaction_upload(
+			import_file=io.BytesIO(b"".join(lines)),
+			db_engine=self.engine,
+			import_job_id=import_job.id,
+			chunk_size=4,
+		)
+		self.db.expire_all()
+		assert import_job.status == models.ImportJobStatus.error
+		assert import_job.error == models.ImportJobError.FAILED_PARSING_FILE
+		assert crud.transaction_list_by_import_job(db=self.db, import_job_id=import_job.id) == []
+
+	async def test_import_sourcink_names(self):
+		"Test that sourcinks named in the file are created once and reused."
+		filename = "tests/import_data/every_dollar.csv"
+		import_job = self._create_import_job(filename)
+		for _ in range(2):
+			with open(filename, "rb") as import_file:
+				await task.process_transaction_upload(
+					import_file=import_file,
+					db_engine=self.engine,
+					import_job_id=import_job.id,
+				)
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=import_job.id,
+		)
+		rows = _get_import_data("every_dollar.csv")
+		# Transactions on the same day may be listed in any order.
+		assert sorted((t.amount, t.sourcink_from.name, t.sourcink_to.name) for t in transactions) == sorted(
+			(r.amount, r.sourcink_from, r.sourcink_to) for r in rows)
+		names = [s.name for s in crud.sourcink_list(self.db, None)]
+		assert len(names) == len(set(names))
+
+		crud.SOURCINK_RESOLVER.invalidate()
+		transaction = next(t for t in transactions if t.amount == rows[0].amount)
+		sourcink = crud.sourcink_get_or_create(self.db, rows[0].sourcink_to)
+		assert sourcink.id == transaction.sourcink_id_to
+
+	def test_account_sourcinks_are_not_shared(self):
+		"Test that accounts with the same name as each other or an imported sourcink each get their own."
+		import_job = self._create_import_job("placeholder.csv")
+		imported = crud.sourcink_get_or_create(self.db, "Checking")
+		accounts = [crud.account_create(
+			db=self.db,
+			institution_id=import_job.account.institution_id,
+			name="Checking",
+			user=import_job.user,
+		) for _ in range(2)]
+		sourcinks = [s for s in crud.sourcink_list(self.db, None) if s.name == "Checking"]
+		assert sorted((s.account_id or 0) for s in sourcinks) == sorted([0] + [a.id for a in accounts])
+		crud.SOURCINK_RESOLVER.invalidate()
+		assert crud.sourcink_get_or_create(self.db, "Checking").id == imported.id
+
+	async def test_import_records_stages(self):
+		"Test that the time spent in each stage of an import is saved on the job."
+		filename = "tests/import_data/afcu.csv"
+		import_file = open(filename, "rb")
+		import_job = self._create_import_job(filename)
+		await task.process_transaction_upload(
+			import_file=import_file,
+			db_engine=self.engine,
+			import_job_id=import_job.id,
+			chunk_size=4,
+		)
+		self.db.expire_all()
+		row_count = len(_get_import_data("afcu.csv"))
+		assert import_job.row_count == row_count
+		assert 0 <= import_job.date_cache_hit_rate <= 1
+		stages = {s.name: s for s in import_job.stages}
+		assert list(stages) == ["sourcink", "detect", "prepare", "parse", "sniff", "dedup", "insert"]
+		assert stages["parse"].rows == row_count
+		assert stages["insert"].rows == row_count
+		assert all(s.seconds >= 0 for s in import_job.stages)
+
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client:
+			response = client.get(f"/import-job/{import_job.id}")
+		assert response.status_code == 200
+		assert "Rows per second" in response.text
+
+	async def test_transaction_list_responsive_during_import(self):
+		"Test that requests are still served while a large import runs."
+		with open(Path("tests") / "import_data" / "afcu.csv", "rb") as f:
+			header = f.readline()
+			body = f.read()
+		import_file = io.BytesIO(header + body * 2000)
+		import_job = self._create_import_job("large-afcu.csv")
+		import_task = asyncio.create_task(task.process_transaction_upload(
+			import_file=import_file,
+			db_engine=self.engine,
+			import_job_id=import_job.id,
+		))
+		async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+			response = await client.get("/transaction")
+		# The client doesn't run the app's lifespan, which would dispose of this.
+		await get_async_db_engine(config=self.config).dispose()
+		assert response.status_code == 200
+		assert not import_task.done()
+		await import_task
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=import_job.id,
+		)
+		assert len(transactions) > 2000
+
+	async def test_reimport_skips_existing(self):
+		"Test that importing an overlapping file again doesn't duplicate transactions."
+		filename = "tests/import_data/afcu.csv"
+		expected = len(_get_import_data("afcu.csv"))
+		first_job = self._create_import_job(filename)
+		with open(filename, "rb") as f:
+			# Repeated rows within one file are all real transactions.
+			content = f.read()
+			doubled = content + content[content.index(b"\n") + 1:]
+		await task.process_transaction_upload(
+			import_file=io.BytesIO(doubled),
+			db_engine=self.engine,
+			import_job_id=first_job.id,
+		)
+		second_job = crud.import_job_create(
+			account_id=first_job.account_id,
 			db=self.db,
 			filename=filename,
-			import_job=import_job,
-			user=user,
+			user=first_job.user,
 		)
-		import_job = crud.import_job_get_by_id(
+		await task.process_transaction_upload(
+			import_file=io.BytesIO(content),
+			db_engine=self.engine,
+			import_job_id=second_job.id,
+		)
+		self.db.expire_all()
+		assert len(crud.transaction_list_by_import_job(db=self.db, import_job_id=first_job.id)) == expected * 2
+		assert crud.transaction_list_by_import_job(db=self.db, import_job_id=second_job.id) == []
+		assert second_job.status == models.ImportJobStatus.finished
+		assert second_job.skipped_count == expected
+
+	async def test_reimport_ofx_matches_fitid(self):
+		"Test that OFX transactions are matched by FITID even if their details change."
+		with open(Path("tests") / "import_data" / "checking.ofx", "rb") as f:
+			content = f.read()
+		import_job = self._create_import_job("checking.ofx")
+		for data in (content, content.replace(b"SMASHBURGER 1477", b"SMASHBURGER #1477")):
+			await task.process_transaction_upload(
+				import_file=io.BytesIO(data),
+				db_engine=self.engine,
+				import_job_id=import_job.id,
+			)
+		self.db.expire_all()
+		assert import_job.skipped_count == 4
+		transactions = crud.transaction_list_by_import_job(
 			db=self.db,
-			user=db_user,
 			import_job_id=import_job.id,
 		)
+		assert len(transactions) == 4
+
+	def test_import_preview_keeps_only_confirmable_uploads(self):
+		"Test that previews with nothing to confirm don't keep the upload and old previews expire."
+		placeholder = self._create_import_job("placeholder.csv")
+		with open("tests/import_data/ally.csv", "rb") as f:
+			ally = f.read()
+		directory = self.config("IMPORT_UPLOAD_DIRECTORY")
+		os.makedirs(directory, exist_ok=True)
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client:
+			spooled_before = set(os.listdir(directory))
+			response = client.post(
+				"/import-job/preview",
+				data={"account_id": placeholder.account_id},
+				files={"import_file": ("statement.pdf", b"%PDF-1.4\n", "application/pdf")},
+			)
+			assert "Failed to read the file" in response.text
+			assert "upload_token" not in response.text
+			assert set(os.listdir(directory)) == spooled_before
+			response = client.post(
+				"/import-job/create",
+				data={"account_id": placeholder.account_id},
+				files={"import_file": ("ally.csv", ally, "text/csv")},
+				follow_redirects=False,
+			)
+			existing = response.headers["location"]
+			spooled_before = set(os.listdir(directory))
+			response = client.post(
+				"/import-job/preview",
+				data={"account_id": placeholder.account_id},
+				files={"import_file": ("ally.csv", ally, "text/csv")},
+			)
+			assert f'href="{existing}"' in response.text
+			assert "upload_token" not in response.text
+			assert set(os.listdir(directory)) == spooled_before
+
+		with open("tests/import_data/afcu.csv", "rb") as f:
+			abandoned = task.spool_upload(f, directory).path
+		with open("tests/import_data/afcu.csv", "rb") as f:
+			fresh = task.spool_upload(f, directory).path
+		with open("tests/import_data/afcu.csv", "rb") as f:
+			queued = task.spool_upload(f, directory).path
+		placeholder.upload_path = queued
+		self.db.commit()
+		long_ago = time.time() - 2 * task.IMPORT_PREVIEW_MAX_AGE.total_seconds()
+		for path in (abandoned, queued):
+			os.utime(path, (long_ago, long_ago))
+		assert task.remove_stale_uploads(self.engine, directory) == 1
+		assert not os.path.exists(abandoned)
+		assert os.path.exists(fresh)
+		assert os.path.exists(queued)
+
+	async def test_import_ofx_repeated_fitid(self):
+		"Test that a FITID repeated within a file is imported once wherever the chunks fall."
+		with open(Path("tests") / "import_data" / "checking.ofx", "rb") as f:
+			content = f.read()
+		start = content.index(b"<STMTTRN>")
+		end = content.index(b"</STMTTRN>") + len(b"</STMTTRN>")
+		content = content[:end] + content[start:end] + content[end:]
+		for chunk_size in (1, 2, 10):
+			import_job = self._create_import_job(f"repeated-{chunk_size}.ofx")
+			await task.process_transaction_upload(
+				import_file=io.BytesIO(content),
+				db_engine=self.engine,
+				import_job_id=import_job.id,
+				chunk_size=chunk_size,
+			)
+			self.db.expire_all()
+			assert import_job.status == models.ImportJobStatus.finished, chunk_size
+			assert import_job.skipped_count == 1
+			assert len(crud.transaction_list_by_import_job(db=self.db, import_job_id=import_job.id)) == 4
+			crud.transaction_delete_by_import_job(self.db, import_job.id)
+
+	def test_import_preview_then_confirm(self):
+		"Test that a previewed upload is imported without being uploaded again."
+		placeholder = self._create_import_job("placeholder.csv")
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client, open("tests/import_data/ally.csv", "rb") as f:
+			response = client.post(
+				"/import-job/preview",
+				data={"account_id": placeholder.account_id},
+				files={"import_file": ("ally.csv", f, "text/csv")},
+			)
+			assert response.status_code == 200
+			assert "SMASHBURGER" in response.text
+			token = re.search(r'name="upload_token" value="([0-9a-f]+)"', response.text).group(1)
+			assert crud.import_job_list(self.db, placeholder.user) == [placeholder]
+
+			responses = [client.post(
+				"/import-job/create",
+				data={"account_id": placeholder.account_id, "filename": "ally.csv", "upload_token": token},
+				follow_redirects=False,
+			) for _ in range(2)]
+			# Sending the form again goes to the job the first send created.
+			assert [r.status_code for r in responses] == [303, 303]
+			assert responses[0].headers["location"] == responses[1].headers["location"]
+			response = client.post(
+				"/import-job/create",
+				data={"account_id": placeholder.account_id, "filename": "x", "upload_token": "../test.env"},
+				follow_redirects=False,
+			)
+			assert response.status_code == 400
+		self.db.expire_all()
+		jobs = {j.filename: j for j in crud.import_job_list(self.db, placeholder.user)}
+		assert len(jobs) == 2
+		assert jobs["ally.csv"].status == models.ImportJobStatus.finished
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=jobs["ally.csv"].id,
+		)
+		assert len(transactions) == len(_get_import_data("ally.csv"))
+
+	def test_same_spooled_upload_queued_twice(self):
+		"Test that hashing a queued job's own upload again finds the job and leaves its file alone."
+		placeholder = self._create_import_job("placeholder.csv")
+		with open("tests/import_data/ally.csv", "rb") as f:
+			upload = task.spool_upload(f, self.config("IMPORT_UPLOAD_DIRECTORY"))
+		db_user = crud.user_get_by_username(self.db, self.user.username)
+		import_job, created = task.import_job_create_for_upload(self.db, placeholder.account_id, "ally.csv", upload, db_user)
+		assert created
+		again, created = task.import_job_create_for_upload(
+			self.db,
+			placeholder.account_id,
+			"ally.csv",
+			task.hash_spooled_upload(upload.path),
+			db_user,
+		)
+		assert not created
+		assert again.id == import_job.id
+		assert os.path.exists(upload.path)
+
+	def test_identical_upload_reuses_job(self):
+		"Test that uploading the same file to the same account again goes to the first job."
+		placeholder = self._create_import_job("placeholder.csv")
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with open("tests/import_data/afcu.csv", "rb") as f:
+			content = f.read()
+		directory = self.config("IMPORT_UPLOAD_DIRECTORY")
+		os.makedirs(directory, exist_ok=True)
+		spooled_before = set(os.listdir(directory))
+		with TestClient(app) as client:
+			locations = []
+			for data in (content, content, content + b"\r\n"):
+				response = client.post(
+					"/import-job/create",
+					data={"account_id": placeholder.account_id},
+					files={"import_file": ("afcu.csv", data, "text/csv")},
+					follow_redirects=False,
+				)
+				assert response.status_code == 303
+				locations.append(response.headers["location"])
+		assert locations[0] == locations[1]
+		assert locations[0] != locations[2]
+		self.db.expire_all()
+		jobs = [j for j in crud.import_job_list(self.db, placeholder.user) if j.filename == "afcu.csv"]
+		assert len(jobs) == 2
+		assert jobs[0].content_size == len(content)
+		assert jobs[0].content_sha256 == hashlib.sha256(content).hexdigest()
+		# Both imports finished and the duplicate upload was never kept.
+		assert set(os.listdir(directory)) == spooled_before
+
+	def test_import_queue(self):
+		"Test that a queued job is claimed, imported and its upload removed."
+		filename = "tests/import_data/ally.csv"
+		with open(filename, "rb") as f:
+			upload_path = task.spool_upload(f, self.config("IMPORT_UPLOAD_DIRECTORY")).path
+		import_job = self._create_import_job(filename)
+		import_job.upload_path = upload_path
+		self.db.commit()
+		assert import_job.status == models.ImportJobStatus.queued
+
+		assert task.run_next_import_job(self.engine, worker_id="test-worker") == import_job.id
+		assert task.run_next_import_job(self.engine, worker_id="test-worker") is None
+		self.db.expire_all()
 		assert import_job.status == models.ImportJobStatus.finished
+		assert import_job.attempts == 1
+		assert import_job.lease_owner is None
+		assert not os.path.exists(upload_path)
 		transactions = crud.transaction_list_by_import_job(
 			db=self.db,
 			import_job_id=import_job.id,
 		)
+		assert len(transactions) == 5
+
+	def test_import_queue_unreadable_files(self):
+		"Test that files that can't be imported fail their job at once instead of waiting out the lease."
+		contents = {
+			"statement.pdf": b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n",
+			"unknown.csv": b'"When","What","How much"\n"1/1/2023","Coffee","4.50"\n',
+		}
+		import_jobs = []
+		for filename, content in contents.items():
+			import_job = self._create_import_job(filename)
+			import_job.upload_path = task.spool_upload(io.BytesIO(content), self.config("IMPORT_UPLOAD_DIRECTORY")).path
+			self.db.commit()
+			import_jobs.append(import_job)
+		for import_job in import_jobs:
+			assert task.run_next_import_job(self.engine, worker_id="test-worker") == import_job.id
+		self.db.expire_all()
+		for import_job in import_jobs:
+			assert import_job.status == models.ImportJobStatus.error
+			assert import_job.error == models.ImportJobError.FAILED_PARSING_FILE
+			assert import_job.lease_owner is None
+			assert import_job.attempts == 1
+
+	def test_import_queue_database_error_is_retried(self):
+		"Test that a job whose import hits a database error is left for its lease to lapse, not failed."
+		import_job = self._create_import_job("ally.csv")
+		with open("tests/import_data/ally.csv", "rb") as f:
+			upload_path = task.spool_upload(f, self.config("IMPORT_UPLOAD_DIRECTORY")).path
+		import_job.upload_path = upload_path
+		self.db.commit()
+		def locked(*args, **kwargs):
+			raise OperationalError("INSERT", {}, Exception("database is locked"))
+		with unittest.mock.patch.object(crud, "transaction_bulk_create", locked):
+			with self.assertRaises(OperationalError):
+				task.run_next_import_job(self.engine, worker_id="test-worker")
+		self.db.expire_all()
+		assert import_job.status == models.ImportJobStatus.started
+		assert import_job.lease_owner == "test-worker"
+		assert import_job.error == models.ImportJobError.NONE
+		assert os.path.exists(upload_path)
+
+	def test_import_queue_polled_at_startup(self):
+		"Test that the server runs jobs left queued or abandoned while it was down."
+		stranded = self._create_import_job("ally.csv")
+		abandoned = self._create_import_job("afcu.csv")
+		for import_job in (stranded, abandoned):
+			with open(Path("tests") / "import_data" / import_job.filename, "rb") as f:
+				import_job.upload_path = task.spool_upload(f, self.config("IMPORT_UPLOAD_DIRECTORY")).path
+		abandoned.attempts = 1
+		abandoned.lease_expires = datetime.datetime.now() - datetime.timedelta(minutes=1)
+		abandoned.lease_owner = "dead-worker"
+		abandoned.status = models.ImportJobStatus.started
+		self.db.commit()
+		with TestClient(app):
+			deadline = time.monotonic() + 30
+			while time.monotonic() < deadline:
+				self.db.expire_all()
+				if all(j.status == models.ImportJobStatus.finished for j in (stranded, abandoned)):
+					break
+				time.sleep(0.05)
+		assert stranded.status == models.ImportJobStatus.finished
+		assert abandoned.status == models.ImportJobStatus.finished
+		assert abandoned.attempts == 2
+
+	def test_import_replay(self):
+		"Test that replaying an archived import corrects its transactions in place."
+		filename = "tests/import_data/amex.xlsx"
+		archive_directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, archive_directory)
+		with open(filename, "rb") as f:
+			content = f.read()
+		upload_path = task.spool_upload(io.BytesIO(content), self.config("IMPORT_UPLOAD_DIRECTORY")).path
+		import_job = self._create_import_job(filename)
+		import_job.upload_path = upload_path
+		self.db.commit()
+		task.run_next_import_job(self.engine, worker_id="test-worker", archive_directory=archive_directory)
+		self.db.expire_all()
+		assert import_job.upload_path is None
+		assert not os.path.exists(upload_path)
+		with gzip.open(import_job.archive_path, "rb") as f:
+			assert f.read() == content
+
+		# Make the job look like it was imported by an older parser that treated
+		# payments as charges and missed a row.
+		transactions = crud.transaction_list_by_import_job(self.db, import_job.id)
+		payment = next(t for t in transactions if t.amount == 2796.01)
+		payment.account_id_from, payment.account_id_to = payment.account_id_to, None
+		payment.fingerprint = "stale"
+		payment.category = "Credit Card Payment"
+		missed = next(t for t in transactions if t is not payment)
+		self.db.delete(missed)
+		self.db.commit()
+
+		# A dry run reports the same changes without making any, not even
+		# creating sourcinks the file needs.
+		unknown = crud.sourcink_get_or_create(self.db, task.UNKNOWN_SOURCINK)
+		unknown.name = "Renamed"
+		self.db.commit()
+		crud.SOURCINK_RESOLVER.invalidate()
+		sourcink_count = len(crud.sourcink_list(self.db, None))
+		results = replay.replay(self.engine, [import_job.id], dry_run=True)
+		assert results == [replay.ReplayResult(
+			import_job_id=import_job.id,
+			unchanged=12,
+			updated=1,
+			inserted=1,
+		)]
+		self.db.expire_all()
+		assert len(crud.sourcink_list(self.db, None)) == sourcink_count
+		assert payment.fingerprint == "stale"
+		unknown.name = task.UNKNOWN_SOURCINK
+		self.db.commit()
+		crud.SOURCINK_RESOLVER.invalidate()
+
+		results = replay.replay(self.engine, [import_job.id])
+		assert results == [replay.ReplayResult(
+			import_job_id=import_job.id,
+			unchanged=12,
+			updated=1,
+			inserted=1,
+		)]
+		self.db.expire_all()
+		assert payment.account_id_to == import_job.account_id
+		assert payment.account_id_from is None
+		assert payment.category == "Credit Card Payment"
+		transactions = crud.transaction_list_by_import_job(self.db, import_job.id)
 		assert len(transactions) == 14
+		assert all(t.fingerprint != "stale" for t in transactions)
+
+		results = replay.replay(self.engine, [import_job.id])
+		assert results == [replay.ReplayResult(import_job_id=import_job.id, unchanged=14)]
+
+	def test_import_retry_failed_job(self):
+		"Test that a failed job keeps its upload and can be run again."
+		with open(Path("tests") / "import_data" / "afcu.csv", "rb") as f:
+			content = f.read()
+		bad = content.replace(b'"1/15/2023"', b'"not a date"', 1)
+		upload_path = task.spool_upload(io.BytesIO(bad), self.config("IMPORT_UPLOAD_DIRECTORY")).path
+		import_job = self._create_import_job("afcu.csv")
+		import_job.upload_path = upload_path
+		self.db.commit()
 
+		assert task.run_next_import_job(self.engine, worker_id="test-worker") == import_job.id
+		self.db.expire_all()
+		assert import_job.status == models.ImportJobStatus.error
+		assert os.path.exists(upload_path)
+
+		with open(upload_path, "wb") as f:
+			f.write(content)
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client:
+			response = client.post(f"/import-job/{import_job.id}/retry", follow_redirects=False)
+		assert response.status_code == 303
+		self.db.expire_all()
+		assert import_job.status == models.ImportJobStatus.finished
+		assert import_job.error == models.ImportJobError.NONE
+		assert import_job.attempts == 1
+		assert not os.path.exists(upload_path)
+		transactions = crud.transaction_list_by_import_job(
+			db=self.db,
+			import_job_id=import_job.id,
+		)
+		assert len(transactions) == len(_get_import_data("afcu.csv"))
+
+	def test_bulk_import_directory(self):
+		"Test that a directory of files is imported into the right accounts without HTTP."
+		placeholder = self._create_import_job("placeholder.csv")
+		account_id = placeholder.account_id
+		other = crud.account_create(
+			db=self.db,
+			institution_id=placeholder.account.institution_id,
+			name="other-account",
+			user=placeholder.user,
+		)
+		directory = Path(tempfile.mkdtemp())
+		self.addCleanup(shutil.rmtree, directory)
+		(directory / "2023").mkdir()
+		(directory / ".cache").mkdir()
+		shutil.copy("tests/import_data/afcu.csv", directory / "2023")
+		shutil.copy("tests/import_data/ally.csv", directory / "2023")
+		shutil.copy("tests/import_data/amex.xlsx", directory)
+		shutil.copy("tests/import_data/ally.csv", directory / ".cache")
+		rows = {name: len(_get_import_data(name)) for name in ("afcu.csv", "ally.csv", "amex.xlsx")}
+
+		summary = bulk_import.import_directory(
+			self.engine,
+			directory=directory,
+			username=self.user.username,
+			upload_directory=self.config("IMPORT_UPLOAD_DIRECTORY"),
+			account_id=account_id,
+			mapping={"2023/ally.csv": other.id},
+			concurrency=2,
+			chunk_size=7,
+		)
+		assert summary.files == 3
+		assert summary.finished == 3
+		assert summary.failed == 0
+		assert summary.rows == sum(rows.values())
+		assert summary.stages["insert"][0] == sum(rows.values())
+		self.db.expire_all()
+		jobs = {j.filename: j for j in crud.import_job_list(self.db, placeholder.user)}
+		assert jobs["ally.csv"].account_id == other.id
+		assert jobs["afcu.csv"].account_id == account_id
+		for filename, count in rows.items():
+			assert len(crud.transaction_list_by_import_job(self.db, jobs[filename].id)) == count
+
+		summary = bulk_import.import_directory(
+			self.engine,
+			directory=directory,
+			username=self.user.username,
+			upload_directory=self.config("IMPORT_UPLOAD_DIRECTORY"),
+			account_id=account_id,
+			mapping={"2023/ally.csv": other.id},
+		)
+		assert summary.duplicates == 3
+		assert summary.finished == 0
+
+		with self.assertRaises(ValueError):
+			bulk_import.import_directory(
+				self.engine,
+				directory=directory,
+				username=self.user.username,
+				upload_directory=self.config("IMPORT_UPLOAD_DIRECTORY"),
+			)
+
+	def test_import_queue_full(self):
+		"Test that uploads are turned away once the queue is full."
+		environ = unittest.mock.patch.dict(os.environ, {"IMPORT_QUEUE_DEPTH": "2", "IMPORT_IN_PROCESS": "false"})
+		environ.start()
+		self.addCleanup(environ.stop)
+		get_config.cache_clear()
+		waiting = self._create_import_job("waiting.csv")
+		directory = self.config("IMPORT_UPLOAD_DIRECTORY")
+		os.makedirs(directory, exist_ok=True)
+		spooled_before = set(os.listdir(directory))
+		archive = io.BytesIO()
+		with zipfile.ZipFile(archive, "w") as z:
+			z.write("tests/import_data/afcu.csv", "afcu.csv")
+			z.write("tests/import_data/ally.csv", "ally.csv")
+		with open("tests/import_data/ally.csv", "rb") as f:
+			ally = f.read()
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client:
+			page = client.get(f"/import-job/{waiting.id}")
+			assert "number 1 in the queue" in page.text
+			# The archive holds more files than there is room for.
+			response = client.post(
+				"/import-job/create-many",
+				data={"account_id": waiting.account_id},
+				files=[("import_files", ("statements.zip", archive.getvalue(), "application/zip"))],
+				follow_redirects=False,
+			)
+			assert response.status_code == 503
+			assert set(os.listdir(directory)) == spooled_before
+			responses = [client.post(
+				"/import-job/create",
+				data={"account_id": waiting.account_id},
+				files={"import_file": (f"ally-{i}.csv", ally + b"\n" * i, "text/csv")},
+				follow_redirects=False,
+			) for i in range(2)]
+			assert [r.status_code for r in responses] == [303, 503]
+			assert responses[1].headers["Retry-After"] == "60"
+		self.db.expire_all()
+		jobs = crud.import_job_list(self.db, waiting.user)
+		assert [j.filename for j in jobs] == ["waiting.csv", "ally-0.csv"]
+		assert all(j.status == models.ImportJobStatus.queued for j in jobs)
+
+	def test_import_queue_full_for_user(self):
+		"Test that a user with too many imports waiting is turned away while others can still import."
+		environ = unittest.mock.patch.dict(os.environ, {"IMPORT_QUEUE_DEPTH_PER_USER": "1", "IMPORT_IN_PROCESS": "false"})
+		environ.start()
+		self.addCleanup(environ.stop)
+		get_config.cache_clear()
+		waiting = self._create_import_job("waiting.csv")
+		other = User(
+			auth_time=datetime.datetime.utcnow(),
+			email=None,
+			email_verified=False,
+			expiration=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+			family_name="Tester",
+			given_name="Alice",
+			name="Alice Tester",
+			disabled=False,
+			username="alicetester",
+		)
+		other_account = crud.account_create(
+			db=self.db,
+			institution_id=waiting.account.institution_id,
+			name="other-account",
+			user=crud.user_ensure_exists(self.db, other),
+		)
+		with open("tests/import_data/ally.csv", "rb") as f:
+			ally = f.read()
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		responses = []
+		with TestClient(app) as client:
+			for user, account_id in ((self.user, waiting.account_id), (other, other_account.id)):
+				app.dependency_overrides[get_user] = lambda: user
+				responses.append(client.post(
+					"/import-job/create",
+					data={"account_id": account_id},
+					files={"import_file": ("ally.csv", ally, "text/csv")},
+					follow_redirects=False,
+				))
+		assert [r.status_code for r in responses] == [429, 303]
+		assert responses[0].headers["Retry-After"] == "60"
+
+	def test_import_many_files(self):
+		"Test that files uploaded together and in ZIP archives each get a job in their account."
+		placeholder = self._create_import_job("placeholder.csv")
+		account_id = placeholder.account_id
+		other = crud.account_create(
+			db=self.db,
+			institution_id=placeholder.account.institution_id,
+			name="other-account",
+			user=placeholder.user,
+		)
+		archive = io.BytesIO()
+		with zipfile.ZipFile(archive, "w") as z:
+			z.write("tests/import_data/afcu.csv", "statements/afcu.csv")
+			z.write("tests/import_data/ally.csv", "statements/ally.csv")
+			z.writestr("__MACOSX/statements/._ally.csv", b"junk")
+		with open("tests/import_data/amex.xlsx", "rb") as f:
+			amex = f.read()
+		app.dependency_overrides[get_user] = lambda: self.user
+		self.addCleanup(app.dependency_overrides.pop, get_user)
+		with TestClient(app) as client:
+			response = client.post(
+				"/import-job/create-many",
+				data={"account_id": account_id, "account_mapping": f"ally.csv = {other.id}\n"},
+				files=[
+					("import_files", ("statements.zip", archive.getvalue(), "application/zip")),
+					("import_files", ("amex.xlsx", amex, "application/octet-stream")),
+				],
+				follow_redirects=False,
+			)
+			assert response.status_code == 303
+			bad = client.post(
+				"/import-job/create-many",
+				data={"account_mapping": "nonsense"},
+				files=[("import_files", ("afcu.csv", b"", "text/csv"))],
+				follow_redirects=False,
+			)
+			assert bad.status_code == 400
+		self.db.expire_all()
+		jobs = {j.filename: j for j in crud.import_job_list(self.db, placeholder.user)}
+		assert set(jobs) == {"placeholder.csv", "afcu.csv", "ally.csv", "amex.xlsx"}
+		expected = {
+			"afcu.csv": (account_id, len(_get_import_data("afcu.csv"))),
+			"ally.csv": (other.id, len(_get_import_data("ally.csv"))),
+			"amex.xlsx": (account_id, len(_get_import_data("amex.xlsx"))),
+		}
+		for filename, (expected_account_id, count) in expected.items():
+			job = jobs[filename]
+			assert job.status == models.ImportJobStatus.finished, filename
+			assert job.account_id == expected_account_id
+			assert len(crud.transaction_list_by_import_job(db=self.db, import_job_id=job.id)) == count
+
+	def test_import_queue_expired_lease(self):
+		"Test that a job whose worker let its lease lapse is claimed again."
+		import_job = self._create_import_job("expired.csv")
+		claimed = crud.import_job_claim(
+			db=self.db,
+			lease_duration=datetime.timedelta(minutes=5),
+			max_attempts=2,
+			worker_id="worker-1",
+		)
+		assert claimed.id == import_job.id
+		assert crud.import_job_claim(
+			db=self.db,
+			lease_duration=datetime.timedelta(minutes=5),
+			max_attempts=2,
+			worker_id="worker-2",
+		) is None
+
+		import_job.lease_expires = datetime.datetime.now() - datetime.timedelta(seconds=1)
+		self.db.commit()
+		claimed = crud.import_job_claim(
+			db=self.db,
+			lease_duration=datetime.timedelta(minutes=5),
+			max_attempts=2,
+			worker_id="worker-2",
+		)
+		assert claimed.id == import_job.id
+		assert claimed.lease_owner == "worker-2"
+		assert claimed.attempts == 2
+		assert not crud.import_job_renew_lease(
+			db=self.db,
+			import_job_id=import_job.id,
+			lease_duration=datetime.timedelta(minutes=5),
+			worker_id="worker-1",
+		)
+
+		import_job.lease_expires = datetime.datetime.now() - datetime.timedelta(seconds=1)
+		self.db.commit()
+		assert crud.import_job_claim(
+			db=self.db,
+			lease_duration=datetime.timedelta(minutes=5),
+			max_attempts=2,
+			worker_id="worker-3",
+		) is None
+		self.db.expire_all()
+		assert import_job.status == models.ImportJobStatus.error
+		assert import_job.error == models.ImportJobError.TOO_MANY_ATTEMPTS
 
 	def test_root(self):
 		with TestClient(app) as client: